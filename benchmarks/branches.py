@@ -0,0 +1,65 @@
+"""
+Compare the serial and thread pool executors on a graph with several
+independent, numpy-heavy branches hanging off of a single root.
+
+    python benchmarks/branches.py [n_branches] [n_chunks] [workers]
+"""
+import sys
+import time
+import numpy as np
+import featureflow as ff
+
+
+class Frames(ff.Node):
+    def __init__(self, needs=None):
+        super(Frames, self).__init__(needs=needs)
+
+    def _process(self, data):
+        for _ in xrange(data):
+            yield np.random.random_sample((256, 256))
+
+
+class Project(ff.Node):
+    def __init__(self, needs=None):
+        super(Project, self).__init__(needs=needs)
+        self._weights = np.random.random_sample((256, 256))
+
+    def _process(self, data):
+        yield np.dot(data, self._weights)
+
+
+class Energy(ff.Node):
+    def __init__(self, needs=None):
+        super(Energy, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield np.dot(data, data.T).sum()
+
+
+def build_graph(n_branches):
+    g = ff.Graph()
+    g['frames'] = Frames()
+    for i in xrange(n_branches):
+        g['project{i}'.format(**locals())] = project = Project(
+                needs=g['frames'])
+        g['energy{i}'.format(**locals())] = Energy(needs=project)
+    return g
+
+
+def timeit(executor, n_branches, n_chunks):
+    g = build_graph(n_branches)
+    g.executor = executor
+    start = time.time()
+    g.process(frames=n_chunks)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_branches = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    n_chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else n_branches
+    executors = [ff.SerialExecutor(), ff.ThreadPoolExecutor(workers=workers)]
+    for executor in executors:
+        elapsed = timeit(executor, n_branches, n_chunks)
+        print '{name:<20} {elapsed:.3f}s'.format(
+                name=executor.__class__.__name__, elapsed=elapsed)
@@ -0,0 +1,75 @@
+"""
+Compare the compression codecs on a few typical payloads, reporting the
+throughput of compression and decompression, along with the compression
+ratio, for each.  Payloads are fed through in chunks, as they would be by
+CompressionEncoder.
+
+    python benchmarks/compression.py [n_megabytes] [chunk_size]
+"""
+import sys
+import time
+import numpy as np
+from io import BytesIO
+from featureflow import compression
+from featureflow.decoder import CompressionDecoder
+
+
+def payloads(n_bytes):
+    words = open(__file__).read().split()
+    text = ' '.join(np.random.choice(words, n_bytes // 6))[:n_bytes]
+    yield 'text', text
+    yield 'random bytes', np.random.bytes(n_bytes)
+    yield 'float64 array', \
+        np.random.normal(0, 1, n_bytes // 8).astype(np.float64).tostring()
+    yield 'int16 samples', (np.sin(
+            np.arange(n_bytes // 2) * 0.01) * 10000).astype(np.int16).tostring()
+    yield 'sparse uint8', (np.random.random_sample(n_bytes) > 0.95) \
+        .astype(np.uint8).tostring()
+
+
+def compress(codec, level, data, chunk_size):
+    compressor = codec.compressor(level)
+    chunks = [codec.header]
+    for i in xrange(0, len(data), chunk_size):
+        chunks.append(compressor.compress(data[i: i + chunk_size]))
+    chunks.append(compressor.flush())
+    return ''.join(chunks)
+
+
+def decompress(compressed):
+    return ''.join(CompressionDecoder()(BytesIO(compressed)))
+
+
+def runs():
+    yield 'zlib', 1
+    yield 'zlib', 6
+    yield 'zlib', 9
+    yield 'bz2', 9
+    if 'lzma' in compression.CODECS:
+        yield 'lzma', 0
+        yield 'lzma', 6
+
+
+if __name__ == '__main__':
+    n_megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2 ** 16
+    n_bytes = n_megabytes * 2 ** 20
+    for payload, data in payloads(n_bytes):
+        print payload
+        for name, level in runs():
+            codec = compression.codec(name)
+            start = time.time()
+            compressed = compress(codec, level, data, chunk_size)
+            compress_time = time.time() - start
+            start = time.time()
+            decompressed = decompress(compressed)
+            decompress_time = time.time() - start
+            assert decompressed == data
+            print (
+                '  {name:<5} {level:<2} ratio {ratio:>6.2f}  '
+                'compress {c:>7.1f}MB/s  decompress {d:>7.1f}MB/s').format(
+                    name=name,
+                    level=level,
+                    ratio=len(data) / float(len(compressed)),
+                    c=n_megabytes / compress_time,
+                    d=n_megabytes / decompress_time)
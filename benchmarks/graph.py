@@ -0,0 +1,58 @@
+"""
+Compare the time it takes each Graph executor to push many small chunks
+through a linear chain of nodes, with and without fusion of the chain.
+
+    python benchmarks/graph.py [n_chunks] [chain_length]
+"""
+import sys
+import time
+import featureflow as ff
+
+
+class Source(ff.Node):
+    def __init__(self, needs=None):
+        super(Source, self).__init__(needs=needs)
+
+    def _process(self, data):
+        for i in xrange(data):
+            yield 'x'
+
+
+class PassThrough(ff.Node):
+    def __init__(self, needs=None):
+        super(PassThrough, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data
+
+
+def build_chain(length, fusable=True):
+    g = ff.Graph()
+    g['source'] = node = Source()
+    for i in xrange(length):
+        node = PassThrough(needs=node)
+        node.fusable = fusable
+        g['node{i}'.format(**locals())] = node
+    return g
+
+
+def timeit(executor, n_chunks, length, fusable=True):
+    g = build_chain(length, fusable=fusable)
+    g.executor = executor
+    start = time.time()
+    g.process(source=n_chunks)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    runs = [
+        ('QueueExecutor', ff.QueueExecutor(), True),
+        ('SerialExecutor', ff.SerialExecutor(), False),
+        ('SerialExecutor+fused', ff.SerialExecutor(), True)
+    ]
+    for name, executor, fusable in runs:
+        elapsed = timeit(executor, n_chunks, length, fusable=fusable)
+        print '{name:<24} {elapsed:.3f}s ({rate:.0f} chunks/s)'.format(
+                name=name, elapsed=elapsed, rate=n_chunks / elapsed)
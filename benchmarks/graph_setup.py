@@ -0,0 +1,85 @@
+"""
+Measure the per-document cost of building a model's extractor graph, i.e.,
+everything BaseModel.process does before the first chunk is processed, both
+from the model's cached GraphTemplate, and as it was built before templates
+existed: by recursing through every feature, computing each feature's
+version anew, building dead nodes and then pruning them.
+
+    python benchmarks/graph_setup.py [n_documents]
+"""
+import sys
+import time
+import featureflow as ff
+
+
+class Stream(ff.Node):
+    def __init__(self, chunksize=3, needs=None):
+        super(Stream, self).__init__(needs=needs)
+        self._chunksize = chunksize
+
+    def _process(self, data):
+        yield data
+
+
+class Step(ff.Node):
+    def __init__(self, factor=1, needs=None):
+        super(Step, self).__init__(needs=needs)
+        self._factor = factor
+
+    def _process(self, data):
+        yield data
+
+
+class Settings(ff.PersistenceSettings):
+    id_provider = ff.UuidProvider()
+    key_builder = ff.StringDelimitedKeyBuilder()
+    database = ff.InMemoryDatabase(key_builder=key_builder)
+
+
+class Document(ff.BaseModel, Settings):
+    stream = ff.Feature(Stream, store=True)
+    a = ff.Feature(Step, needs=stream, store=False)
+    b = ff.Feature(Step, needs=a, store=True)
+    c = ff.Feature(Step, needs=b, store=False)
+    d = ff.Feature(Step, needs=c, store=True)
+    e = ff.Feature(Step, needs=stream, store=True)
+    f = ff.JSONFeature(Step, needs=e, store=True)
+    g = ff.Feature(Step, needs=[d, f], store=True)
+    unused = ff.Feature(Step, needs=g, store=False)
+
+
+def build_from_template(_id):
+    return Document._build_extractor(_id)
+
+
+def build_without_template(_id):
+    features = Document.features.values()
+    # versions were computed every time a key was built
+    for feature in features:
+        feature._version = None
+    graph = ff.Graph()
+    for feature in features:
+        feature._build_extractor(_id, graph, Document)
+    graph.remove_dead_nodes(features)
+    return graph
+
+
+def setup(build, n_documents):
+    start = time.time()
+    for i in xrange(n_documents):
+        graph = build(str(i))
+        graph.compile()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for build in [build_without_template, build_from_template]:
+        elapsed = setup(build, n_documents)
+        print (
+            '{name:<24} {n} graphs in {elapsed:.3f}s '
+            '({per:.1f}us per document)').format(
+                name=build.__name__,
+                n=n_documents,
+                elapsed=elapsed,
+                per=1e6 * elapsed / n_documents)
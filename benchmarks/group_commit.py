@@ -0,0 +1,67 @@
+"""
+Compare the time it takes to process many small documents into an
+LmdbDatabase, committing each document on its own, and in groups.
+
+    python benchmarks/group_commit.py [n_documents] [group_size]
+"""
+import sys
+import time
+import shutil
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+class Text(ff.Node):
+    def __init__(self, needs=None):
+        super(Text, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data
+
+
+class Upper(ff.Node):
+    def __init__(self, needs=None):
+        super(Upper, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data.upper()
+
+
+def build_model(path, group_commit):
+    class Settings(ff.PersistenceSettings):
+        id_provider = ff.UuidProvider()
+        key_builder = ff.StringDelimitedKeyBuilder()
+        database = ff.LmdbDatabase(
+                path,
+                map_size=1000000000,
+                key_builder=key_builder,
+                group_commit=group_commit)
+
+    class Document(ff.BaseModel, Settings):
+        text = ff.Feature(Text, store=True)
+        upper = ff.Feature(Upper, needs=text, store=True)
+
+    return Document
+
+
+def timeit(n_documents, group_commit):
+    path = mkdtemp()
+    try:
+        model = build_model(path, group_commit)
+        documents = (dict(text='x' * 512) for _ in xrange(n_documents))
+        start = time.time()
+        for result in model.process_many(documents, workers=1):
+            if result.error:
+                raise Exception(result.error)
+        return time.time() - start
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    n_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    group_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for name, group_commit in [('per document', None), ('group', group_size)]:
+        elapsed = timeit(n_documents, group_commit)
+        print '{name:<16} {elapsed:.3f}s ({rate:.0f} documents/s)'.format(
+                name=name, elapsed=elapsed, rate=n_documents / elapsed)
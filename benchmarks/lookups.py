@@ -0,0 +1,59 @@
+"""
+Measure the rate of the small lookups a feature server makes against an
+LmdbDatabase: checking whether a value is stored, asking for its size, and
+reading it.
+
+    python benchmarks/lookups.py [n_values] [value_size]
+"""
+import sys
+import os
+import time
+import shutil
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+def populate(db, keys, value_size):
+    value = os.urandom(value_size)
+    with db.transaction():
+        for key in keys:
+            with db.write_stream(key, 'application/octet-stream') as ws:
+                ws.write(value)
+
+
+def contains(db, key):
+    return key in db
+
+
+def size(db, key):
+    return db.size(key)
+
+
+def read(db, key):
+    with db.read_stream(key) as rs:
+        return rs.read()
+
+
+def timeit(db, keys, func):
+    start = time.time()
+    for key in keys:
+        func(db, key)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_values = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    value_size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+    path = mkdtemp()
+    try:
+        key_builder = ff.StringDelimitedKeyBuilder()
+        db = ff.LmdbDatabase(path, key_builder=key_builder)
+        keys = [key_builder.build(str(i), 'feature', 'version')
+                for i in xrange(n_values)]
+        populate(db, keys, value_size)
+        for func in [contains, size, read]:
+            elapsed = timeit(db, keys, func)
+            print '{name:<10} {rate:.0f} lookups/s'.format(
+                    name=func.__name__, rate=n_values / elapsed)
+    finally:
+        shutil.rmtree(path)
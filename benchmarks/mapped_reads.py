@@ -0,0 +1,85 @@
+"""
+Compare the time it takes to decode a large stored array, and the memory
+used by the process afterward, when FileSystemDatabase reads it from a plain
+file, and from a memory-mapped one, which the array is built over, without
+copying.  Each run happens in a fresh process, so that its peak resident
+set size can be measured.
+
+    python benchmarks/mapped_reads.py [n_megabytes]
+"""
+import sys
+import time
+import resource
+import shutil
+import subprocess
+from tempfile import mkdtemp
+import numpy as np
+import featureflow as ff
+
+
+class PassThrough(ff.Node):
+    def __init__(self, needs=None):
+        super(PassThrough, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data
+
+
+def document(path, mmap):
+    class Settings(ff.PersistenceSettings):
+        id_provider = ff.UserSpecifiedIdProvider(key='_id')
+        key_builder = ff.StringDelimitedKeyBuilder()
+        database = ff.FileSystemDatabase(
+                path=path, key_builder=key_builder, mmap=mmap)
+
+    class Document(ff.BaseModel, Settings):
+        arr = ff.NumpyFeature(
+                PassThrough,
+                store=True,
+                decoder=ff.GreedyNumpyDecoder(zero_copy=True))
+
+    return Document
+
+
+def private_memory():
+    """
+    Resident memory that isn't backed by a file, and so can't be shared with
+    other processes, or dropped under memory pressure (linux only)
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return line.split(':')[1].strip()
+    return 'unknown'
+
+
+def read(path, mmap):
+    doc = document(path, mmap)
+    start = time.time()
+    arr = doc('id').arr
+    elapsed = time.time() - start
+    arr.sum()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print '{name:<8} {elapsed:.3f}s peak {peak:.0f}MB private {private}'.format(
+            name='mmap' if mmap else 'file',
+            elapsed=elapsed,
+            peak=peak,
+            private=private_memory())
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['read']:
+        read(sys.argv[2], sys.argv[3] == 'True')
+        sys.exit(0)
+
+    n_megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    path = mkdtemp()
+    try:
+        arr = np.random.random_sample((n_megabytes * 1024, 128))
+        document(path, False).process(arr=arr, _id='id')
+        del arr
+        for mmap in (False, True):
+            subprocess.check_call(
+                    [sys.executable, __file__, 'read', path, str(mmap)])
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,78 @@
+"""
+Compare reading one feature for many documents with a read_stream() call
+per key, and with a single read_many() call, for each database backend, and
+with FileSystemDatabase's threaded read_many().
+
+    python benchmarks/read_many.py [n_values] [value_size]
+"""
+import sys
+import os
+import time
+import random
+import shutil
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+def populate(db, keys, value_size):
+    value = os.urandom(value_size)
+    for key in keys:
+        with db.write_stream(key, 'application/octet-stream') as ws:
+            ws.write(value)
+
+
+def one_at_a_time(db, keys):
+    for key in keys:
+        stream = db.read_stream(key)
+        stream.read()
+        stream.close()
+
+
+def batched(db, keys):
+    for key, stream in db.read_many(keys):
+        stream.read()
+        stream.close()
+
+
+def threaded(db, keys):
+    for key, stream in db.read_many(keys, workers=8):
+        stream.read()
+        stream.close()
+
+
+def timeit(db, keys, func):
+    start = time.time()
+    func(db, keys)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_values = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    value_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    key_builder = ff.StringDelimitedKeyBuilder()
+    keys = [key_builder.build(str(i), 'feature', 'version')
+            for i in xrange(n_values)]
+    path = mkdtemp()
+    try:
+        databases = [
+            ('lmdb', ff.LmdbDatabase(
+                    os.path.join(path, 'lmdb'), key_builder=key_builder)),
+            ('filesystem', ff.FileSystemDatabase(
+                    os.path.join(path, 'fs'),
+                    key_builder=key_builder,
+                    createdirs=True))
+        ]
+        for name, db in databases:
+            populate(db, keys, value_size)
+            random.shuffle(keys)
+            funcs = [one_at_a_time, batched]
+            if name == 'filesystem':
+                funcs.append(threaded)
+            for func in funcs:
+                elapsed = timeit(db, keys, func)
+                print '{name:<12} {func:<14} {rate:.0f} values/s'.format(
+                        name=name,
+                        func=func.__name__,
+                        rate=n_values / elapsed)
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,75 @@
+"""
+Measure read throughput from an LmdbDatabase as the number of concurrent
+reader processes grows.  Each reader opens the database read-only and reads
+every value in a random order.
+
+    python benchmarks/readers.py [n_values] [value_size] [max_readers]
+"""
+import sys
+import os
+import time
+import random
+import shutil
+import multiprocessing
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+def populate(path, n_values, value_size):
+    key_builder = ff.StringDelimitedKeyBuilder()
+    db = ff.LmdbDatabase(path, key_builder=key_builder)
+    value = os.urandom(value_size)
+    with db.transaction():
+        for i in xrange(n_values):
+            key = key_builder.build(str(i), 'feature', 'version')
+            with db.write_stream(key, 'application/octet-stream') as ws:
+                ws.write(value)
+    db.env.close()
+
+
+def read_all(args):
+    path, n_values = args
+    key_builder = ff.StringDelimitedKeyBuilder()
+    db = ff.LmdbDatabase(path, key_builder=key_builder, readonly=True)
+    ids = range(n_values)
+    random.shuffle(ids)
+    nbytes = 0
+    for i in ids:
+        key = key_builder.build(str(i), 'feature', 'version')
+        with db.read_stream(key) as rs:
+            nbytes += len(rs.read())
+    return nbytes
+
+
+def timeit(path, n_values, n_readers):
+    pool = multiprocessing.Pool(n_readers)
+    try:
+        start = time.time()
+        nbytes = sum(pool.map(read_all, [(path, n_values)] * n_readers))
+        return time.time() - start, nbytes
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    n_values = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    value_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    max_readers = int(sys.argv[3]) if len(sys.argv) > 3 \
+        else multiprocessing.cpu_count()
+    path = mkdtemp()
+    try:
+        populate(path, n_values, value_size)
+        n_readers = 1
+        while n_readers <= max_readers:
+            elapsed, nbytes = timeit(path, n_values, n_readers)
+            reads = n_values * n_readers
+            print '{n:>3} readers {elapsed:.3f}s ' \
+                  '({rate:.0f} reads/s, {mb:.0f}MB/s)'.format(
+                        n=n_readers,
+                        elapsed=elapsed,
+                        rate=reads / elapsed,
+                        mb=nbytes / elapsed / 1e6)
+            n_readers *= 2
+    finally:
+        shutil.rmtree(path)
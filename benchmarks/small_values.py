@@ -0,0 +1,78 @@
+"""
+Compare SegmentDatabase with FileSystemDatabase and LmdbDatabase on many
+tiny values: writing documents with several small features each, a
+transaction per document, then reading every value back in random order.
+The number of files each database leaves on disk is also reported.
+
+    python benchmarks/small_values.py [n_documents] [n_features] [value_size]
+"""
+import sys
+import os
+import time
+import random
+import shutil
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+def write(db, keys, value):
+    for document in keys:
+        with db.transaction():
+            for key in document:
+                with db.write_stream(key, 'application/json') as ws:
+                    ws.write(value)
+    db.commit()
+
+
+def read(db, keys):
+    keys = [key for document in keys for key in document]
+    random.shuffle(keys)
+    for key in keys:
+        stream = db.read_stream(key)
+        stream.read()
+        stream.close()
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+if __name__ == '__main__':
+    n_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_features = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    value_size = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    key_builder = ff.StringDelimitedKeyBuilder()
+    keys = [
+        [key_builder.build(str(i), 'feature{j}'.format(j=j), 'version')
+         for j in xrange(n_features)]
+        for i in xrange(n_documents)]
+    value = os.urandom(value_size)
+    path = mkdtemp()
+    try:
+        databases = [
+            ('segment', os.path.join(path, 'segment'), ff.SegmentDatabase),
+            ('lmdb', os.path.join(path, 'lmdb'), ff.LmdbDatabase),
+            ('filesystem', os.path.join(path, 'fs'),
+             lambda p, key_builder: ff.FileSystemDatabase(
+                     p, key_builder=key_builder, createdirs=True))
+        ]
+        n_values = n_documents * n_features
+        for name, db_path, factory in databases:
+            db = factory(db_path, key_builder=key_builder)
+            write_time = timeit(write, db, keys, value)
+            read_time = timeit(read, db, keys)
+            print (
+                '{name:<12} write {write:>8.0f} values/s  '
+                'read {read:>8.0f} values/s  {files} files').format(
+                    name=name,
+                    write=n_values / write_time,
+                    read=n_values / read_time,
+                    files=count_files(db_path))
+    finally:
+        shutil.rmtree(path)
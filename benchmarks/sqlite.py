@@ -0,0 +1,79 @@
+"""
+Compare SqliteDatabase with LmdbDatabase and FileSystemDatabase: writing
+documents with several features each, a transaction per document, then
+reading every value back in random order, and listing the ids.
+
+    python benchmarks/sqlite.py [n_documents] [n_features] [value_size]
+"""
+import sys
+import os
+import time
+import random
+import shutil
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+def write(db, keys, value):
+    for document in keys:
+        with db.transaction():
+            for key in document:
+                with db.write_stream(key, 'application/octet-stream') as ws:
+                    ws.write(value)
+
+
+def read(db, keys):
+    keys = [key for document in keys for key in document]
+    random.shuffle(keys)
+    for key in keys:
+        stream = db.read_stream(key)
+        stream.read()
+        stream.close()
+
+
+def list_ids(db, keys):
+    for _ in db.iter_ids():
+        pass
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_features = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    value_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1024
+    key_builder = ff.StringDelimitedKeyBuilder()
+    keys = [
+        [key_builder.build(str(i), 'feature{j}'.format(j=j), 'version')
+         for j in xrange(n_features)]
+        for i in xrange(n_documents)]
+    value = os.urandom(value_size)
+    path = mkdtemp()
+    try:
+        databases = [
+            ('sqlite', ff.SqliteDatabase(
+                    os.path.join(path, 'sqlite.db'), key_builder=key_builder)),
+            ('lmdb', ff.LmdbDatabase(
+                    os.path.join(path, 'lmdb'), key_builder=key_builder)),
+            ('filesystem', ff.FileSystemDatabase(
+                    os.path.join(path, 'fs'),
+                    key_builder=key_builder,
+                    createdirs=True))
+        ]
+        n_values = n_documents * n_features
+        for name, db in databases:
+            elapsed = timeit(write, db, keys, value)
+            print '{name:<12} write    {rate:>8.0f} documents/s'.format(
+                    name=name, rate=n_documents / elapsed)
+            elapsed = timeit(read, db, keys)
+            print '{name:<12} read     {rate:>8.0f} values/s'.format(
+                    name=name, rate=n_values / elapsed)
+            elapsed = timeit(list_ids, db, keys)
+            print '{name:<12} iter_ids {rate:>8.0f} ids/s'.format(
+                    name=name, rate=n_documents / elapsed)
+    finally:
+        shutil.rmtree(path)
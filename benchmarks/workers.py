@@ -0,0 +1,83 @@
+"""
+Time process_many() with several worker processes writing to an
+LmdbDatabase, a ShardedLmdbDatabase and a SqliteDatabase, while each
+document spends most of its time in a slow node.  Documents should overlap,
+since a document only takes its database's write lock once it's complete,
+so the time taken should be close to n_documents / workers slow steps,
+rather than n_documents.
+
+    python benchmarks/workers.py [n_documents] [workers] [delay]
+"""
+import sys
+import time
+import shutil
+from tempfile import mkdtemp
+import featureflow as ff
+
+
+class Text(ff.Node):
+    def __init__(self, needs=None):
+        super(Text, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data
+
+
+class Slow(ff.Node):
+    def __init__(self, delay=0, needs=None):
+        super(Slow, self).__init__(needs=needs)
+        self.delay = delay
+
+    def _process(self, data):
+        time.sleep(self.delay)
+        yield data.upper()
+
+
+def build_model(database, delay):
+    class Settings(ff.PersistenceSettings):
+        id_provider = ff.UuidProvider()
+        key_builder = ff.StringDelimitedKeyBuilder()
+
+    Settings.database = database(key_builder=Settings.key_builder)
+
+    class Document(ff.BaseModel, Settings):
+        text = ff.Feature(Text, store=True)
+        slow = ff.Feature(Slow, needs=text, delay=delay, store=True)
+
+    return Document
+
+
+def timeit(database, n_documents, workers, delay):
+    model = build_model(database, delay)
+    documents = (dict(text='x' * 512) for _ in xrange(n_documents))
+    start = time.time()
+    for result in model.process_many(documents, workers=workers):
+        if result.error:
+            raise Exception(result.error)
+    elapsed = time.time() - start
+    assert model.database.count() == n_documents
+    return elapsed
+
+
+if __name__ == '__main__':
+    n_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    print 'ideal        {ideal:.2f}s'.format(
+            ideal=delay * n_documents / workers)
+    path = mkdtemp()
+    try:
+        databases = [
+            ('lmdb', lambda **kwargs: ff.LmdbDatabase(
+                    path + '/lmdb', map_size=2 ** 26, **kwargs)),
+            ('sharded', lambda **kwargs: ff.ShardedLmdbDatabase(
+                    path + '/sharded', shards=4, map_size=2 ** 26, **kwargs)),
+            ('sqlite', lambda **kwargs: ff.SqliteDatabase(
+                    path + '/sqlite.db', timeout=2, **kwargs))
+        ]
+        for name, database in databases:
+            elapsed = timeit(database, n_documents, workers, delay)
+            print '{name:<12} {elapsed:.2f}s'.format(
+                    name=name, elapsed=elapsed)
+    finally:
+        shutil.rmtree(path)
@@ -1,18 +1,19 @@
 __version__ = '1.16.12'
 
-from model import BaseModel
+from model import BaseModel, ProcessResult
 
 from feature import Feature, JSONFeature, TextFeature, CompressedFeature, \
     PickleFeature
 
-from extractor import Node, Graph, Aggregator, NotEnoughData
+from extractor import Node, Graph, Aggregator, NotEnoughData, ExecutionPlan, \
+    SerialExecutor, QueueExecutor, ThreadPoolExecutor
 
 from bytestream import ByteStream, ByteStreamFeature, ZipWrapper, iter_zip
 
 from data import \
     IdProvider, UuidProvider, UserSpecifiedIdProvider, StaticIdProvider, \
     KeyBuilder, StringDelimitedKeyBuilder, Database, FileSystemDatabase, \
-    InMemoryDatabase
+    InMemoryDatabase, LruDatabase, CachedDatabase
 
 from datawriter import DataWriter
 
@@ -22,14 +23,20 @@ from encoder import IdentityEncoder
 
 from decoder import Decoder
 
-from lmdbstore import LmdbDatabase
+from lmdbstore import LmdbDatabase, ShardedLmdbDatabase
+
+from sqlitestore import SqliteDatabase
+
+from segmentstore import SegmentDatabase
 
 from persistence import PersistenceSettings
 
 from iteratornode import IteratorNode
 
+from profiler import Profiler, GraphReport, NodeStats
+
 try:
     from nmpy import NumpyEncoder, PackedNumpyEncoder, StreamingNumpyDecoder, \
-        BaseNumpyDecoder, NumpyMetaData, NumpyFeature
+        BaseNumpyDecoder, GreedyNumpyDecoder, NumpyMetaData, NumpyFeature
 except ImportError:
     pass
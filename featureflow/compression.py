@@ -0,0 +1,111 @@
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Compressed values begin with this, followed by a single byte identifying
+# the codec they were compressed with
+HEADER_PREFIX = '\x00ffcodec'
+
+HEADER_SIZE = len(HEADER_PREFIX) + 1
+
+# values compressed before codecs were recorded are all bz2 streams, which
+# begin with this
+_BZ2_MAGIC = 'BZh'
+
+
+class Codec(object):
+    """
+    A compression algorithm, along with the tag identifying it in stored
+    values, and the level it compresses at, by default
+    """
+
+    def __init__(self, name, tag, compressor, decompressor, default_level):
+        super(Codec, self).__init__()
+        self.name = name
+        self.tag = tag
+        self._compressor = compressor
+        self._decompressor = decompressor
+        self.default_level = default_level
+
+    @property
+    def header(self):
+        return HEADER_PREFIX + self.tag
+
+    def compressor(self, level=None):
+        return self._compressor(
+                self.default_level if level is None else level)
+
+    def decompressor(self):
+        return self._decompressor()
+
+    def __repr__(self):
+        return '{cls}(name = {name})'.format(
+                cls=self.__class__.__name__, name=self.name)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+CODECS = dict()
+
+_TAGS = dict()
+
+
+def register(codec):
+    CODECS[codec.name] = codec
+    _TAGS[codec.tag] = codec
+
+
+register(Codec(
+        'zlib', 'z', lambda level: zlib.compressobj(level),
+        zlib.decompressobj, 6))
+
+register(Codec(
+        'bz2', 'b', lambda level: bz2.BZ2Compressor(level),
+        bz2.BZ2Decompressor, 9))
+
+if lzma is not None:
+    register(Codec(
+            'lzma', 'x', lambda level: lzma.LZMACompressor(preset=level),
+            lzma.LZMADecompressor, 6))
+
+
+def codec(name):
+    """
+    Look up a registered codec by name
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(
+                'unknown codec {name}; choose from {names}{lzma}'.format(
+                        name=name,
+                        names=', '.join(sorted(CODECS)),
+                        lzma='' if lzma is not None else
+                        ' (install backports.lzma for lzma)'))
+
+
+def detect(head):
+    """
+    Return the codec the value beginning with head was compressed with, and
+    whether head is a header that should be discarded, rather than passed to
+    the codec's decompressor
+    """
+    if head.startswith(HEADER_PREFIX) and len(head) >= HEADER_SIZE:
+        tag = head[len(HEADER_PREFIX)]
+        try:
+            return _TAGS[tag], True
+        except KeyError:
+            raise ValueError(
+                    'value was compressed with an unknown codec {tag!r}'
+                    .format(**locals()))
+    if head.startswith(_BZ2_MAGIC):
+        return CODECS['bz2'], False
+    raise ValueError('value is not compressed with a known codec')
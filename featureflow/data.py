@@ -1,7 +1,20 @@
 from StringIO import StringIO
 from uuid import uuid4
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import threading
+import hashlib
+import errno
+import mmap
 import os
 
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 
 class IdProvider(object):
     """
@@ -79,10 +92,39 @@ class Database(object):
     Marker class for a datastore
     """
 
+    # True if several processes, each of which has called reopen(), may write
+    # to this database at the same time
+    process_safe = False
+
+    # True if the writes made within transaction() are atomic
+    transactional = False
+
     def __init__(self, key_builder=None):
         super(Database, self).__init__()
         self.key_builder = key_builder
 
+    def reopen(self):
+        """
+        Called in a newly forked process, before the database is used there
+        """
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        The scope within which a single document's features are written.
+        Transactional databases commit everything written within it at
+        once, and discard all of it if an exception is raised.  Others write
+        each value as soon as its stream is closed
+        """
+        yield
+
+    def commit(self):
+        """
+        Commit any documents whose writes are being batched
+        """
+        pass
+
     # TODO: Maybe this should just be open(), since it returns a file-like 
     # object
     def write_stream(self, key, content_type):
@@ -93,12 +135,31 @@ class Database(object):
     def read_stream(self, key):
         raise NotImplementedError()
 
+    def read_many(self, keys):
+        """
+        Yield a (key, stream) pair for each key in keys, in order, where
+        stream is None if nothing is stored under key.  Subclasses may
+        override this to read many values more efficiently than with
+        read_stream() alone
+        """
+        for key in keys:
+            try:
+                yield key, self.read_stream(key)
+            except KeyError:
+                yield key, None
+
     def size(self, key):
         raise NotImplementedError()
 
     def iter_ids(self):
         raise NotImplementedError()
 
+    def count(self):
+        """
+        The number of documents with at least one stored value
+        """
+        return sum(1 for _ in self.iter_ids())
+
     def __iter__(self):
         return self.iter_ids()
 
@@ -118,23 +179,50 @@ class IOWithLength(StringIO):
         return self._length
 
 
+class _MemoryWriteStream(object):
+    """
+    Collects the chunks written to it, and hands them, joined, to on_close
+    when it's closed
+    """
+
+    def __init__(self, on_close):
+        super(_MemoryWriteStream, self).__init__()
+        self._chunks = []
+        self._on_close = on_close
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def write(self, data):
+        if not isinstance(data, basestring):
+            # anything else with the buffer interface, as files accept
+            data = buffer(data)[:]
+        self._chunks.append(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # joining a single chunk returns the chunk itself, rather than a copy
+        value = ''.join(self._chunks)
+        self._chunks = None
+        self._on_close(value)
+
+
 class InMemoryDatabase(Database):
     def __init__(self, key_builder=None):
         super(InMemoryDatabase, self).__init__(key_builder=key_builder)
         self._dict = dict()
 
-    def write_stream(self, key, content_type):
-        sio = StringIO()
-        self._dict[key] = sio
-
-        def hijacked_close():
-            sio.seek(0)
-            self._dict[key] = sio.read()
-            sio._old_close()
+    def _store(self, key, value):
+        self._dict[key] = value
 
-        sio._old_close = sio.close
-        sio.close = hijacked_close
-        return sio
+    def write_stream(self, key, content_type):
+        return _MemoryWriteStream(lambda value: self._store(key, value))
 
     def read_stream(self, key):
         return IOWithLength(self._dict[key])
@@ -142,8 +230,7 @@ class InMemoryDatabase(Database):
     def size(self, key):
         return len(self._dict[key])
 
-    def iter_ids(self):
-        seen = set()
+    def _iter_ids(self, seen):
         for key in self._dict.iterkeys():
             _id, _, _ = self.key_builder.decompose(key)
             if _id in seen:
@@ -151,6 +238,9 @@ class InMemoryDatabase(Database):
             yield _id
             seen.add(_id)
 
+    def iter_ids(self):
+        return self._iter_ids(set())
+
     def __contains__(self, key):
         return key in self._dict
 
@@ -158,32 +248,630 @@ class InMemoryDatabase(Database):
         del self._dict[key]
 
 
+class LruDatabase(InMemoryDatabase):
+    """
+    An InMemoryDatabase that holds at most max_bytes of values.  When a
+    write pushes it over budget, the least recently used values are evicted,
+    and are either discarded, or, if spill is given, written to spill, which
+    may be any other Database, and from which they're read back into memory
+    the next time they're requested.  Values larger than max_bytes are
+    written straight to spill.
+
+    hits and misses count the reads that were, and weren't, served from
+    memory, evictions counts the values evicted, and nbytes is the size of
+    the values currently held in memory
+    """
+
+    def __init__(self, max_bytes, spill=None, key_builder=None):
+        super(LruDatabase, self).__init__(key_builder=key_builder)
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self._dict = OrderedDict()
+        # keys whose value in memory is identical to the one in spill, and so
+        # needn't be written there again when they're evicted
+        self._clean = set()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def reopen(self):
+        if self.spill is not None:
+            self.spill.reopen()
+
+    def commit(self):
+        if self.spill is not None:
+            self.spill.commit()
+
+    def _spill(self, key, value):
+        if self.spill is None:
+            return
+        with self.spill.transaction():
+            stream = self.spill.write_stream(key, 'application/octet-stream')
+            stream.write(value)
+            stream.close()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            key, value = self._dict.popitem(last=False)
+            self.nbytes -= len(value)
+            self.evictions += 1
+            if key in self._clean:
+                self._clean.discard(key)
+            else:
+                self._spill(key, value)
+
+    def _discard(self, key):
+        value = self._dict.pop(key, None)
+        if value is not None:
+            self.nbytes -= len(value)
+        self._clean.discard(key)
+        return value
+
+    def _store(self, key, value, clean=False):
+        self._discard(key)
+        if len(value) > self.max_bytes:
+            if not clean:
+                self._spill(key, value)
+            return
+        self._dict[key] = value
+        self.nbytes += len(value)
+        if clean:
+            self._clean.add(key)
+        self._evict()
+
+    def _get(self, key):
+        try:
+            value = self._dict.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self._dict[key] = value
+            return value
+
+        self.misses += 1
+        if self.spill is None:
+            raise KeyError(key)
+        stream = self.spill.read_stream(key)
+        try:
+            value = stream.read()
+        finally:
+            stream.close()
+        self._store(key, value, clean=True)
+        return value
+
+    def read_stream(self, key):
+        return IOWithLength(self._get(key))
+
+    def size(self, key):
+        try:
+            return len(self._dict[key])
+        except KeyError:
+            if self.spill is None:
+                raise
+            return self.spill.size(key)
+
+    def iter_ids(self):
+        seen = set()
+        for _id in self._iter_ids(seen):
+            yield _id
+        if self.spill is None:
+            return
+        for _id in self.spill.iter_ids():
+            if _id not in seen:
+                yield _id
+
+    def __contains__(self, key):
+        return key in self._dict \
+            or (self.spill is not None and key in self.spill)
+
+    def __delitem__(self, key):
+        value = self._discard(key)
+        if self.spill is not None and key in self.spill:
+            del self.spill[key]
+        elif value is None:
+            raise KeyError(key)
+
+
+class _TeeWriteStream(object):
+    """
+    Writes everything written to it to each of streams
+    """
+
+    def __init__(self, *streams):
+        super(_TeeWriteStream, self).__init__()
+        self.streams = streams
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+
+
+class CachedDatabase(Database):
+    """
+    Serves reads from front, a small, fast database, e.g., an LruDatabase,
+    or an LmdbDatabase on a local disk, in front of back, a larger, slower
+    one, e.g., a FileSystemDatabase on a network share.  Values missing from
+    front are read from back, and copied into front on the way.
+
+    Writes go to both databases, unless write_back is True, in which case
+    they're made to front only, and copied to back by commit().  front must
+    then be able to hold every value written between commits, and, since the
+    values yet to be copied are only known to the process that wrote them,
+    documents are never processed by several processes at once.
+
+    back is the authority on what's stored; front may lose values at any
+    time.  hits and misses count the reads that were, and weren't, served
+    from front, and bytes_saved is the total size of the former
+    """
+
+    def __init__(self, front, back, write_back=False, key_builder=None):
+        super(CachedDatabase, self).__init__(
+                key_builder=key_builder or back.key_builder)
+        self.front = front
+        self.back = back
+        self.write_back = write_back
+        # keys written to front, but not yet to back
+        self._dirty = set()
+        # keys written within the current thread's transaction
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def process_safe(self):
+        return not self.write_back \
+            and self.front.process_safe \
+            and self.back.process_safe
+
+    @property
+    def transactional(self):
+        return self.back.transactional
+
+    @property
+    def hit_ratio(self):
+        reads = self.hits + self.misses
+        return self.hits / float(reads) if reads else 0
+
+    def reopen(self):
+        self.front.reopen()
+        self.back.reopen()
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, 'written', None) is not None:
+            yield
+            return
+
+        self._local.written = written = []
+        try:
+            with self.back.transaction(), self.front.transaction():
+                yield
+        except:
+            # don't serve values that back has discarded
+            for key in written:
+                self._invalidate(key)
+            raise
+        finally:
+            self._local.written = None
+
+    def _invalidate(self, key):
+        self._dirty.discard(key)
+        try:
+            if key in self.front:
+                del self.front[key]
+        except (KeyError, OSError):
+            pass
+
+    def _copy(self, key, value, db, content_type='application/octet-stream'):
+        with db.transaction():
+            stream = db.write_stream(key, content_type)
+            stream.write(value)
+            stream.close()
+
+    def commit(self):
+        for key in list(self._dirty):
+            stream = self.front.read_stream(key)
+            try:
+                value = stream.read()
+            finally:
+                stream.close()
+            self._copy(key, value, self.back)
+            self._dirty.discard(key)
+        self.back.commit()
+        self.front.commit()
+
+    def write_stream(self, key, content_type):
+        written = getattr(self._local, 'written', None)
+        if written is not None:
+            written.append(key)
+        front = self.front.write_stream(key, content_type)
+        if self.write_back:
+            self._dirty.add(key)
+            return front
+        return _TeeWriteStream(self.back.write_stream(key, content_type), front)
+
+    def read_stream(self, key):
+        try:
+            stream = self.front.read_stream(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self.bytes_saved += self.front.size(key)
+            return stream
+
+        self.misses += 1
+        stream = self.back.read_stream(key)
+        try:
+            value = stream.read()
+        finally:
+            stream.close()
+        self._copy(key, value, self.front)
+        return IOWithLength(value)
+
+    def size(self, key):
+        try:
+            return self.front.size(key)
+        except KeyError:
+            return self.back.size(key)
+
+    def iter_ids(self):
+        seen = set()
+        for key in list(self._dirty):
+            _id, _, _ = self.key_builder.decompose(key)
+            if _id not in seen:
+                yield _id
+                seen.add(_id)
+        for _id in self.back.iter_ids():
+            if _id not in seen:
+                yield _id
+
+    def __contains__(self, key):
+        return key in self.front or key in self.back
+
+    def __delitem__(self, key):
+        dirty = key in self._dirty
+        self._invalidate(key)
+        if dirty and key not in self.back:
+            return
+        del self.back[key]
+
+
+# the suffix of values that are still being written
+_PARTIAL = '.partial'
+
+
+def _list(path, directories=None):
+    """
+    Yield the name of each entry in the directory at path, or only those of
+    the subdirectories, or files, if directories is True, or False.  Entries
+    are streamed with scandir, rather than reading the entire listing into
+    memory first.  scandir is an install requirement, but if it's missing,
+    e.g., in a source checkout, whole listings are read with os.listdir
+    """
+    if scandir is None:
+        for name in os.listdir(path):
+            if directories is None \
+                    or directories == os.path.isdir(os.path.join(path, name)):
+                yield name
+        return
+
+    for entry in scandir(path):
+        if directories is None or directories == entry.is_dir():
+            yield entry.name
+
+
+class BufferReadStream(object):
+    """
+    A file-like view of buf, any object with the buffer interface.  read()
+    returns copies, just as a file would, while read_buffer() returns buffers
+    that share buf's memory, and keep it alive
+    """
+
+    def __init__(self, buf, length=None):
+        super(BufferReadStream, self).__init__()
+        self.buf = buf
+        self.length = len(buf) if length is None else length
+        self.pos = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.buf = None
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = pos
+        elif whence == os.SEEK_END:
+            self.pos = max(0, self.length + pos)
+        elif whence == os.SEEK_CUR:
+            self.pos += pos
+        else:
+            raise IOError
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream')
+
+    def read_buffer(self, nbytes=None):
+        self._check_open()
+        if nbytes is None:
+            nbytes = self.length
+        v = buffer(self.buf, self.pos, nbytes)
+        self.pos += len(v)
+        return v
+
+    def read(self, nbytes=None):
+        return self.read_buffer(nbytes)[:]
+
+
+class ChunkedReads(object):
+    """
+    Reads for a BufferReadStream over a value stored as a series of chunks of
+    chunk_size bytes, which are fetched, one at a time, by _fetch_chunk() as
+    they're needed.  buf holds the chunk at _index.  Reads that fall within a
+    single chunk are zero-copy, while those that span chunks are assembled
+    into a new string
+    """
+
+    def _fetch_chunk(self, index):
+        raise NotImplementedError()
+
+    def _chunk(self, index):
+        if index != self._index:
+            buf = self._fetch_chunk(index)
+            if buf is None:
+                raise IOError('chunk {index} is missing'.format(**locals()))
+            self.buf = buf
+            self._index = index
+        return self.buf
+
+    def read_buffer(self, nbytes=None):
+        self._check_open()
+        remaining = max(0, self.length - self.pos)
+        nbytes = remaining if nbytes is None else min(nbytes, remaining)
+        pieces = []
+        while nbytes:
+            index, offset = divmod(self.pos, self.chunk_size)
+            piece = buffer(self._chunk(index), offset, nbytes)
+            pieces.append(piece)
+            self.pos += len(piece)
+            nbytes -= len(piece)
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(p[:] for p in pieces)
+
+
+class MappedReadStream(BufferReadStream):
+    """
+    A file-like view of a file that has been mapped into memory, read-only.
+    Pages are shared with every other process that maps, or reads, the same
+    file, and are only faulted in as they're touched.
+
+    Buffers returned by read_buffer() are over the mapped pages themselves.
+    Each keeps the mapping alive, so arrays built from them remain valid
+    after the stream is closed; the file is unmapped once the last of them
+    is gone
+    """
+
+    def __init__(self, f):
+        length = os.fstat(f.fileno()).st_size
+        # empty files can't be mapped
+        super(MappedReadStream, self).__init__(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if length else '')
+
+
+class _ReplacingWriteStream(object):
+    """
+    Writes to a temporary file alongside path, and moves it into place when
+    closed, so that readers with path mapped into memory continue to see the
+    old contents, rather than a file that's been truncated beneath them
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.partial = '{path}.{id}{suffix}'.format(
+                path=path, id=uuid4().hex, suffix=_PARTIAL)
+        self.f = open(self.partial, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.close()
+        os.rename(self.partial, self.path)
+
+
 class FileSystemDatabase(Database):
-    def __init__(self, path=None, key_builder=None, createdirs=False):
+    """
+    Stores each value in a file of its own.  By default, every file is
+    written to the directory at path, but directories with millions of
+    entries are slow to work with, so values may instead be spread across a
+    tree of directories levels deep, each level named by the next two
+    characters of the hex digest of the document id.  All of a document's
+    features are stored in the same directory.  An existing database can be
+    moved from one layout to the other with migrate()
+
+    If mmap is True, values are read through MappedReadStreams, which allow
+    numpy decoders to build arrays directly over the file's pages, instead of
+    reading them into a string first.  Values are then always written to a
+    new file that replaces the old one, since truncating a file that's
+    mapped by a reader is fatal to the reader
+    """
+
+    process_safe = True
+
+    def __init__(
+            self,
+            path=None,
+            key_builder=None,
+            createdirs=False,
+            levels=0,
+            mmap=False):
+
         super(FileSystemDatabase, self).__init__(key_builder=key_builder)
         self._path = path
+        self.levels = levels
+        self.mmap = mmap
+        # directories that are known to exist
+        self._directories = set()
         if createdirs and not os.path.exists(self._path):
             os.makedirs(self._path)
 
+    def _directory(self, key, levels=None):
+        levels = self.levels if levels is None else levels
+        if not levels:
+            return self._path
+        _id, _, _ = self.key_builder.decompose(key)
+        digest = hashlib.md5(_id).hexdigest()
+        return os.path.join(
+                self._path, *[digest[i * 2: i * 2 + 2] for i in xrange(levels)])
+
+    def _key_path(self, key):
+        return os.path.join(self._directory(key), key)
+
+    def _ensure_directory(self, directory):
+        if directory == self._path or directory in self._directories:
+            return
+        if not os.path.isdir(self._path):
+            # a missing root is left for open() to complain about
+            return
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._directories.add(directory)
+
+    def _directories_at(self, depth):
+        """
+        Yield every directory depth levels beneath the root
+        """
+        if not depth:
+            yield self._path
+            return
+
+        for parent in self._directories_at(depth - 1):
+            for name in _list(parent, directories=True):
+                yield os.path.join(parent, name)
+
+    def _files(self, levels, strict=False):
+        """
+        Yield a (directory, filename) pair for every value stored in a
+        layout levels deep.  Leaf directories should contain nothing else,
+        unless a migration is underway, in which case strict should be True
+        """
+        for directory in self._directories_at(levels):
+            for name in _list(directory, False if strict else None):
+                if not name.endswith(_PARTIAL):
+                    yield directory, name
+
     def write_stream(self, key, content_type):
-        return open(os.path.join(self._path, key), 'wb')
+        directory = self._directory(key)
+        self._ensure_directory(directory)
+        path = os.path.join(directory, key)
+        if self.mmap:
+            return _ReplacingWriteStream(path)
+        return open(path, 'wb')
 
     def read_stream(self, key):
         try:
-            return open(os.path.join(self._path, key), 'rb')
+            f = open(self._key_path(key), 'rb')
         except IOError:
             raise KeyError(key)
+        if not self.mmap:
+            return f
+        with f:
+            return MappedReadStream(f)
+
+    def _open_all(self, keys):
+        streams = []
+        for key in keys:
+            try:
+                streams.append(self.read_stream(key))
+            except KeyError:
+                streams.append(None)
+        return zip(keys, streams)
+
+    def read_many(self, keys, workers=None, batch_size=32):
+        """
+        Open files one at a time, or, if workers is given, on a pool of that
+        many threads, batch_size at a time, which pays off when opens are
+        slow, e.g., on network filesystems, or with a cold cache, but is
+        considerably slower than opening them one at a time on a local disk.
+        At most workers batches are opened ahead of the caller
+        """
+        if not workers:
+            for result in super(FileSystemDatabase, self).read_many(keys):
+                yield result
+            return
+
+        keys = iter(keys)
+        pool = ThreadPool(workers)
+        try:
+            pending = deque()
+            while True:
+                batch = list(islice(keys, batch_size))
+                if not batch:
+                    break
+                pending.append(pool.apply_async(self._open_all, (batch,)))
+                if len(pending) > workers:
+                    for result in pending.popleft().get():
+                        yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
 
     def size(self, key):
-        path = os.path.join(self._path, key)
         try:
-            return os.stat(path).st_size
+            return os.stat(self._key_path(key)).st_size
         except OSError:
             raise KeyError(key)
 
     def iter_ids(self):
+        # a document's features all live in the same directory, so only ids
+        # from the current one need to be remembered
         seen = set()
-        for fn in os.listdir(self._path):
+        directory = None
+        for d, fn in self._files(self.levels):
+            if d != directory:
+                directory = d
+                seen.clear()
             _id, _, _ = self.key_builder.decompose(fn)
             if _id in seen:
                 continue
@@ -191,9 +879,37 @@ class FileSystemDatabase(Database):
             seen.add(_id)
 
     def __contains__(self, key):
-        path = os.path.join(self._path, key)
-        return os.path.exists(path)
+        return os.path.exists(self._key_path(key))
 
     def __delitem__(self, key):
-        path = os.path.join(self._path, key)
-        os.remove(path)
+        os.remove(self._key_path(key))
+
+    def migrate(self, levels):
+        """
+        Move every stored value into a layout levels deep, removing the
+        directories of the old layout once they're empty.  Files are moved
+        one at a time, with rename(), so an interrupted migration can be
+        finished by calling migrate() again with the same arguments,
+        although the database mustn't be used by anyone else in the meantime
+        """
+        if levels == self.levels:
+            return
+
+        for directory, fn in self._files(self.levels, strict=True):
+            destination = self._directory(fn, levels)
+            self._ensure_directory(destination)
+            os.rename(
+                    os.path.join(directory, fn),
+                    os.path.join(destination, fn))
+
+        for depth in xrange(self.levels, 0, -1):
+            for directory in list(self._directories_at(depth)):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    # it's still in use by the new layout
+                    pass
+
+        self.levels = levels
+        self._directories.clear()
+
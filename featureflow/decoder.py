@@ -2,6 +2,7 @@ import json
 from util import chunked
 from extractor import Node
 import bz2
+import compression
 from cPickle import loads
 
 
@@ -80,6 +81,35 @@ class BZ2Decoder(Decoder):
             yield decompressor.decompress(chunk)
 
 
+class CompressionDecoder(Decoder):
+    """
+    A decoder that decompresses data written by CompressionEncoder, with the
+    codec recorded in its header, or by BZ2Encoder
+    """
+
+    def __init__(self):
+        super(CompressionDecoder, self).__init__()
+
+    def __call__(self, flo):
+        return self.__iter__(flo)
+
+    def __iter__(self, flo):
+        head = flo.read(compression.HEADER_SIZE)
+        if not head:
+            return
+        codec, is_header = compression.detect(head)
+        decompressor = codec.decompressor()
+        if not is_header:
+            yield decompressor.decompress(head)
+        for chunk in chunked(flo):
+            yield decompressor.decompress(chunk)
+        try:
+            flush = decompressor.flush
+        except AttributeError:
+            return
+        yield flush()
+
+
 class DecoderNode(Node):
     def __init__(self, needs=None, decodifier=None, version=None):
         super(DecoderNode, self).__init__(needs=needs)
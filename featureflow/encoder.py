@@ -1,6 +1,7 @@
 import json
 from extractor import Node, Aggregator
 import bz2
+import compression
 from cPickle import dumps, HIGHEST_PROTOCOL
 
 
@@ -62,3 +63,45 @@ class BZ2Encoder(Node):
         compressed = self._compressor.compress(data)
         if compressed:
             yield compressed
+
+
+class CompressionEncoder(Node):
+    """
+    Compresses data with one of the codecs registered in the compression
+    module, at level, or the codec's default level, if level is None.  The
+    codec is recorded in a header, so that CompressionDecoder can tell which
+    to decompress the value with.  Use using() to build an encoder class with
+    a codec, or level, other than the defaults
+    """
+    content_type = 'application/octet-stream'
+    codec = 'zlib'
+    level = None
+
+    def __init__(self, needs=None):
+        super(CompressionEncoder, self).__init__(needs=needs)
+        self._codec = compression.codec(self.codec)
+        self._compressor = None
+        self._header = None
+
+    @classmethod
+    def using(cls, codec, level=None):
+        # fail early on codecs that aren't available
+        compression.codec(codec)
+        return type(cls.__name__, (cls,), dict(codec=codec, level=level))
+
+    def _finalize(self, pusher):
+        self._cache = ''
+
+    def _first_chunk(self, data):
+        self._compressor = self._codec.compressor(self.level)
+        self._header = self._codec.header
+        return data
+
+    def _last_chunk(self):
+        yield self._compressor.flush()
+
+    def _process(self, data):
+        compressed = self._header + self._compressor.compress(data)
+        self._header = ''
+        if compressed:
+            yield compressed
@@ -1,7 +1,15 @@
 from itertools import izip_longest
 import contextlib
 from collections import deque, defaultdict
+from functools import partial
+from Queue import Queue
+from copy import copy
+from timeit import default_timer
+import threading
 import inspect
+import sys
+from util import nbytes
+from profiler import NodeStats, GraphReport
 
 
 class InvalidProcessMethod(Exception):
@@ -15,11 +23,30 @@ class InvalidProcessMethod(Exception):
         super(InvalidProcessMethod, self).__init__(msg)
 
 
+# a cache of Node._ready_is_reliable(), by class
+_reliable_readiness = dict()
+
+# the Node classes whose _process method has been checked, and found to be a
+# generator
+_valid_process_methods = set()
+
+# a cache of Node._is_stateless(), by class
+_stateless_nodes = dict()
+
+
 class Node(object):
+    # when False, compiled plans never fuse this node with the node it
+    # depends on, so that it receives every chunk through the usual
+    # enqueue/dequeue cycle.  Can be set per instance, e.g., while debugging
+    fusable = True
+
     def __init__(self, needs=None):
         super(Node, self).__init__()
-        if not inspect.isgeneratorfunction(self._process):
-            raise InvalidProcessMethod(self.__class__)
+        cls = self.__class__
+        if cls not in _valid_process_methods:
+            if not inspect.isgeneratorfunction(self._process):
+                raise InvalidProcessMethod(cls)
+            _valid_process_methods.add(cls)
 
         self._cache = None
         self._listeners = []
@@ -82,6 +109,14 @@ class Node(object):
     def _enqueue(self, data, pusher):
         self._cache = data
 
+    def _ready(self):
+        """
+        Return true if a call to _dequeue() would succeed.  Execution engines
+        call this cheap check in preference to catching NotEnoughData, as long
+        as a class that overrides _dequeue() also overrides _ready()
+        """
+        return self._cache is not None
+
     def _dequeue(self):
         if self._cache is None:
             raise NotEnoughData()
@@ -89,6 +124,46 @@ class Node(object):
         v, self._cache = self._cache, None
         return v
 
+    @classmethod
+    def _ready_is_reliable(cls):
+        """
+        Return true if _ready() is defined at least as far down the class
+        hierarchy as _dequeue(), and can be trusted to predict whether
+        _dequeue() will raise NotEnoughData
+        """
+        try:
+            return _reliable_readiness[cls]
+        except KeyError:
+            pass
+
+        def defined_in(name):
+            return next(i for i, c in enumerate(cls.__mro__)
+                        if name in c.__dict__)
+
+        reliable = defined_in('_ready') <= defined_in('_dequeue')
+        _reliable_readiness[cls] = reliable
+        return reliable
+
+    @classmethod
+    def _is_stateless(cls):
+        """
+        Return true if the class relies on Node's default buffering, i.e., it
+        holds on to a single chunk between _enqueue() and _dequeue(), and
+        does nothing special with the first one, so that each chunk can be
+        handed straight to _process()
+        """
+        try:
+            return _stateless_nodes[cls]
+        except KeyError:
+            pass
+
+        names = ('_enqueue', '_dequeue', '_ready', '_first_chunk', 'process')
+        stateless = all(
+                getattr(cls, name).im_func is getattr(Node, name).im_func
+                for name in names)
+        _stateless_nodes[cls] = stateless
+        return stateless
+
     def _process(self, data):
         yield data
 
@@ -160,6 +235,9 @@ class Aggregator(object):
     def __init__(self, needs=None):
         super(Aggregator, self).__init__(needs=needs)
 
+    def _ready(self):
+        return self._finalized and super(Aggregator, self)._ready()
+
     def _dequeue(self):
         if not self._finalized:
             raise NotEnoughData()
@@ -174,9 +252,604 @@ class NotEnoughData(Exception):
     pass
 
 
+class _Vertex(object):
+    """
+    A single node, as seen by a compiled ExecutionPlan.  Edges to listening
+    nodes are resolved to bound methods when the plan is compiled, so pushing
+    a chunk downstream is a direct function call
+    """
+
+    def __init__(self, key, node):
+        super(_Vertex, self).__init__()
+        self.key = key
+        self.node = node
+        self.listeners = []
+        self.sinks = ()
+        self.closers = ()
+        # true when the node that this one depends on hands it chunks through
+        # fused_receive(), rather than receive()
+        self.fused = False
+        self._first = True
+        self._finished = False
+
+        # When _ready() can be trusted, consult it instead of letting
+        # _dequeue() raise.  Nodes that use the default readiness check are
+        # always ready right after receiving data, so it's only worth calling
+        # once their dependencies are finished
+        reliable = node._ready_is_reliable()
+        overridden = node.__class__._ready.im_func is not Node._ready.im_func
+        self._ready_on_data = node._ready if reliable and overridden else None
+        self._ready_on_close = node._ready if reliable else None
+
+    def __repr__(self):
+        return '_Vertex({key}, {node})'.format(key=self.key, node=self.node)
+
+    def connect(self):
+        self.sinks = tuple(
+                l.fused_receive() if l.fused else l.receive
+                for l in self.listeners)
+        self.closers = tuple(l.close for l in self.listeners)
+
+    @property
+    def fusable(self):
+        node = self.node
+        return \
+            node.fusable \
+            and len(node.needs) == 1 \
+            and node._is_stateless()
+
+    def fused_receive(self):
+        """
+        Build a replacement for receive(), for a node with a single
+        dependency and default buffering.  Each chunk goes straight to
+        _process(), and its output straight to the node's listeners, which
+        may themselves be fused, so a linear chain of such nodes runs as one
+        nested loop
+        """
+        node = self.node
+        process = node._process
+        enqueued = node._enqueued_dependencies
+        emit = self.emit
+
+        def receive(data, pusher):
+            if data is None:
+                return
+            try:
+                enqueued.add(id(pusher))
+                for d in process(data):
+                    emit(d)
+            except (TypeError, NotEnoughData):
+                pass
+
+        return receive
+
+    def emit(self, data):
+        node = self.node
+        for sink in self.sinks:
+            sink(data, node)
+
+    def _run(self, ready):
+        if ready is not None and not ready():
+            return
+        node = self.node
+        try:
+            inp = node._dequeue()
+            if self._first:
+                inp = node._first_chunk(inp)
+                self._first = False
+            emit = self.emit
+            for d in node._process(inp):
+                emit(d)
+        except NotEnoughData:
+            pass
+
+    # KLUDGE: The queue-based engine has always discarded TypeErrors raised
+    # while a (non-root) node handles a message, and existing graphs rely on
+    # this, so receive() and close() do the same
+    def receive(self, data, pusher):
+        try:
+            if data is not None:
+                node = self.node
+                node._enqueued_dependencies.add(id(pusher))
+                node._enqueue(data, pusher)
+            self._run(self._ready_on_data)
+        except TypeError:
+            pass
+
+    def close(self, pusher):
+        node = self.node
+        try:
+            node._finish(pusher=pusher)
+            self._run(self._ready_on_close)
+            if node._finalized:
+                self.finish()
+        except TypeError:
+            pass
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        node = self.node
+        emit = self.emit
+        for chunk in node._last_chunk():
+            emit(chunk)
+        node._finalize(None)
+        for close in self.closers:
+            close(node)
+
+    def drive(self, data):
+        """
+        Feed data to a root node, yielding after each chunk it produces has
+        been pushed all the way through the graph
+        """
+        node = self.node
+        if data is not None:
+            node._enqueued_dependencies.add(id(None))
+            node._enqueue(data, None)
+
+        try:
+            inp = node._dequeue()
+            if self._first:
+                inp = node._first_chunk(inp)
+                self._first = False
+            emit = self.emit
+            for d in node._process(inp):
+                emit(d)
+                yield None
+        except NotEnoughData:
+            yield None
+
+        self.finish()
+        yield None
+
+
+class _ProfiledVertex(_Vertex):
+    """
+    A vertex that counts the calls, chunks and bytes flowing through its
+    node, and times the node's own generators
+    """
+
+    def __init__(self, key, node):
+        super(_ProfiledVertex, self).__init__(key, node)
+        self.stats = NodeStats(key, node)
+        # only count a stall when the node was just handed some data
+        self._has_data = False
+
+    def _timed(self, iterator):
+        stats = self.stats
+        while True:
+            start = default_timer()
+            try:
+                d = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                stats.process_time += default_timer() - start
+            yield d
+
+    def emit(self, data):
+        stats = self.stats
+        stats.chunks_out += 1
+        stats.bytes_out += nbytes(data)
+        super(_ProfiledVertex, self).emit(data)
+
+    def _run(self, ready):
+        stats = self.stats
+        if ready is not None and not ready():
+            stats.stalls += self._has_data
+            return
+        node = self.node
+        try:
+            inp = node._dequeue()
+            if self._first:
+                inp = node._first_chunk(inp)
+                self._first = False
+            emit = self.emit
+            for d in self._timed(node._process(inp)):
+                emit(d)
+        except NotEnoughData:
+            stats.stalls += self._has_data
+
+    def receive(self, data, pusher):
+        stats = self.stats
+        stats.calls += 1
+        if data is not None:
+            stats.chunks_in += 1
+            stats.bytes_in += nbytes(data)
+        self._has_data = data is not None
+        super(_ProfiledVertex, self).receive(data, pusher)
+
+    def close(self, pusher):
+        self.stats.calls += 1
+        self._has_data = False
+        super(_ProfiledVertex, self).close(pusher)
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        node = self.node
+        emit = self.emit
+        for chunk in self._timed(node._last_chunk()):
+            emit(chunk)
+        node._finalize(None)
+        for close in self.closers:
+            close(node)
+
+    def drive(self, data):
+        node = self.node
+        stats = self.stats
+        stats.calls += 1
+        if data is not None:
+            node._enqueued_dependencies.add(id(None))
+            node._enqueue(data, None)
+
+        try:
+            inp = node._dequeue()
+            if self._first:
+                inp = node._first_chunk(inp)
+                self._first = False
+            emit = self.emit
+            for d in self._timed(node._process(inp)):
+                emit(d)
+                yield None
+        except NotEnoughData:
+            stats.stalls += 1
+            yield None
+
+        self.finish()
+        yield None
+
+
+class ExecutionPlan(object):
+    """
+    A Graph compiled into a reusable schedule.  The graph is sorted
+    topologically once, and each node's listeners are resolved to bound
+    methods, so that no per-chunk messages need to be built or dispatched by
+    name.
+
+    Nodes that have a single dependency and use Node's default buffering are
+    fused with that dependency: chunks are passed directly from one _process
+    generator to the next, skipping the enqueue/dequeue cycle.  A fused node
+    is still a vertex in its own right, so its other listeners, e.g., the
+    encoder of a stored feature, and its _last_chunk() and _finalize()
+    behavior are unaffected.  Profiled plans are never fused, so that each
+    node's statistics can be gathered separately
+    """
+
+    def __init__(self, graph, profile=False):
+        super(ExecutionPlan, self).__init__()
+        self.profile = profile
+        self.order = graph.topological_sort()
+        vertex_cls = _ProfiledVertex if profile else _Vertex
+        self._vertices = dict(
+                (id(graph[k]), vertex_cls(k, graph[k])) for k in self.order)
+
+        for vertex in self._vertices.itervalues():
+            for n in vertex.node.needs:
+                self._vertices[id(n)].listeners.append(vertex)
+
+        if not profile:
+            for vertex in self._vertices.itervalues():
+                vertex.fused = vertex.fusable
+
+        for vertex in self._vertices.itervalues():
+            vertex.connect()
+
+        self._by_key = dict(
+                (v.key, v) for v in self._vertices.itervalues())
+
+    def __getitem__(self, key):
+        return self._by_key[key]
+
+    def branches(self):
+        """
+        Partition the non-root nodes into groups that share no edges with one
+        another, i.e., the independent subgraphs that hang off of the root
+        nodes.  Each branch is returned as a list of keys, in topological order
+        """
+        parents = dict((k, k) for k in self.order)
+
+        def find(k):
+            while parents[k] != k:
+                parents[k] = parents[parents[k]]
+                k = parents[k]
+            return k
+
+        for vertex in self:
+            if vertex.node.is_root:
+                continue
+            for listener in vertex.listeners:
+                parents[find(listener.key)] = find(vertex.key)
+
+        branches = defaultdict(list)
+        for vertex in self:
+            if not vertex.node.is_root:
+                branches[find(vertex.key)].append(vertex.key)
+        return sorted(branches.values(), key=lambda b: self.order.index(b[0]))
+
+    @property
+    def fused(self):
+        """
+        The keys of nodes that are fused with the node they depend on
+        """
+        return [k for k in self.order if self._by_key[k].fused]
+
+    def __iter__(self):
+        return (self._by_key[k] for k in self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def report(self, wall_time):
+        """
+        Gather the statistics recorded by a profiled plan into a GraphReport
+        """
+        if not self.profile:
+            raise ValueError('this plan was not compiled for profiling')
+        return GraphReport([v.stats for v in self], wall_time)
+
+
+class QueueExecutor(object):
+    """
+    The original execution strategy, which moves every chunk through a queue
+    of string-dispatched messages.  Kept for nodes that override process(),
+    and as a baseline for benchmarks.  Graphs run by this executor can't be
+    profiled
+    """
+
+    # False for executors that don't run the graph's compiled ExecutionPlan,
+    # and so record nothing for a profiler to report
+    can_profile = False
+
+    def execute(self, graph, graph_args):
+        roots = graph.roots()
+        subscriptions = graph.subscriptions()
+        queue = deque()
+
+        # get a generator for each root node.
+        generators = [roots[k].process(v, queue=queue)
+                      for k, v in graph_args.iteritems()]
+        for _ in izip_longest(*generators):
+            while queue:
+                key, fname, kwargs = queue.pop()
+                for subscriber in subscriptions[key]:
+                    func = getattr(subscriber, fname)
+                    try:
+                        [_ for _ in func(**kwargs)]
+                    except TypeError:
+                        continue
+
+
+class SerialExecutor(object):
+    """
+    Execute a graph's compiled ExecutionPlan in the calling thread.  Each
+    chunk is pushed depth-first through every downstream node before the
+    next chunk is produced, so chunks are never buffered between nodes
+    """
+
+    can_profile = True
+
+    def execute(self, graph, graph_args):
+        plan = graph.compile()
+        generators = [plan[k].drive(v) for k, v in graph_args.iteritems()]
+        for _ in izip_longest(*generators):
+            pass
+
+
+class _Edge(object):
+    """
+    Accounting for the chunks that a root node has handed to a worker thread,
+    but which the listening node hasn't yet processed.  Producers are blocked
+    while the edge is over its budget of chunks or bytes.  A single chunk
+    larger than max_bytes is only admitted once the edge is empty
+    """
+
+    def __init__(self, producer, consumer, max_chunks=None, max_bytes=None):
+        super(_Edge, self).__init__()
+        self.key = (producer, consumer)
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.chunks = 0
+        self.bytes = 0
+        self.peak_chunks = 0
+        self.peak_bytes = 0
+        self._condition = threading.Condition()
+
+    def _full(self, size):
+        if not self.chunks:
+            return False
+        if self.max_chunks is not None and self.chunks >= self.max_chunks:
+            return True
+        if self.max_bytes is not None and self.bytes + size > self.max_bytes:
+            return True
+        return False
+
+    def acquire(self, size):
+        with self._condition:
+            while self._full(size):
+                self._condition.wait()
+            self.chunks += 1
+            self.bytes += size
+            self.peak_chunks = max(self.peak_chunks, self.chunks)
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def release(self, size):
+        with self._condition:
+            self.chunks -= 1
+            self.bytes -= size
+            self._condition.notify()
+
+
+class _Worker(threading.Thread):
+    """
+    A thread that delivers messages to the nodes of one or more graph
+    branches, in the order they were sent
+    """
+
+    def __init__(self, name):
+        super(_Worker, self).__init__(name=name)
+        self.daemon = True
+        self.queue = Queue()
+        self.exc_info = None
+
+    def send(self, method, *args):
+        self.queue.put((method, args, None, 0))
+
+    def send_chunk(self, edge, method, data, pusher):
+        size = nbytes(data)
+        edge.acquire(size)
+        self.queue.put((method, (data, pusher), edge, size))
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            method, args, edge, size = message
+            try:
+                if self.exc_info is None:
+                    method(*args)
+            except Exception:
+                self.exc_info = sys.exc_info()
+            finally:
+                # keep releasing chunks after a failure, so that producers
+                # are never blocked
+                if edge is not None:
+                    edge.release(size)
+
+
+class ThreadPoolExecutor(object):
+    """
+    Execute the independent branches of a graph concurrently, on a pool of
+    threads.  Root nodes run in the calling thread, and each branch is pinned
+    to a single worker thread, so chunks arrive at every node in the same
+    order they would when executing serially.  This pays off when the nodes'
+    _process methods spend most of their time in code that releases the GIL,
+    e.g. numpy.
+
+    Chunks sent from a root node to a worker thread are buffered until the
+    worker gets to them.  By default these buffers are unbounded.  In
+    backpressure mode, each edge from a root node to its listener may hold
+    at most max_chunks chunks, or max_bytes bytes, and the root node is
+    paused until the listener catches up.  Budgets for individual edges can
+    be set with budgets, a dictionary mapping (producer key, consumer key)
+    to a (max_chunks, max_bytes) tuple.
+
+    The most chunks and bytes ever held by each edge, over every graph this
+    executor has run, are available in high_water_marks
+    """
+
+    can_profile = True
+
+    def __init__(self, workers=4, max_chunks=None, max_bytes=None, budgets=None):
+        super(ThreadPoolExecutor, self).__init__()
+        if workers < 1:
+            raise ValueError('workers must be greater than zero')
+        self.workers = workers
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.budgets = budgets or dict()
+        self.high_water_marks = dict()
+        self._lock = threading.Lock()
+
+    def _edge(self, producer, consumer):
+        max_chunks, max_bytes = self.budgets.get(
+                (producer, consumer), (self.max_chunks, self.max_bytes))
+        return _Edge(producer, consumer, max_chunks, max_bytes)
+
+    def _route(self, vertex, assignment):
+        sinks = []
+        closers = []
+        edges = []
+        for listener in vertex.listeners:
+            worker = assignment[listener.key]
+            edge = self._edge(vertex.key, listener.key)
+            edges.append(edge)
+            sinks.append(partial(worker.send_chunk, edge, listener.receive))
+            closers.append(partial(worker.send, listener.close))
+        root = copy(vertex)
+        root.sinks = tuple(sinks)
+        root.closers = tuple(closers)
+        return root, edges
+
+    def _record(self, graph, edges):
+        marks = dict((e.key, (e.peak_chunks, e.peak_bytes)) for e in edges)
+        graph.high_water_marks = marks
+        with self._lock:
+            for key, (chunks, peak_bytes) in marks.iteritems():
+                c, b = self.high_water_marks.get(key, (0, 0))
+                self.high_water_marks[key] = (
+                        max(c, chunks), max(b, peak_bytes))
+
+    def execute(self, graph, graph_args):
+        plan = graph.compile()
+        branches = plan.branches()
+        workers = [
+            _Worker('featureflow-worker-{i}'.format(i=i))
+            for i in xrange(min(self.workers, len(branches)))]
+
+        assignment = dict()
+        for i, branch in enumerate(branches):
+            for key in branch:
+                assignment[key] = workers[i % len(workers)]
+
+        roots = []
+        edges = []
+        for k, v in graph_args.iteritems():
+            root, root_edges = self._route(plan[k], assignment)
+            roots.append((root, v))
+            edges.extend(root_edges)
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            generators = [vertex.drive(v) for vertex, v in roots]
+            for _ in izip_longest(*generators):
+                if any(w.exc_info for w in workers):
+                    break
+        finally:
+            for worker in workers:
+                worker.stop()
+            for worker in workers:
+                worker.join()
+
+        self._record(graph, edges)
+
+        for worker in workers:
+            if worker.exc_info is not None:
+                t, value, traceback = worker.exc_info
+                raise t, value, traceback
+
+
 class Graph(dict):
+    executor = SerialExecutor()
+
+    # a Profiler that decides whether this graph's runs are instrumented
+    profiler = None
+
     def __init__(self, **kwargs):
         super(Graph, self).__init__(**kwargs)
+        self._plan = None
+        self._order = None
+        # the most chunks and bytes buffered on each edge, by (producer key,
+        # consumer key), for executors that buffer chunks between nodes
+        self.high_water_marks = dict()
+
+    def __setitem__(self, key, value):
+        self._plan = None
+        self._order = None
+        super(Graph, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._plan = None
+        self._order = None
+        super(Graph, self).__delitem__(key)
 
     def roots(self):
         return dict((k, v) for k, v in self.iteritems() if v.is_root)
@@ -191,6 +864,48 @@ class Graph(dict):
                 subscriptions[id(n)].append(node)
         return subscriptions
 
+    def topological_sort(self):
+        """
+        Return the graph's keys, ordered so that every node appears after all
+        the nodes it depends on
+        """
+        if self._order is not None:
+            return list(self._order)
+
+        keys = dict((id(v), k) for k, v in self.iteritems())
+        in_degree = dict((k, v.dependency_count) for k, v in self.iteritems())
+        subscriptions = self.subscriptions()
+        ready = deque(k for k, v in in_degree.iteritems() if not v)
+        order = []
+        while ready:
+            key = ready.popleft()
+            order.append(key)
+            for subscriber in subscriptions[id(self[key])]:
+                k = keys[id(subscriber)]
+                in_degree[k] -= 1
+                if not in_degree[k]:
+                    ready.append(k)
+
+        if len(order) < len(self):
+            raise ValueError(
+                    'the graph contains a cycle, or nodes whose dependencies '
+                    'are not part of the graph')
+        self._order = order
+        return list(order)
+
+    def compile(self, profile=None):
+        """
+        Build an ExecutionPlan for this graph, or return the one built
+        previously, if the graph hasn't been modified since.  profile decides
+        whether the plan is instrumented.  When it's None, the previous plan's
+        setting is kept, so executors run whichever plan process() asked for
+        """
+        if profile is None:
+            profile = self._plan is not None and self._plan.profile
+        if self._plan is None or self._plan.profile != profile:
+            self._plan = ExecutionPlan(self, profile=profile)
+        return self._plan
+
     def remove_dead_nodes(self, features):
         # starting from the leaves, remove any nodes that are not stored, and 
         # have no stored consuming nodes
@@ -224,19 +939,23 @@ class Graph(dict):
 
         graph_args = dict((k, kwargs[k]) for k in intersection)
 
-        subscriptions = self.subscriptions()
-        queue = deque()
+        profiler = self.profiler
+        if profiler is not None \
+                and not getattr(self.executor, 'can_profile', True):
+            raise ValueError(
+                    '{executor} records no statistics, so graphs it runs '
+                    'can\'t be profiled'.format(
+                            executor=self.executor.__class__.__name__))
+        profile = profiler is not None and profiler.sample()
+        self.compile(profile=profile)
+        start = default_timer()
 
-        # get a generator for each root node.
         with contextlib.nested(*self.values()) as _:
-            generators = [roots[k].process(v, queue=queue)
-                          for k, v in graph_args.iteritems()]
-            for _ in izip_longest(*generators):
-                while queue:
-                    key, fname, kwargs = queue.pop()
-                    for subscriber in subscriptions[key]:
-                        func = getattr(subscriber, fname)
-                        try:
-                            [_ for _ in func(**kwargs)]
-                        except TypeError:
-                            continue
+            self.executor.execute(self, graph_args)
+
+        if not profile:
+            return None
+
+        report = self.compile(profile=True).report(default_timer() - start)
+        profiler.report(report)
+        return report
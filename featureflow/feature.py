@@ -1,8 +1,8 @@
 from extractor import Graph
-from encoder import IdentityEncoder, JSONEncoder, TextEncoder, BZ2Encoder, \
-    PickleEncoder
+from encoder import IdentityEncoder, JSONEncoder, TextEncoder, \
+    CompressionEncoder, PickleEncoder
 from decoder import JSONDecoder, Decoder, GreedyDecoder, DecoderNode, \
-    BZ2Decoder, PickleDecoder
+    CompressionDecoder, PickleDecoder
 from datawriter import DataWriter, StringIODataWriter
 
 
@@ -34,6 +34,7 @@ class Feature(object):
         self.extractor_args = extractor_args
 
         self.persistence = persistence
+        self._version = None
 
         if data_writer:
             self._data_writer = data_writer
@@ -49,13 +50,17 @@ class Feature(object):
 
     @property
     def version(self):
+        if self._version is not None:
+            return self._version
+
         # KLUDGE: Build a shallow version of the extractor.  Building a deep
         # version with re-usable code is more difficult, because
         # self._build_extractor relies on this version property, so there's
         # a circular dependency.
         dependencies = [f.extractor(**f.extractor_args) for f in self.needs]
         e = self.extractor(needs=dependencies, **self.extractor_args)
-        return e.version
+        self._version = e.version
+        return self._version
 
     def copy(
             self,
@@ -82,6 +87,7 @@ class Feature(object):
 
     def add_dependency(self, feature):
         self.needs.append(feature)
+        self._version = None
 
     def database(self, persistence):
         return (self.persistence or persistence).database
@@ -118,7 +124,7 @@ class Feature(object):
 
         return all([n._can_compute() for n in self.needs])
 
-    def __call__(self, _id=None, decoder=None, persistence=None):
+    def __call__(self, _id=None, decoder=None, persistence=None, profiler=None):
         if decoder is None:
             decoder = self.decoder
 
@@ -133,6 +139,7 @@ class Feature(object):
             raise AttributeError('%s cannot be computed' % self.key)
 
         graph, stream = self._build_partial(_id, persistence)
+        graph.profiler = profiler
 
         kwargs = dict()
         for k, extractor in graph.roots().iteritems():
@@ -149,32 +156,57 @@ class Feature(object):
         return decoded
 
     def _build_partial(self, _id, persistence):
-        features = self._partial(_id, persistence=persistence)
+        g, streams = Feature._build_partials([self], _id, persistence)
+        return g, streams[self.key]
+
+    @staticmethod
+    def _build_partials(features, _id, persistence):
+        """
+        Build a single graph that computes every feature in features, sharing
+        the work they have in common.  Return the graph, along with a
+        dictionary mapping each feature's key to the stream its encoded output
+        will be written to, or None, if it's written to the database
+        """
+        requested = set(f.key for f in features)
+        partial = dict()
+        for f in features:
+            f._partial(
+                    _id,
+                    features=partial,
+                    persistence=persistence,
+                    requested=requested)
+
         g = Graph()
-        for feat in features.itervalues():
-            e = feat._build_extractor(_id, g, persistence)
-            if feat.key == self.key:
-                stream = e.find_listener( \
-                        lambda x: isinstance(x, StringIODataWriter))
-                if stream is not None:
-                    stream = stream._stream
+        for feat in partial.itervalues():
+            feat._build_extractor(_id, g, persistence)
 
-        return g, stream
+        streams = dict()
+        for key in requested:
+            writer = g.get('{key}_writer'.format(**locals()))
+            streams[key] = writer._stream \
+                if isinstance(writer, StringIODataWriter) else None
+        return g, streams
 
-    def _partial(self, _id, features=None, persistence=None):
+    def _partial(self, _id, features=None, persistence=None, requested=None):
         """
         TODO: _partial is a shit name for this, kind of.  I'm building a graph
-        such that I can only do work necessary to compute self, and no more
+        such that I can only do work necessary to compute self, and no more.
+        The output of self, and of any feature whose key is in requested, is
+        captured in memory, unless it's written to the database anyway
         """
 
         root = features is None
+        capture = root or (requested is not None and self.key in requested)
+
+        if not root and self.key in features:
+            return features
 
         stored = self._stored(_id, persistence)
         is_cached = self.store and stored
 
         if self.store and not stored:
             data_writer = None
-        elif root:
+        elif capture:
             data_writer = StringIODataWriter
         else:
             data_writer = None
@@ -182,7 +214,7 @@ class Feature(object):
         should_store = self.store and not stored
         nf = self.copy(
                 extractor=DecoderNode if is_cached else self.extractor,
-                store=root or should_store,
+                store=capture or should_store,
                 needs=None,
                 data_writer=data_writer,
                 persistence=self.persistence,
@@ -196,7 +228,11 @@ class Feature(object):
 
         if not is_cached:
             for n in self.needs:
-                n._partial(_id, features=features, persistence=persistence)
+                n._partial(
+                        _id,
+                        features=features,
+                        persistence=persistence,
+                        requested=requested)
                 nf.add_dependency(features[n.key])
 
         return features
@@ -218,6 +254,13 @@ class Feature(object):
             pass
 
         needs = self._depends_on(_id, graph, persistence)
+        return self._build_node(_id, graph, persistence, needs)
+
+    def _build_node(self, _id, graph, persistence, needs):
+        """
+        Add this feature's extractor, which consumes needs, to graph, along
+        with the encoder and data writer that store its output, if necessary
+        """
         e = self.extractor(needs=needs, **self.extractor_args)
         if isinstance(e, DecoderNode):
             reader = self.reader(_id, self.key, persistence)
@@ -244,19 +287,29 @@ class Feature(object):
 
 
 class CompressedFeature(Feature):
+    """
+    A feature whose stored value is compressed with codec, one of the names
+    registered in the compression module, e.g., zlib, bz2 or lzma, at level,
+    or the codec's default level.  Values are decompressed with whichever
+    codec they were compressed with, so the codec may be changed without
+    rewriting the values already stored
+    """
+
     def __init__(
             self,
             extractor,
             needs=None,
             store=False,
             key=None,
+            codec='bz2',
+            level=None,
             **extractor_args):
         super(CompressedFeature, self).__init__(
                 extractor,
                 needs=needs,
                 store=store,
-                encoder=BZ2Encoder,
-                decoder=BZ2Decoder(),
+                encoder=CompressionEncoder.using(codec, level),
+                decoder=CompressionDecoder(),
                 key=key,
                 **extractor_args)
 
@@ -1,15 +1,115 @@
 import lmdb
-from data import Database
+from data import Database, BufferReadStream, ChunkedReads
 from io import BytesIO
+from uuid import uuid4
+from contextlib import contextmanager
+from functools import partial
+from collections import defaultdict
+from itertools import izip
+from operator import itemgetter
+from bisect import bisect_left
+import threading
+import weakref
+import struct
+import heapq
+import zlib
+import sys
 import os
 
+# the sub-database holding the pieces of values too large for a single record
+CHUNKS_DB = '__chunks__'
+
+# the sub-database holding each document id, along with the number of values
+# stored for it, so ids can be listed without visiting every feature
+IDS_DB = '__ids__'
+
+_INTERNAL_DBS = frozenset([CHUNKS_DB, IDS_DB])
+
+# Values larger than this are split into chunks of this size, each stored in
+# a record of its own, and described by a header in the value's usual place
+DEFAULT_CHUNK_SIZE = 2 ** 26
+
+# a header is this prefix, followed by the value's write token, chunk count,
+# total length and chunk size.  A record is only treated as a header if it
+# also has exactly the header's length
+_HEADER_PREFIX = '\x00ffchunks\x00'
+_header = struct.Struct('>16sQQQ')
+_HEADER_SIZE = len(_HEADER_PREFIX) + _header.size
+
+
+def _pack_header(token, chunks, length, chunk_size):
+    return _HEADER_PREFIX + _header.pack(token, chunks, length, chunk_size)
+
+
+def _unpack_header(buf):
+    if len(buf) != _HEADER_SIZE \
+            or buf[:len(_HEADER_PREFIX)] != _HEADER_PREFIX:
+        return None
+    return _header.unpack(buf[len(_HEADER_PREFIX):])
+
+
+def _chunk_key(token, index):
+    return token + struct.pack('>Q', index)
+
+
+def _delete_chunks(txn, chunks_db, header):
+    token, chunks, _, _ = header
+    for i in xrange(chunks):
+        txn.delete(_chunk_key(token, i), db=chunks_db)
+
+
+_count = struct.Struct('>Q')
+
+
+def _index_id(txn, ids_db, _id, delta):
+    """
+    Adjust the number of values stored for _id by delta, adding it to the id
+    index, or removing it, as needed
+    """
+    current = txn.get(_id, db=ids_db)
+    n = delta if current is None else _count.unpack(current)[0] + delta
+    if n > 0:
+        txn.put(_id, _count.pack(n), db=ids_db)
+    else:
+        txn.delete(_id, db=ids_db)
+
 
 class WriteStream(object):
-    def __init__(self, key, env, db_getter=None):
+    """
+    Buffers a value in memory until it's closed, and then writes it as a
+    single record.  Once a value grows beyond chunk_size, each full chunk is
+    written as soon as it's available, keyed by a token unique to this write,
+    so that readers never see a mix of chunks from old and new values.  The
+    header that makes the new chunks visible is written when the stream is
+    closed, along with the removal of any chunks belonging to the old value.
+
+    writing is called with a function to run within a write transaction,
+    which it's passed, and may be run more than once, if the transaction must
+    be retried.  flushing, if given, is called in the same way to write
+    chunks, along with their token, and otherwise, writing is used
+    """
+
+    def __init__(
+            self,
+            key,
+            writing,
+            db_getter=None,
+            chunks_db=None,
+            chunk_size=DEFAULT_CHUNK_SIZE,
+            ids_db=None,
+            flushing=None):
+
         self.key = key
         self.db_getter = db_getter
-        self.env = env
+        self.writing = writing
+        self.flushing = flushing or (lambda func, token: writing(func))
+        self.chunks_db = chunks_db
+        self.ids_db = ids_db
+        self.chunk_size = chunk_size
         self.buf = BytesIO()
+        self.token = None
+        self.chunks = 0
+        self.length = 0
 
     def __enter__(self):
         return self
@@ -17,78 +117,693 @@ class WriteStream(object):
     def __exit__(self, t, value, traceback):
         self.close()
 
+    def _flush(self, final=False):
+        data = self.buf.getvalue()
+        n_chunks = len(data) // self.chunk_size
+        if final and len(data) % self.chunk_size:
+            n_chunks += 1
+        if not n_chunks:
+            return
+
+        if self.token is None:
+            self.token = uuid4().bytes
+
+        chunks = [
+            data[i * self.chunk_size: (i + 1) * self.chunk_size]
+            for i in xrange(n_chunks)]
+        # put may run after more chunks have been flushed
+        first = self.chunks
+
+        def put(writer):
+            for i, chunk in enumerate(chunks):
+                key = _chunk_key(self.token, first + i)
+                writer.txn.put(key, chunk, db=self.chunks_db)
+
+        self.flushing(put, self.token)
+        self.chunks += n_chunks
+        self.length += sum(len(chunk) for chunk in chunks)
+        self.buf = BytesIO()
+        self.buf.write(data[n_chunks * self.chunk_size:])
+
     def close(self):
-        _id, db = self.db_getter(self.key)
-        self.buf.seek(0)
-        with self.env.begin(write=True) as txn:
-            txn.put(_id, self.buf.read(), db=db)
+        if self.token is None:
+            value = self.buf.getvalue()
+        else:
+            self._flush(final=True)
+            value = _pack_header(
+                    self.token, self.chunks, self.length, self.chunk_size)
+
+        def put(writer):
+            txn = writer.txn
+            _id, versioned_key, db = self.db_getter(self.key, writer)
+            old = txn.get(versioned_key, db=db)
+            if old is None:
+                _index_id(txn, self.ids_db, _id, 1)
+            else:
+                old = _unpack_header(old)
+            txn.put(versioned_key, value, db=db)
+            if old is not None:
+                _delete_chunks(txn, self.chunks_db, old)
+
+        self.writing(put)
 
     def write(self, data):
         self.buf.write(data)
+        if self.chunk_size and self.buf.tell() > self.chunk_size:
+            self._flush()
 
 
-class ReadStream(object):
-    def __init__(self, buf):
-        self.buf = buf
-        self.pos = 0
+class ReadStream(BufferReadStream):
+    """
+    A file-like view of a single value.  buf points directly into the
+    database's memory map, and txn, the read transaction it was fetched in,
+    is held open while the stream needs it, since the memory may be reused by
+    subsequent writes as soon as the transaction ends.
 
-    def __enter__(self):
-        return self
+    read() returns copies, just as a file would, while read_buffer() returns
+    buffers that share memory with the database, and that are only valid for
+    as long as the stream is open.  Once it's handed one out, the stream
+    holds txn until it's closed.  Otherwise, the database may detach it from
+    txn, once txn is out of date, so that streams kept around, e.g., as
+    decoded features, don't hold on to read transactions, of which there
+    are only max_readers, or stop the map from growing.  If release is given,
+    it's called when the stream lets go of txn, instead of aborting txn,
+    which may be shared with other streams
+    """
 
-    def __exit__(self, t, value, traceback):
-        pass
-
-    def tell(self):
-        return self.pos
-
-    def seek(self, pos, whence=os.SEEK_SET):
-        if whence == os.SEEK_SET:
-            self.pos = pos
-        elif whence == os.SEEK_END:
-            self.pos = max(0, len(self.buf) + pos)
-        elif whence == os.SEEK_CUR:
-            self.pos += pos
+    def __init__(self, buf, txn=None, length=None, release=None):
+        super(ReadStream, self).__init__(buf, length=length)
+        self.txn = txn
+        self.release = release
+        self.pinned = False
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        # decoders often hand back streams, or objects built from them, that
+        # are never explicitly closed
+        if not self.closed:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            super(ReadStream, self).close()
+            txn, self.txn = self.txn, None
+        if txn is None:
+            return
+        if self.release is None:
+            txn.abort()
         else:
-            raise IOError
+            self.release()
+
+    def _copy(self):
+        self.buf = self.buf[:]
+
+    def _detach(self):
+        """
+        Copy what the stream needs from txn, and let go of it, unless
+        buffers over its memory have been handed out, or it's being read
+        right now.  The caller is responsible for releasing txn, if this
+        returns True
+        """
+        if not self._lock.acquire(False):
+            return False
+        try:
+            if self.pinned or self.txn is None:
+                return False
+            self._copy()
+            # py-lmdb only gives up a read transaction's slot once the
+            # transaction itself is collected, and release refers to it
+            self.txn = None
+            self.release = None
+            return True
+        finally:
+            self._lock.release()
+
+    def _read_buffer(self, nbytes):
+        return super(ReadStream, self).read_buffer(nbytes)
+
+    def read_buffer(self, nbytes=None):
+        with self._lock:
+            self.pinned = self.txn is not None
+            return self._read_buffer(nbytes)
 
     def read(self, nbytes=None):
-        if nbytes is None:
-            nbytes = len(self.buf)
-        v = buffer(self.buf, self.pos, nbytes)
-        self.pos += len(v)
-        # KLUDGE: This negates most of the benefit of returning pointers
-        # directly to the memory-mapped data, because it creates a copy.
-        # Is there any way to treat this as a string/bytes without copying
-        # the data?
-        return v[:]
+        with self._lock:
+            return self._read_buffer(nbytes)[:]
+
+
+class ChunkedReadStream(ChunkedReads, ReadStream):
+    """
+    A ReadStream over a value stored as a series of chunks, each read from
+    chunks_db within txn.  Once detached from txn, the remaining chunks are
+    read in transactions begun by reading(), which are guaranteed to see the
+    same chunks, or none at all, if the value has since been overwritten or
+    deleted, since chunks never change once they're written under a token
+    """
+
+    def __init__(
+            self,
+            txn,
+            chunks_db,
+            token,
+            chunks,
+            length,
+            chunk_size,
+            release=None,
+            reading=None):
+
+        super(ChunkedReadStream, self).__init__(
+                None, txn, length=length, release=release)
+        self.chunks_db = chunks_db
+        self.token = token
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.reading = reading
+        self._index = None
+
+    def _copy(self):
+        if self.buf is not None:
+            self.buf = self.buf[:]
+
+    def _detach(self):
+        if self.reading is None:
+            return False
+        return super(ChunkedReadStream, self)._detach()
+
+    def _fetch_chunk(self, index):
+        key = _chunk_key(self.token, index)
+        if self.txn is not None:
+            return self.txn.get(key, db=self.chunks_db)
+        with self.reading() as txn:
+            buf = txn.get(key, db=self.chunks_db)
+            return None if buf is None else buf[:]
+
+    def _read_buffer(self, nbytes):
+        return ChunkedReads.read_buffer(self, nbytes)
+
+    # ChunkedReads comes first, for _chunk(), but reads go through
+    # ReadStream, which keeps track of buffers it hands out
+    read_buffer = ReadStream.__dict__['read_buffer']
+
+
+class _Reader(object):
+    """
+    A read transaction shared by one thread's lookups, and by the streams
+    opened from it, until a newer transaction is committed, or another
+    sub-database is opened.  users counts the lookups and streams still using
+    it, and it's aborted once it's been retired, and the last of them is done
+    """
+
+    def __init__(self, txn, env, n_dbs, release):
+        super(_Reader, self).__init__()
+        self.txn = txn
+        self.env = env
+        # sub-databases opened after a transaction begins can't be used in it
+        self.n_dbs = n_dbs
+        self.release = release
+        self.users = 0
+        self.retired = False
+        # the streams opened from it, which may be detached once it's retired
+        self.streams = weakref.WeakSet()
+
+    def __enter__(self):
+        return self.txn
+
+    def __exit__(self, t, value, traceback):
+        self.release(self)
+
+
+class _Writer(object):
+    """
+    A write transaction, along with the sub-databases opened within it, which
+    other transactions can't use until it's committed.  parent is the
+    _Writer of the enclosing transaction, if it's nested
+    """
+
+    def __init__(self, txn, parent=None):
+        super(_Writer, self).__init__()
+        self.txn = txn
+        self.parent = parent
+        self.dbs = dict()
+
+    def commit(self, published):
+        self.txn.commit()
+        published.update(self.dbs)
+
+    def abort(self):
+        self.txn.abort()
+
+
+class _Document(object):
+    """
+    The writes made within a document, which are made once it's complete,
+    and the tokens of chunks already written for it, which are deleted if it
+    fails
+    """
+
+    def __init__(self):
+        super(_Document, self).__init__()
+        self.writes = []
+        self.tokens = set()
 
 
 class LmdbDatabase(Database):
-    def __init__(self, path, map_size=1000000000, key_builder=None):
+    """
+    Each processed document's features are written in a single write
+    transaction, so they're committed atomically, and rolling back a failed
+    document means discarding its writes.  A document's writes are held in
+    memory until it's complete, and only then is the transaction begun, so
+    LMDB's write lock, which every other writing thread and process waits
+    on, isn't held while the document is processed.  The chunks of large
+    values aren't held, but written as they fill, in short transactions of
+    their own, and deleted if the document fails.  Those of a document cut
+    short by a crash are left behind, unreferenced.
+
+    In group commit mode, documents are committed in batches of
+    group_commit, rather than one at a time, which saves a commit per
+    document, though benchmarks/group_commit.py, which processes many small
+    documents, measures it within a few percent of committing each one.
+    Each document is still written in a transaction of its own, nested
+    within the batch's, and a failure only discards the document that
+    caused it.  A batch's writes are kept until it's committed, so that, if
+    committing it fills the map, the map can be grown, and the batch written
+    again.  If the map can't be grown, the whole batch is discarded, and
+    commit() raises.  A batch holds LMDB's write lock until it's committed,
+    and its documents aren't visible to readers until then.  process_many()
+    commits the last batch when it's done, but after calling process()
+    directly, call commit() on the database, or the model.  Since the batch
+    holds the write lock, the chunks of large values are held in memory along
+    with the rest of their document's writes in this mode.  Nested
+    transactions can't be used with a writable memory map, so the environment
+    is opened without one in this mode
+
+    When the memory map fills up, it's grown by a factor of map_growth, up
+    to max_map_size, if given, and the writes that filled it are retried,
+    including those of the document being committed, after the rest of its
+    batch, in group commit mode, is committed.  The map can only be remapped
+    while no transactions are in progress in this process, so growth is
+    deferred while any read streams that have handed out buffers are open,
+    or ids are being iterated.  map_growth=None disables growth.
+
+    readonly opens an existing database for reading only, e.g., in serving
+    processes, and lock=False disables LMDB's locking altogether, which is
+    only safe when nothing writes to the database, e.g., for a read-only
+    replica.  Databases written before ids were indexed are indexed when
+    they're next opened for writing; until then, read-only ones list their
+    ids by visiting every value.  max_readers is the number of read
+    transactions, across all processes, that may be in progress at once, and
+    max_dbs is the number of features that may be stored, plus two
+    """
+
+    transactional = True
+
+    def __init__(
+            self,
+            path,
+            map_size=1000000000,
+            key_builder=None,
+            chunk_size=DEFAULT_CHUNK_SIZE,
+            group_commit=None,
+            readonly=False,
+            lock=True,
+            max_readers=126,
+            max_dbs=128,
+            map_growth=2,
+            max_map_size=None):
+
         super(LmdbDatabase, self).__init__(key_builder=key_builder)
         self.path = path
+        self.map_size = map_size
+        self.chunk_size = chunk_size
+        self.group_commit = group_commit
+        self.readonly = readonly
+        self.lock = lock
+        self.max_readers = max_readers
+        self.max_dbs = max_dbs
+        self.map_growth = map_growth
+        self.max_map_size = max_map_size
+        self._inherited_envs = []
+        # write transactions belong to the thread that began them, and only
+        # one may be in progress at a time, so each thread keeps track of its
+        # own.  Streams written from other threads, e.g., by a thread pool
+        # executor, share their transaction, one at a time
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._init_readers()
+        self._open()
+
+    def _init_readers(self):
+        # every read transaction in progress, all of which must be finished
+        # whenever the map is resized
+        self._readers = set()
+        self._readers_lock = threading.Lock()
+
+    def _open(self):
         self.env = lmdb.open(
                 self.path,
-                max_dbs=10,
-                map_size=map_size,
-                writemap=True,
+                max_dbs=self.max_dbs,
+                max_readers=self.max_readers,
+                map_size=self.map_size,
+                readonly=self.readonly,
+                lock=self.lock,
+                writemap=not (self.group_commit or self.readonly),
                 map_async=True,
-                metasync=True)
+                metasync=True,
+                # read transactions are pooled by _reader(), so py-lmdb's
+                # cache of spare ones would only tie up more reader slots
+                max_spare_txns=0)
+        self.chunks_db = self._open_internal_db(CHUNKS_DB)
+        self.ids_db = self._open_internal_db(IDS_DB)
         self.dbs = dict()
-        with self.env.begin() as txn:
+        self._open_dbs()
+        if not self.readonly:
+            self._build_id_index()
+
+    def _open_internal_db(self, name):
+        try:
+            return self.env.open_db(name, create=not self.readonly)
+        except lmdb.NotFoundError:
+            # a read-only database that's never had values of this kind
+            return None
+
+    def _open_dbs(self):
+        with self._reader() as txn:
             cursor = txn.cursor()
-            for feature in cursor.iternext(keys=True, values=False):
+            features = [
+                str(f) for f in cursor.iternext(keys=True, values=False)]
+        for feature in features:
+            if feature not in _INTERNAL_DBS and feature not in self.dbs:
                 self.dbs[feature] = self.env.open_db(feature)
 
-    def _get_db(self, key):
+    def _build_id_index(self):
+        """
+        Index the ids of documents written before the id index existed
+        """
+        with self._reader() as txn:
+            if txn.stat(self.ids_db)['entries'] \
+                    or not any(txn.stat(db)['entries']
+                               for db in self.dbs.itervalues()):
+                return
+
+        def index(writer):
+            for db in self.dbs.itervalues():
+                cursor = writer.txn.cursor(db)
+                for key in cursor.iternext(keys=True, values=False):
+                    _id, _ = self.key_builder.decompose(str(key))
+                    _index_id(writer.txn, self.ids_db, _id, 1)
+
+        self._write(index)
+
+    def reopen(self):
+        # An environment must never be used, or even closed, in a process
+        # forked from the one that opened it, so hold a reference to the old
+        # one, to keep it from being garbage collected, and open a new one
+        self._inherited_envs.append(self.env)
+        self._local = threading.local()
+        self._init_readers()
+        self._open()
+
+    @property
+    def process_safe(self):
+        # LMDB serializes writers from different processes with its own lock
+        # file, but a batch of documents holds it until the batch is committed
+        return not self.group_commit
+
+    def _resize(self, map_size):
+        """
+        Remap the environment with map_size, or the size most recently set by
+        another process, if it's zero.  Return False if the map can't be
+        resized at the moment
+        """
+        with self._readers_lock:
+            return self._resize_locked(map_size)
+
+    def _resize_locked(self, map_size):
+        for reader in list(self._readers):
+            self._retire(reader)
+        if self._readers:
+            return False
+        try:
+            self.env.set_mapsize(map_size)
+        except lmdb.Error:
+            # a write transaction is in progress in another thread
+            return False
+        self.map_size = self.env.info()['map_size']
+        return True
+
+    def _grow(self):
+        if not self.map_growth or self._group() is not None:
+            return False
+        current = self.env.info()['map_size']
+        map_size = int(current * self.map_growth)
+        if self.max_map_size:
+            map_size = min(map_size, self.max_map_size)
+        return map_size > current and self._resize(map_size)
+
+    def _begin(self, **kwargs):
+        try:
+            return self.env.begin(**kwargs)
+        except lmdb.MapResizedError:
+            # another process has grown the map beyond this one's
+            if not self._resize(0):
+                raise
+            return self.env.begin(**kwargs)
+
+    def _reader(self):
+        """
+        Start using this thread's read transaction, replacing it first if
+        anything has been committed since it began, so that lookups always
+        see the latest writes.  The caller must release() it when done
+        """
+        with self._readers_lock:
+            reader = getattr(self._local, 'reader', None)
+            if reader is None \
+                    or reader.retired \
+                    or reader.env is not self.env \
+                    or reader.n_dbs != len(self.dbs) \
+                    or reader.txn.id() != self.env.info()['last_txnid']:
+                if reader is not None and reader.env is self.env:
+                    self._retire(reader)
+                reader = self._begin_reader()
+                self._local.reader = reader
+            reader.users += 1
+            return reader
+
+    def _begin_reader(self):
+        try:
+            txn = self.env.begin(buffers=True)
+        except lmdb.MapResizedError:
+            # another process has grown the map beyond this one's
+            if not self._resize_locked(0):
+                raise
+            txn = self.env.begin(buffers=True)
+        reader = _Reader(txn, self.env, len(self.dbs), self._release_reader)
+        self._readers.add(reader)
+        return reader
+
+    def _retire(self, reader):
+        reader.retired = True
+        for stream in list(reader.streams):
+            if stream._detach():
+                reader.users -= 1
+        if not reader.users:
+            reader.txn.abort()
+            self._readers.discard(reader)
+
+    def _release_reader(self, reader):
+        with self._readers_lock:
+            reader.users -= 1
+            if reader.retired and not reader.users:
+                reader.txn.abort()
+                self._readers.discard(reader)
+
+    def _document(self):
+        return getattr(self._local, 'document', None)
+
+    def _group(self):
+        return getattr(self._local, 'group', None)
+
+    def _write(self, func, document=None):
+        """
+        Call func with a _Writer.  If document, the _Document currently being
+        written, is given, func is added to its writes, to be called once it's
+        complete.  Otherwise, it's called with a
+        new transaction, committed once func returns, and retried if the map
+        fills up and can be grown
+        """
+        if document is not None:
+            with self._lock:
+                document.writes.append(func)
+            return
+
+        while True:
+            group = self._group()
+            txn = self._begin(
+                    write=True,
+                    buffers=True,
+                    parent=None if group is None else group.txn)
+            writer = _Writer(txn, group)
+            try:
+                result = func(writer)
+                writer.commit(self.dbs if group is None else group.dbs)
+                if group is not None:
+                    # replayed along with the batch, should it fill the map
+                    self._local.writes.append(func)
+                return result
+            except lmdb.MapFullError:
+                writer.abort()
+                if not self._grow():
+                    raise
+            except:
+                writer.abort()
+                raise
+
+    @contextmanager
+    def transaction(self):
+        if self.readonly or self._document() is not None:
+            yield
+            return
+
+        document = self._local.document = _Document()
+        try:
+            try:
+                yield
+            finally:
+                self._local.document = None
+            if document.writes:
+                self._commit_document(document)
+        except:
+            exc = sys.exc_info()
+            if document.tokens:
+                self._delete_tokens(document.tokens)
+            raise exc[0], exc[1], exc[2]
+
+    def _write_chunks(self, func, token, document=None):
+        """
+        Write a value's chunks, which aren't visible until its header is, so
+        needn't wait for the document they belong to, unless documents are
+        batched, and the batch's transaction holds the write lock
+        """
+        if document is None or self.group_commit:
+            return self._write(func, document)
+        with self._lock:
+            document.tokens.add(token)
+        return self._write(func)
+
+    def _delete_tokens(self, tokens):
+        """
+        Delete every chunk written under any of tokens
+        """
+        def delete(writer):
+            cursor = writer.txn.cursor(self.chunks_db)
+            for token in tokens:
+                if not cursor.set_range(token):
+                    continue
+                while cursor.key()[:len(token)] == token and cursor.delete():
+                    pass
+
+        self._write(delete)
+
+    def _commit_document(self, document):
+        """
+        Make document's writes in a single transaction, nested within the
+        current batch's, in group commit mode, and retry them if the map
+        fills up and can be grown
+        """
+        while True:
+            group = self._group()
+            if group is None:
+                # sub-databases created elsewhere can't be opened once this
+                # thread holds the write lock, and can't be created by anyone
+                # else until it lets go
+                self._open_dbs()
+                if self.group_commit:
+                    group = _Writer(self._begin(write=True, buffers=True))
+                    self._local.group = group
+                    self._local.documents = 0
+                    self._local.writes = []
+
+            writer = _Writer(
+                    self._begin(
+                            write=True,
+                            buffers=True,
+                            parent=None if group is None else group.txn),
+                    group)
+            try:
+                for func in document.writes:
+                    func(writer)
+                writer.commit(self.dbs if group is None else group.dbs)
+                break
+            except lmdb.MapFullError:
+                writer.abort()
+                # commit the rest of the batch, so that the map may be grown,
+                # unless committing it has grown the map already
+                if not self._commit_group() and not self._grow():
+                    raise
+            except:
+                writer.abort()
+                raise
+
+        if group is not None:
+            # kept until the batch is committed, in case it must be replayed
+            self._local.writes.extend(document.writes)
+            self._local.documents += 1
+            if self._local.documents >= self.group_commit:
+                self.commit()
+
+    def commit(self):
+        self._commit_group()
+
+    def _commit_group(self):
+        """
+        Commit the current batch, if there is one.  If the map fills up, grow
+        it, and make the batch's writes again, in a new transaction.  Return
+        True if the map was grown
+        """
+        group = self._group()
+        if group is None:
+            return False
+        writes = self._local.writes
+        self._local.group = None
+        self._local.writes = None
+
+        grown = False
+        while True:
+            try:
+                if group is None:
+                    self._open_dbs()
+                    group = _Writer(self._begin(write=True, buffers=True))
+                    for func in writes:
+                        func(group)
+                group.commit(self.dbs)
+                return grown
+            except lmdb.MapFullError:
+                if group is not None:
+                    group.abort()
+                group = None
+                if not self._grow():
+                    raise
+                grown = True
+            except:
+                if group is not None:
+                    group.abort()
+                raise
+
+    def _get_db(self, key, writer):
         _id, feature, version = self.key_builder.decompose(key)
         versioned_key = self.key_builder.build(_id, version)
+        w = writer
+        while w is not None:
+            try:
+                return _id, versioned_key, w.dbs[feature]
+            except KeyError:
+                w = w.parent
         try:
-            return versioned_key, self.dbs[feature]
+            return _id, versioned_key, self.dbs[feature]
         except KeyError:
-            db = self.env.open_db(feature)
-            self.dbs[feature] = db
-            return versioned_key, db
+            db = self.env.open_db(feature, txn=writer.txn)
+            writer.dbs[feature] = db
+            return _id, versioned_key, db
 
     def _get_read_db(self, key):
         _id, feature, version = self.key_builder.decompose(key)
@@ -96,64 +811,306 @@ class LmdbDatabase(Database):
         try:
             return versioned_key, self.dbs[feature]
         except KeyError:
+            pass
+
+        if self._group() is not None:
+            # opening a sub-database would require a second write
+            # transaction in this thread, and all those created elsewhere
+            # were opened before the first one began
+            raise KeyError(key)
+
+        # the sub-database may have been created by another process since
+        # this environment was opened
+        try:
+            db = self.env.open_db(feature, create=False)
+        except lmdb.NotFoundError:
             raise KeyError(key)
+        self.dbs[feature] = db
+        return versioned_key, db
 
     def write_stream(self, key, content_type):
-        return WriteStream(key, self.env, self._get_db)
+        if self.readonly:
+            raise lmdb.ReadonlyError(
+                    'cannot write {key} to a read-only database'.format(
+                            **locals()))
+        # streams are often written to from other threads, so they hold on to
+        # this thread's document, if there is one
+        document = self._document()
+        return WriteStream(
+                key,
+                lambda func: self._write(func, document),
+                self._get_db,
+                chunks_db=self.chunks_db,
+                chunk_size=self.chunk_size,
+                ids_db=self.ids_db,
+                flushing=lambda func, token:
+                    self._write_chunks(func, token, document))
+
+    def _stream(self, reader, buf):
+        """
+        Open a stream over buf, which takes over one of reader's uses
+        """
+        release = partial(self._release_reader, reader)
+        header = _unpack_header(buf)
+        if header is None:
+            stream = ReadStream(buf, reader.txn, release=release)
+        else:
+            stream = ChunkedReadStream(
+                    reader.txn,
+                    self.chunks_db,
+                    *header,
+                    release=release,
+                    reading=self._reader)
+        with self._readers_lock:
+            reader.streams.add(stream)
+        return stream
 
     def read_stream(self, key):
         _id, db = self._get_read_db(key)
-        with self.env.begin(buffers=True) as txn:
-            buf = txn.get(_id, db=db)
+        reader = self._reader()
+        buf = reader.txn.get(_id, db=db)
 
         if buf is None:
+            self._release_reader(reader)
             raise KeyError(key)
 
-        # POSSIBLE BUG:  Is it safe to keep the buffer around after the
-        # transaction is complete?
-        return ReadStream(buf)
+        return self._stream(reader, buf)
+
+    def read_many(self, keys):
+        """
+        Read every value in a single read transaction, visiting each
+        sub-database's keys in sorted order, with a single cursor.  The
+        streams all share the transaction, which is held until they, and
+        this generator, are done with it
+        """
+        keys = list(keys)
+        by_db = defaultdict(list)
+        for i, key in enumerate(keys):
+            try:
+                versioned_key, db = self._get_read_db(key)
+            except KeyError:
+                continue
+            by_db[id(db)].append((db, versioned_key, i))
+
+        bufs = [None] * len(keys)
+        reader = self._reader()
+        try:
+            for items in by_db.itervalues():
+                cursor = reader.txn.cursor(items[0][0])
+                for _, versioned_key, i in sorted(items, key=itemgetter(1)):
+                    if cursor.set_key(versioned_key):
+                        bufs[i] = cursor.value()
+
+            for key, buf in izip(keys, bufs):
+                if buf is None:
+                    yield key, None
+                    continue
+                with self._readers_lock:
+                    reader.users += 1
+                yield key, self._stream(reader, buf)
+        finally:
+            self._release_reader(reader)
 
     def size(self, key):
         _id, db = self._get_read_db(key)
-        with self.env.begin(buffers=True) as txn:
+        with self._reader() as txn:
+            # buf points into the memory map, so this doesn't copy, or even
+            # read, the value itself
             buf = txn.get(_id, db=db)
+            if buf is None:
+                raise KeyError(key)
+            header = _unpack_header(buf)
+            return len(buf) if header is None else header[2]
 
-        if buf is None:
-            raise KeyError(key)
-
-        # POSSIBLE BUG:  Is it safe to keep the buffer around after the
-        # transaction is complete?
-        return len(buf)
-
-    def iter_ids(self):
-        try:
-            db = self.dbs.values()[0]
-        except IndexError:
+    def iter_ids(self, start=None):
+        """
+        Yield the id of every document with at least one stored value, in
+        sorted order, beginning with start, or the first id after it, if
+        start is provided.  Ids are read from a single snapshot of the
+        database
+        """
+        if self.ids_db is None:
+            with self._reader() as txn:
+                ids = self._scan_ids(txn)
+            for _id in ids[0 if start is None else bisect_left(ids, start):]:
+                yield _id
             return
 
-        seen = set()
-        with self.env.begin() as txn:
-            cursor = txn.cursor(db)
+        with self._reader() as txn:
+            cursor = txn.cursor(self.ids_db)
+            if start is None:
+                positioned = cursor.first()
+            else:
+                positioned = cursor.set_range(start)
+            if not positioned:
+                return
             for _id in cursor.iternext(keys=True, values=False):
-                _id, version = self.key_builder.decompose(_id)
-                if _id in seen:
-                    continue
-                yield _id
-                seen.add(_id)
+                yield str(_id)
+
+    def _scan_ids(self, txn):
+        """
+        The sorted ids of every document with a stored value, found by
+        visiting each sub-database's keys.  A database written before the id
+        index existed, and opened read-only, has no index, and it can't be
+        built until the database is next opened for writing
+        """
+        self._open_dbs()
+        ids = set()
+        for db in self.dbs.itervalues():
+            cursor = txn.cursor(db)
+            for key in cursor.iternext(keys=True, values=False):
+                _id, _ = self.key_builder.decompose(str(key))
+                ids.add(_id)
+        return sorted(ids)
+
+    def count(self):
+        with self._reader() as txn:
+            if self.ids_db is None:
+                return len(self._scan_ids(txn))
+            return txn.stat(self.ids_db)['entries']
 
     def __contains__(self, key):
         try:
             _id, db = self._get_read_db(key)
         except KeyError:
             return False
-        with self.env.begin(buffers=True) as txn:
-            buf = txn.get(_id, db=db)
-        return buf is not None
+        with self._reader() as txn:
+            return txn.get(_id, db=db) is not None
 
     def __delitem__(self, key):
         try:
-            _id, db = self._get_read_db(key)
+            versioned_key, db = self._get_read_db(key)
         except KeyError:
             return
-        with self.env.begin(write=True) as txn:
-            txn.delete(_id, db=db)
+        _id, _, _ = self.key_builder.decompose(key)
+
+        def delete(writer):
+            txn = writer.txn
+            old = txn.get(versioned_key, db=db)
+            if old is None:
+                return
+            header = _unpack_header(old)
+            txn.delete(versioned_key, db=db)
+            _index_id(txn, self.ids_db, _id, -1)
+            if header is not None:
+                _delete_chunks(txn, self.chunks_db, header)
+
+        self._write(delete, self._document())
+
+
+class ShardedLmdbDatabase(Database):
+    """
+    Spreads documents across shards LmdbDatabase environments, each in a
+    directory of its own beneath path, choosing a document's shard by
+    hashing its id.  Each environment has its own write lock, so processes
+    writing documents that belong to different shards don't wait on one
+    another.
+
+    The number of shards can't change once documents have been written, and
+    other keyword arguments are passed along to each shard's LmdbDatabase
+    """
+
+    transactional = True
+
+    def __init__(self, path, shards=8, key_builder=None, **kwargs):
+        super(ShardedLmdbDatabase, self).__init__(key_builder=key_builder)
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        existing = [d for d in os.listdir(path) if d.startswith('shard')]
+        if existing and len(existing) != shards:
+            raise ValueError(
+                '{path} has {n} shards, not {shards}'.format(
+                    n=len(existing), **locals()))
+        self.shards = [
+            LmdbDatabase(
+                os.path.join(path, 'shard{i:03d}'.format(**locals())),
+                key_builder=key_builder,
+                **kwargs)
+            for i in xrange(shards)]
+        self._local = threading.local()
+
+    @property
+    def process_safe(self):
+        return all(shard.process_safe for shard in self.shards)
+
+    def reopen(self):
+        for shard in self.shards:
+            shard.reopen()
+
+    def _shard(self, key):
+        _id, _, _ = self.key_builder.decompose(key)
+        shard = self.shards[
+            (zlib.crc32(_id) & 0xffffffff) % len(self.shards)]
+        # only the shards a document writes to take part in its transaction
+        entered = getattr(self._local, 'entered', None)
+        if entered is not None and shard not in entered:
+            transaction = shard.transaction()
+            transaction.__enter__()
+            entered[shard] = transaction
+        return shard
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, 'entered', None) is not None:
+            yield
+            return
+
+        entered = self._local.entered = dict()
+        exc = (None, None, None)
+        try:
+            yield
+        except:
+            exc = sys.exc_info()
+        finally:
+            self._local.entered = None
+            for transaction in entered.itervalues():
+                try:
+                    if transaction.__exit__(*exc):
+                        exc = (None, None, None)
+                except:
+                    exc = sys.exc_info()
+            if exc != (None, None, None):
+                raise exc[0], exc[1], exc[2]
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+    def write_stream(self, key, content_type):
+        return self._shard(key).write_stream(key, content_type)
+
+    def read_stream(self, key):
+        return self._shard(key).read_stream(key)
+
+    def read_many(self, keys):
+        keys = list(keys)
+        by_shard = defaultdict(list)
+        for i, key in enumerate(keys):
+            by_shard[self._shard(key)].append(i)
+        streams = [None] * len(keys)
+        for shard, indices in by_shard.iteritems():
+            results = shard.read_many(keys[i] for i in indices)
+            for i, (_, stream) in izip(indices, results):
+                streams[i] = stream
+        return izip(keys, streams)
+
+    def size(self, key):
+        return self._shard(key).size(key)
+
+    def iter_ids(self, start=None):
+        """
+        Yield the id of every document, in sorted order, beginning with
+        start, or the first id after it, if start is provided
+        """
+        return heapq.merge(
+                *[shard.iter_ids(start=start) for shard in self.shards])
+
+    def count(self):
+        return sum(shard.count() for shard in self.shards)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
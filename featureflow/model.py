@@ -1,12 +1,18 @@
 from extractor import Graph
 from feature import Feature
 from persistence import PersistenceSettings
+from itertools import izip, repeat
+import contextlib
+import multiprocessing
+import traceback
 
 
 class MetaModel(type):
     def __init__(cls, name, bases, attrs):
         cls.features = {}
         cls._add_features(cls.features)
+        # built the first time a document is processed
+        cls._template = None
         super(MetaModel, cls).__init__(name, bases, attrs)
 
     def iter_features(self):
@@ -46,9 +52,124 @@ class NoPersistenceSettingsError(Exception):
     pass
 
 
+class GraphTemplate(object):
+    """
+    The parts of a model's extractor graph that are the same for every
+    document: which features are computed, the order they're built in, and
+    their versions.  Features that aren't stored, and that no stored feature
+    depends on, are left out, rather than being built and then removed from
+    every graph.  instantiate() builds a fresh graph for a single document
+    """
+
+    def __init__(self, features):
+        super(GraphTemplate, self).__init__()
+        steps = []
+        visited = set()
+
+        def visit(feature):
+            if feature.key in visited:
+                return
+            visited.add(feature.key)
+            for n in feature.needs:
+                visit(n)
+            steps.append(feature)
+
+        for feature in features.itervalues():
+            visit(feature)
+
+        # walking backward from the leaves, a feature is live if it's stored,
+        # or if any live feature depends on it.  Features that belong to
+        # another model are always kept
+        live = set()
+        for feature in reversed(steps):
+            if feature.key in live \
+                    or feature.store \
+                    or feature.key not in features:
+                live.add(feature.key)
+                live.update(n.key for n in feature.needs)
+
+        self.steps = [f for f in steps if f.key in live]
+        self.order = []
+        for feature in self.steps:
+            # compute, and cache, each version now, rather than per document
+            feature.version
+            self.order.append(feature.key)
+            if feature.store:
+                self.order.append('{key}_encoder'.format(key=feature.key))
+                self.order.append('{key}_writer'.format(key=feature.key))
+
+    def __len__(self):
+        return len(self.order)
+
+    def instantiate(self, _id, persistence):
+        g = Graph()
+        for feature in self.steps:
+            needs = [g[n.key] for n in feature.needs]
+            feature._build_node(_id, g, persistence, needs)
+        g._order = list(self.order)
+        return g
+
+
+class ProcessResult(object):
+    """
+    The outcome of processing a single document with BaseModel.process_many(),
+    or updating one with BaseModel.update_many().  index is the position of
+    the document in the input, and error is None, or the formatted traceback
+    of the exception that caused the document to be rolled back
+    """
+
+    def __init__(self, index, kwargs, _id, error):
+        super(ProcessResult, self).__init__()
+        self.index = index
+        self.kwargs = kwargs
+        self._id = _id
+        self.error = error
+
+    def __repr__(self):
+        return '{cls}(index = {index}, _id = {_id}, error = {error})'.format(
+                cls=self.__class__.__name__, **self.__dict__)
+
+    def __str__(self):
+        return self.__repr__()
+
+# the model class handled by a process_many() worker process
+_worker_model = None
+
+
+def _initialize_worker(cls):
+    global _worker_model
+    _worker_model = cls
+    for database in cls._databases():
+        database.reopen()
+
+
+def _call_in_worker(method, index, _id, kwargs):
+    try:
+        getattr(_worker_model, method)(_id, kwargs)
+        return index, _id, None
+    except Exception:
+        return index, _id, traceback.format_exc()
+
+
+def _process_in_worker(args):
+    return _call_in_worker('_process_document', *args)
+
+
+def _update_in_worker(args):
+    return _call_in_worker('_update_document', *args)
+
+
 class BaseModel(object):
     __metaclass__ = MetaModel
 
+    # the strategy used to execute this model's graph.  When None, the
+    # Graph class' default executor is used
+    executor = None
+
+    # a Profiler that instruments a sample of this model's graph runs,
+    # including the runs that lazily compute unstored features
+    profiler = None
+
     def __init__(self, _id=None):
         super(BaseModel, self).__init__()
         if _id:
@@ -62,22 +183,123 @@ class BaseModel(object):
 
         BaseModel._ensure_persistence_settings(self.__class__)
         feature = getattr(self.__class__, key)
-        decoded = feature.__call__(self._id, persistence=self.__class__)
+        decoded = feature.__call__(
+                self._id,
+                persistence=self.__class__,
+                profiler=self.__class__.profiler)
         setattr(self, key, decoded)
         return decoded
 
+    def materialize(self, keys):
+        """
+        Decode, or compute, several of this document's features at once,
+        using features_for(), and cache them on the document, just as
+        attribute access does.  Return a dictionary mapping each key to the
+        feature's decoded value
+        """
+        missing = [k for k in keys if k not in self.__dict__]
+        decoded = self.__class__.features_for(self._id, missing)
+        for k, v in decoded.iteritems():
+            setattr(self, k, v)
+        return dict((k, getattr(self, k)) for k in keys)
+
+    @classmethod
+    def features_for(cls, _id, keys):
+        """
+        Return a dictionary mapping each key in keys to the decoded value of
+        that feature, for document _id.  Stored features are read directly.
+        The rest are computed together, in a single graph, so that the stored
+        features they depend on are read, and the nodes they share are run,
+        only once
+        """
+        BaseModel._ensure_persistence_settings(cls)
+        results = dict()
+        pending = []
+        for key in keys:
+            feature = cls.features[key]
+            try:
+                results[key] = feature.decoder(feature.reader(_id, key, cls))
+            except KeyError:
+                pending.append(feature)
+
+        if not pending:
+            return results
+
+        for feature in pending:
+            if not feature._can_compute():
+                raise AttributeError('%s cannot be computed' % feature.key)
+
+        graph, streams = Feature._build_partials(pending, _id, cls)
+        if cls.executor is not None:
+            graph.executor = cls.executor
+        graph.profiler = cls.profiler
+
+        kwargs = dict()
+        for k, extractor in graph.roots().iteritems():
+            try:
+                kwargs[k] = extractor._reader
+            except AttributeError:
+                kwargs[k] = cls.features[k].reader(_id, k, cls)
+
+        graph.process(**kwargs)
+        for feature in pending:
+            stream = streams[feature.key]
+            if stream is None:
+                stream = feature.reader(_id, feature.key, cls)
+            stream.seek(0)
+            results[feature.key] = feature.decoder(stream)
+        return results
+
+    @classmethod
+    def fetch_many(cls, ids, key):
+        """
+        Yield an (_id, value) pair for each document in ids, in order, where
+        value is the decoded value of the feature key.  Stored values are
+        read with a single call to the database's read_many(), while those
+        that are missing, or not stored, are computed, just as they would be
+        by attribute access
+        """
+        BaseModel._ensure_persistence_settings(cls)
+        feature = cls.features[key]
+        ids = list(ids)
+        if feature.store:
+            builder = feature.keybuilder(cls)
+            keys = [builder.build(_id, key, feature.version) for _id in ids]
+            streams = (s for _, s in feature.database(cls).read_many(keys))
+        else:
+            streams = repeat(None)
+
+        for _id, stream in izip(ids, streams):
+            if stream is None:
+                yield _id, feature(
+                        _id, persistence=cls, profiler=cls.profiler)
+            else:
+                yield _id, feature.decoder(stream)
+
+    @classmethod
+    def _graph_template(cls):
+        if cls._template is None:
+            cls._template = GraphTemplate(cls.features)
+        return cls._template
+
     @classmethod
     def _build_extractor(cls, _id):
-        g = Graph()
-        for feature in cls.features.itervalues():
-            feature._build_extractor(_id, g, cls)
+        g = cls._graph_template().instantiate(_id, cls)
+        if cls.executor is not None:
+            g.executor = cls.executor
+        g.profiler = cls.profiler
         return g
 
     @classmethod
-    def _rollback(cls, _id):
-        for f in cls.features.itervalues():
+    def _rollback(cls, _id, features=None):
+        if features is None:
+            features = cls.features.itervalues()
+        for f in features:
             if not f.store:
                 continue
+            if f.database(cls).transactional:
+                # the document's transaction has already been aborted
+                continue
             key = cls.key_builder.build(_id, f.key, f.version)
             try:
                 del cls.database[key]
@@ -85,14 +307,178 @@ class BaseModel(object):
                 pass
 
     @classmethod
-    def process(cls, **kwargs):
-        BaseModel._ensure_persistence_settings(cls)
-        _id = cls.id_provider.new_id(**kwargs)
+    def _databases(cls):
+        databases = dict()
+        for f in cls.features.itervalues():
+            db = f.database(cls)
+            databases[id(db)] = db
+        return databases.values()
+
+    @classmethod
+    def _transaction(cls):
+        return contextlib.nested(
+                *[db.transaction() for db in cls._databases()])
+
+    @classmethod
+    def commit(cls):
+        """
+        Commit any documents whose writes are being batched by the model's
+        databases, e.g., an LmdbDatabase in group commit mode
+        """
+        for db in cls._databases():
+            db.commit()
+
+    @classmethod
+    def _process_document(cls, _id, kwargs):
         graph = cls._build_extractor(_id)
-        graph.remove_dead_nodes(cls.features.itervalues())
         try:
-            graph.process(**kwargs)
+            with cls._transaction():
+                graph.process(**kwargs)
             return _id
         except Exception:
             cls._rollback(_id)
             raise
+
+    @classmethod
+    def process(cls, **kwargs):
+        BaseModel._ensure_persistence_settings(cls)
+        _id = cls.id_provider.new_id(**kwargs)
+        return cls._process_document(_id, kwargs)
+
+    @classmethod
+    def _stale_features(cls, _id):
+        return [f for f in cls.features.itervalues()
+                if f.store and not f._stored(_id, cls)]
+
+    @classmethod
+    def _build_update(cls, _id, stale):
+        features = dict()
+        for f in stale:
+            f._partial(_id, features=features, persistence=cls)
+        g = Graph()
+        if cls.executor is not None:
+            g.executor = cls.executor
+        g.profiler = cls.profiler
+        for f in features.itervalues():
+            f._build_extractor(_id, g, cls)
+        return g
+
+    @classmethod
+    def _update_document(cls, _id, kwargs):
+        stale = cls._stale_features(_id)
+        if not stale:
+            return []
+
+        graph = cls._build_update(_id, stale)
+        graph_args = dict(kwargs)
+        for k, extractor in graph.roots().iteritems():
+            try:
+                graph_args[k] = extractor._reader
+            except AttributeError:
+                pass
+
+        try:
+            with cls._transaction():
+                graph.process(**graph_args)
+        except Exception:
+            cls._rollback(_id, stale)
+            raise
+        return sorted(f.key for f in stale)
+
+    @classmethod
+    def update(cls, _id, **kwargs):
+        """
+        Compute and store those of an existing document's stored features that
+        are missing, or that were stored with a different version, e.g.,
+        after adding a feature to the model.  Stored features that are
+        up-to-date are read back and decoded, rather than being recomputed,
+        so kwargs, the same arguments passed to process(), are only needed
+        if a root feature itself is missing.  Return the keys of the
+        features that were computed
+        """
+        BaseModel._ensure_persistence_settings(cls)
+        return cls._update_document(_id, kwargs)
+
+    @classmethod
+    def update_many(cls, ids=None, workers=None, ordered=True):
+        """
+        update() each document in ids, or every document in the model's
+        database, if ids is None, yielding a ProcessResult for each, just as
+        process_many() does
+        """
+        BaseModel._ensure_persistence_settings(cls)
+        if ids is None:
+            ids = list(cls.database.iter_ids())
+        tasks = ((index, _id, dict()) for index, _id in enumerate(ids))
+        return cls._run_many(
+                '_update_document', _update_in_worker, tasks, workers, ordered)
+
+    @classmethod
+    def process_many(cls, iterable, workers=None, ordered=True):
+        """
+        Process each dictionary of keyword arguments in iterable as a
+        document, fanning documents out to a pool of worker processes.  A
+        ProcessResult is yielded for each document, in input order, or as
+        documents are completed if ordered is False.  A document that fails is
+        rolled back and reported, and does not interrupt the batch.
+
+        Documents are processed in this process, one at a time, if workers is
+        one, or if any of the model's databases cannot be written to by
+        several processes at once
+        """
+        BaseModel._ensure_persistence_settings(cls)
+        # ids are assigned in this process, so that stateful id providers
+        # never hand out the same id in two processes
+        tasks = (
+            (index, cls.id_provider.new_id(**kwargs), kwargs)
+            for index, kwargs in enumerate(iterable))
+        return cls._run_many(
+                '_process_document', _process_in_worker, tasks, workers,
+                ordered)
+
+    @classmethod
+    def _run_many(cls, method, worker_func, tasks, workers, ordered):
+        workers = workers or multiprocessing.cpu_count()
+        process_safe = all(db.process_safe for db in cls._databases())
+        if workers == 1 or not process_safe:
+            return cls._run_serially(method, tasks)
+        return cls._run_in_pool(worker_func, tasks, workers, ordered)
+
+    @classmethod
+    def _run_serially(cls, method, tasks):
+        try:
+            for index, _id, kwargs in tasks:
+                try:
+                    getattr(cls, method)(_id, kwargs)
+                    yield ProcessResult(index, kwargs, _id, None)
+                except Exception:
+                    yield ProcessResult(
+                            index, kwargs, _id, traceback.format_exc())
+        finally:
+            # documents whose writes are being batched are committed once the
+            # batch is done, or abandoned
+            cls.commit()
+
+    @classmethod
+    def _run_in_pool(cls, worker_func, tasks, workers, ordered):
+        pending = dict()
+
+        def track():
+            for index, _id, kwargs in tasks:
+                pending[index] = kwargs
+                yield index, _id, kwargs
+
+        pool = multiprocessing.Pool(
+                workers, initializer=_initialize_worker, initargs=(cls,))
+        completed = False
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for index, _id, error in imap(worker_func, track()):
+                yield ProcessResult(index, pending.pop(index), _id, error)
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
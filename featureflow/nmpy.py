@@ -5,7 +5,6 @@ import numpy as np
 import numpy
 from extractor import Node
 from feature import Feature
-from util import chunked
 from decoder import Decoder
 import struct
 
@@ -81,14 +80,55 @@ class PackedNumpyEncoder(NumpyEncoder):
         return np.packbits(data.astype(np.uint8), axis=-1)
 
 
-def _np_from_buffer(b, shape, dtype):
+class _PinnedArray(object):
+    """
+    Exposes an array through the array interface, while holding a reference to
+    owner, e.g., a stream whose open transaction keeps the memory the array
+    points to valid.  Arrays built from it keep it, and owner, alive
+    """
+
+    def __init__(self, arr, owner):
+        super(_PinnedArray, self).__init__()
+        self.__array_interface__ = arr.__array_interface__
+        self.arr = arr
+        self.owner = owner
+
+
+def _read(flo, nbytes=None, zero_copy=False):
+    """
+    Read from flo, without copying, if zero_copy is True, and it's a stream
+    that can hand out buffers over the memory its data is stored in.  Return
+    the data, along with the object that must outlive any array built from
+    it, or None, if the data is a copy
+    """
+    read_buffer = getattr(flo, 'read_buffer', None)
+    if not zero_copy or read_buffer is None:
+        return (flo.read() if nbytes is None else flo.read(nbytes)), None
+    return read_buffer(nbytes), flo
+
+
+def _np_from_buffer(b, shape, dtype, owner=None):
     f = np.frombuffer if len(b) else np.fromstring
-    return f(b, dtype=dtype).reshape(shape)
+    arr = f(b, dtype=dtype).reshape(shape)
+    if owner is None:
+        return arr
+    return np.asarray(_PinnedArray(arr, owner))
 
 
 class BaseNumpyDecoder(Decoder):
-    def __init__(self):
+    """
+    Decodes a stored array.  Arrays are copied out of the database, unless
+    zero_copy is True, in which case they're built over the memory the
+    database stores them in, where it allows, e.g., over an LmdbDatabase's,
+    or a memory-mapped FileSystemDatabase's, pages.  A zero-copy array keeps
+    its stream open for as long as it's alive, and an LmdbDatabase's stream
+    holds one of max_readers read transactions, and stops the map from
+    growing, so zero-copy arrays are best kept short-lived
+    """
+
+    def __init__(self, zero_copy=False):
         super(BaseNumpyDecoder, self).__init__()
+        self.zero_copy = zero_copy
 
     def _unpack_metadata(self, flo):
         return NumpyMetaData.unpack(flo)
@@ -98,11 +138,11 @@ class BaseNumpyDecoder(Decoder):
 
     def __call__(self, flo):
         metadata, bytes_read = self._unpack_metadata(flo)
-        leftovers = flo.read()
+        leftovers, owner = _read(flo, zero_copy=self.zero_copy)
         leftover_bytes = len(leftovers)
         first_dim = leftover_bytes / metadata.totalsize
         dim = (first_dim,) + metadata.shape
-        raw = _np_from_buffer(leftovers, dim, metadata.dtype)
+        raw = _np_from_buffer(leftovers, dim, metadata.dtype, owner)
         return self._wrap_array(raw, metadata)
 
     def __iter__(self, flo):
@@ -110,14 +150,20 @@ class BaseNumpyDecoder(Decoder):
 
 
 class GreedyNumpyDecoder(BaseNumpyDecoder):
-    def __init__(self):
-        super(GreedyNumpyDecoder, self).__init__()
+    def __init__(self, zero_copy=False):
+        super(GreedyNumpyDecoder, self).__init__(zero_copy=zero_copy)
 
 
 class StreamingNumpyDecoder(Decoder):
-    def __init__(self, n_examples=100):
+    """
+    Decodes a stored array n_examples at a time.  zero_copy is as described
+    for BaseNumpyDecoder
+    """
+
+    def __init__(self, n_examples=100, zero_copy=False):
         super(StreamingNumpyDecoder, self).__init__()
         self.n_examples = n_examples
+        self.zero_copy = zero_copy
 
     def __call__(self, flo):
         return self.__iter__(flo)
@@ -128,12 +174,16 @@ class StreamingNumpyDecoder(Decoder):
         chunk_size = int(example_size * self.n_examples)
         count = 0
 
-        for chunk in chunked(flo, chunk_size):
+        while True:
+            chunk, owner = _read(flo, chunk_size, self.zero_copy)
+            if not len(chunk):
+                break
             n_examples = len(chunk) // example_size
             yield _np_from_buffer(
                     chunk,
                     (n_examples,) + metadata.shape,
-                    metadata.dtype)
+                    metadata.dtype,
+                    owner)
             count += 1
 
         if count == 0:
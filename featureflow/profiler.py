@@ -0,0 +1,96 @@
+import random
+
+
+class NodeStats(object):
+    """
+    Counters gathered for a single node during one profiled graph run.
+    process_time is the time spent inside the node's own _process and
+    _last_chunk generators, excluding the time spent by downstream nodes.
+    stalls counts the times the node was handed data, but wasn't yet ready to
+    produce anything.  For DataWriter nodes, bytes_in is the number of bytes
+    written to the database
+    """
+
+    def __init__(self, key, node):
+        super(NodeStats, self).__init__()
+        self.key = key
+        self.node = node.__class__.__name__
+        self.calls = 0
+        self.chunks_in = 0
+        self.bytes_in = 0
+        self.chunks_out = 0
+        self.bytes_out = 0
+        self.process_time = 0
+        self.stalls = 0
+
+    def __repr__(self):
+        return (
+            '{cls}(key = {key}, calls = {calls}, '
+            'process_time = {process_time:.6f})').format(
+                cls=self.__class__.__name__, **self.__dict__)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class GraphReport(object):
+    """
+    The NodeStats for every node in a profiled graph run, by key, along with
+    the wall time of the entire run.  Iterating over a report yields the
+    NodeStats, in descending order of process_time
+    """
+
+    def __init__(self, stats, wall_time):
+        super(GraphReport, self).__init__()
+        self.nodes = dict((s.key, s) for s in stats)
+        self.wall_time = wall_time
+
+    def __getitem__(self, key):
+        return self.nodes[key]
+
+    def __iter__(self):
+        return iter(sorted(
+                self.nodes.itervalues(),
+                key=lambda s: s.process_time,
+                reverse=True))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def process_time(self):
+        return sum(s.process_time for s in self.nodes.itervalues())
+
+    def __str__(self):
+        header = '{:<24} {:<24} {:>8} {:>10} {:>12} {:>10} {:>12} {:>8} {:>12}'
+        row = '{:<24} {:<24} {:>8} {:>10} {:>12} {:>10} {:>12} {:>8} {:>12.6f}'
+        lines = [header.format(
+                'key', 'node', 'calls', 'chunks in', 'bytes in',
+                'chunks out', 'bytes out', 'stalls', 'time')]
+        for s in self:
+            lines.append(row.format(
+                    s.key, s.node, s.calls, s.chunks_in, s.bytes_in,
+                    s.chunks_out, s.bytes_out, s.stalls, s.process_time))
+        lines.append('wall time: {:.6f}'.format(self.wall_time))
+        return '\n'.join(lines)
+
+
+class Profiler(object):
+    """
+    Decides which graph runs are instrumented, and receives their reports.
+    A fraction sample_rate of runs are profiled, and each resulting
+    GraphReport is passed to callback, if one is provided.  Runs that aren't
+    sampled execute exactly as they would without a profiler
+    """
+
+    def __init__(self, sample_rate=1.0, callback=None):
+        super(Profiler, self).__init__()
+        self.sample_rate = sample_rate
+        self.callback = callback
+
+    def sample(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def report(self, graph_report):
+        if self.callback is not None:
+            self.callback(graph_report)
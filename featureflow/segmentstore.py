@@ -0,0 +1,374 @@
+from data import Database, BufferReadStream, _MemoryWriteStream
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict
+import cPickle
+import threading
+import struct
+import zlib
+import mmap
+import os
+
+# Each record is this header, followed by its key and its value.  The header
+# holds a checksum of the rest of the record, the lengths of its key and
+# value, and its flags
+_record = struct.Struct('>IIQB')
+_record_rest = struct.Struct('>IQB')
+
+# the record deletes its key, rather than storing a value for it
+_TOMBSTONE = 1
+
+# the record is one of a batch, e.g., a document's features, and more of the
+# batch follow it.  Batches are written all at once, and a batch cut short by
+# a crash is discarded in its entirety
+_CONTINUED = 2
+
+SEGMENT_PREFIX = 'segment'
+
+INDEX_FILE = 'index'
+
+DEFAULT_SEGMENT_SIZE = 2 ** 28
+
+
+def _segment_name(n):
+    return '{prefix}{n:06d}'.format(prefix=SEGMENT_PREFIX, n=n)
+
+
+def _pack(key, value, flags):
+    rest = _record_rest.pack(len(key), len(value), flags)
+    crc = zlib.crc32(value, zlib.crc32(key, zlib.crc32(rest))) & 0xffffffff
+    return struct.pack('>I', crc) + rest + key + value
+
+
+class CorruptSegmentError(IOError):
+    pass
+
+
+class SegmentDatabase(Database):
+    """
+    Appends values to large segment files, rather than storing each in a
+    file, or a record, of its own, which suits many small values.  An index
+    of each key's segment and offset is kept in memory, and values are read
+    directly from memory-mapped segments, so reading a value involves no
+    system calls at all, once its segment has been mapped.
+
+    Each document's features are appended to the current segment in a single
+    write, and a document cut short by a crash is discarded when the
+    database is next opened.  sync=True also flushes each write to disk
+    before returning.  A new segment is begun once the current one reaches
+    segment_size bytes.
+
+    Deleting or overwriting a value only appends a record, so the space
+    values occupy is only reclaimed by compact(), which must not be run while
+    any other process is using the database.  The index is saved by commit()
+    and compact(), and only records appended after the last save are read
+    when the database is opened.
+
+    Only one process may write to the database at once
+    """
+
+    transactional = True
+
+    def __init__(
+            self,
+            path,
+            key_builder=None,
+            segment_size=DEFAULT_SEGMENT_SIZE,
+            sync=False):
+
+        super(SegmentDatabase, self).__init__(key_builder=key_builder)
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._active = None
+        self._load()
+
+    def _segment_path(self, n):
+        return os.path.join(self.path, _segment_name(n))
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.path):
+            if not name.startswith(SEGMENT_PREFIX):
+                continue
+            try:
+                segments.append(int(name[len(SEGMENT_PREFIX):]))
+            except ValueError:
+                pass
+        return sorted(segments)
+
+    def _load(self):
+        self._index = dict()
+        self._ids = defaultdict(int)
+        # the mapping of each segment that has been read from
+        self._maps = dict()
+        self._segments = self._list_segments()
+        position = (-1, 0)
+
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), 'rb') as f:
+                position, self._index, ids = cPickle.load(f)
+            self._ids.update(ids)
+        except IOError:
+            pass
+
+        start_segment, start = position
+        for n in self._segments:
+            if n < start_segment:
+                continue
+            self._replay(n, start if n == start_segment else 0)
+
+        if not self._segments:
+            self._segments.append(0)
+        self._open_active()
+
+    def _open_active(self):
+        n = self._segments[-1]
+        self._active = open(self._segment_path(n), 'ab')
+        self._active_size = os.fstat(self._active.fileno()).st_size
+
+    def _scan(self, n, start):
+        """
+        Yield each complete batch of records in segment n, beginning at
+        start, as a list of (key, location, flags) tuples, along with the
+        offset just past it
+        """
+        path = self._segment_path(n)
+        with open(path, 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            if length <= start:
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        batch = []
+        pos = start
+        while pos < length:
+            end = pos + _record.size
+            if end > length:
+                break
+            crc, key_length, value_length, flags = \
+                _record.unpack_from(m, pos)
+            value_start = end + key_length
+            end = value_start + value_length
+            if end > length:
+                break
+            checksum = zlib.crc32(buffer(m, pos + 4, end - pos - 4)) \
+                & 0xffffffff
+            if checksum != crc:
+                break
+            key = m[pos + _record.size: value_start]
+            batch.append((key, (n, value_start, value_length), flags))
+            pos = end
+            if not flags & _CONTINUED:
+                yield batch, pos
+                batch = []
+
+    def _replay(self, n, start):
+        end = start
+        for batch, end in self._scan(n, start):
+            for key, location, flags in batch:
+                self._apply(key, None if flags & _TOMBSTONE else location)
+
+        length = os.path.getsize(self._segment_path(n))
+        if end == length:
+            return
+        if n != self._segments[-1]:
+            raise CorruptSegmentError(
+                    'segment {n} is corrupt at offset {end}'.format(
+                            **locals()))
+        # the last write was cut short
+        with open(self._segment_path(n), 'r+b') as f:
+            f.truncate(end)
+
+    def _apply(self, key, location):
+        """
+        Point key at location in the index, or remove it, if location is None
+        """
+        existed = self._index.pop(key, None) is not None
+        if location is not None:
+            self._index[key] = location
+        if existed == (location is not None):
+            return
+        _id, _, _ = self.key_builder.decompose(key)
+        if location is not None:
+            self._ids[_id] += 1
+            return
+        self._ids[_id] -= 1
+        if not self._ids[_id]:
+            del self._ids[_id]
+
+    def reopen(self):
+        with self._lock:
+            self._active.close()
+            self._local = threading.local()
+            self._load()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._active.close()
+
+    def _roll(self):
+        self._active.close()
+        self._segments.append(self._segments[-1] + 1)
+        self._open_active()
+
+    def _append(self, records):
+        with self._lock:
+            if self._active_size >= self.segment_size:
+                self._roll()
+            n = self._segments[-1]
+            pieces = []
+            locations = []
+            offset = self._active_size
+            for i, (key, value) in enumerate(records):
+                flags = 0 if i == len(records) - 1 else _CONTINUED
+                if value is None:
+                    flags |= _TOMBSTONE
+                    value = ''
+                piece = _pack(key, value, flags)
+                pieces.append(piece)
+                value_start = offset + _record.size + len(key)
+                locations.append(
+                        None if flags & _TOMBSTONE
+                        else (n, value_start, len(value)))
+                offset += len(piece)
+
+            self._active.write(''.join(pieces))
+            self._active.flush()
+            if self.sync:
+                os.fsync(self._active.fileno())
+            self._active_size = offset
+
+            for (key, _), location in zip(records, locations):
+                self._apply(key, location)
+
+    def _pending(self):
+        return getattr(self._local, 'pending', None)
+
+    @contextmanager
+    def transaction(self):
+        if self._pending() is not None:
+            yield
+            return
+
+        pending = self._local.pending = OrderedDict()
+        try:
+            yield
+        finally:
+            self._local.pending = None
+        if pending:
+            self._append(pending.items())
+
+    def commit(self):
+        """
+        Save the index, so that the records appended so far needn't be read
+        when the database is next opened
+        """
+        with self._lock:
+            position = (self._segments[-1], self._active_size)
+            path = os.path.join(self.path, INDEX_FILE)
+            partial = path + '.partial'
+            with open(partial, 'wb') as f:
+                cPickle.dump(
+                        (position, self._index, dict(self._ids)),
+                        f,
+                        cPickle.HIGHEST_PROTOCOL)
+            os.rename(partial, path)
+
+    def _put(self, key, value):
+        pending = self._pending()
+        if pending is None:
+            self._append([(key, value)])
+        else:
+            pending[key] = value
+
+    def write_stream(self, key, content_type):
+        return _MemoryWriteStream(lambda value: self._put(key, value))
+
+    def _map(self, n, end):
+        with self._lock:
+            m = self._maps.get(n)
+            if m is None or len(m) < end:
+                # the current segment has grown since it was mapped.  Buffers
+                # over the old mapping keep it alive for as long as they need
+                with open(self._segment_path(n), 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[n] = m
+            return m
+
+    def _value(self, key):
+        """
+        Return a buffer over the value stored under key, or raise KeyError
+        """
+        pending = self._pending()
+        if pending is not None and key in pending:
+            value = pending[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        n, offset, length = self._index[key]
+        if not length:
+            return ''
+        return buffer(self._map(n, offset + length), offset, length)
+
+    def read_stream(self, key):
+        return BufferReadStream(self._value(key))
+
+    def size(self, key):
+        return len(self._value(key))
+
+    def iter_ids(self):
+        return iter(sorted(self._ids))
+
+    def count(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        try:
+            self._value(key)
+            return True
+        except KeyError:
+            return False
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._put(key, None)
+
+    def compact(self):
+        """
+        Copy every live value into new segments, in the order they were
+        written, and remove the old ones, along with the space taken by
+        deleted, and overwritten, values
+        """
+        with self._lock:
+            old = list(self._segments)
+            self._active.close()
+            self._segments.append(old[-1] + 1)
+            self._open_active()
+            live = sorted(self._index.iteritems(), key=lambda item: item[1])
+            for key, (n, offset, length) in live:
+                value = self._map(n, offset + length)[offset:offset + length]
+                if self._active_size >= self.segment_size:
+                    self._active.flush()
+                    os.fsync(self._active.fileno())
+                    self._roll()
+                piece = _pack(key, value, 0)
+                self._active.write(piece)
+                self._index[key] = (
+                    self._segments[-1],
+                    self._active_size + _record.size + len(key),
+                    length)
+                self._active_size += len(piece)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+
+            self._segments = [n for n in self._segments if n not in old]
+            self.commit()
+            self._maps = dict()
+            for n in old:
+                os.remove(self._segment_path(n))
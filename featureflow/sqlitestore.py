@@ -0,0 +1,237 @@
+import sqlite3
+from data import \
+    Database, BufferReadStream, ChunkedReads, _MemoryWriteStream
+from contextlib import contextmanager
+from collections import OrderedDict
+import threading
+
+# Values are stored as a series of chunks of at most this size, each in a row
+# of its own, so they can be read a piece at a time
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS keys (
+    token INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    _id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS keys_id ON keys (_id);
+CREATE TABLE IF NOT EXISTS chunks (
+    token INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (token, n)) WITHOUT ROWID;
+'''
+
+_READ = '''
+SELECT keys.token, keys.size, keys.chunk_size, chunks.data
+FROM keys LEFT JOIN chunks ON chunks.token = keys.token AND chunks.n = 0
+WHERE keys.key = ?
+'''
+
+
+class ReadStream(ChunkedReads, BufferReadStream):
+    """
+    A file-like view of a value stored as a series of chunks, which are
+    fetched as they're read.  A value that fits in a single chunk is fetched
+    along with its size, in a single query, and subsequent chunks are looked
+    up by the value's token, which changes whenever the value is overwritten,
+    so a stream never mixes the chunks of two versions of a value.
+
+    read_buffer() returns buffers over the rows' data, which, unlike those
+    returned by LMDB, belong to the stream, and remain valid after it's
+    closed
+    """
+
+    def __init__(self, fetch, token, length, chunk_size, first):
+        super(ReadStream, self).__init__(first, length=length)
+        self._fetch = fetch
+        self.token = token
+        self.chunk_size = chunk_size
+        self._index = 0
+
+    def _fetch_chunk(self, index):
+        return self._fetch(self.token, index)
+
+
+class SqliteDatabase(Database):
+    """
+    Stores every value in a single SQLite database file at path, in
+    write-ahead logging mode, so that readers, in any number of threads or
+    processes, don't block, and aren't blocked by, the single writer.
+
+    Each processed document's features are held in memory until it's
+    complete, and then written in a single transaction, so they're committed
+    atomically, and rolling back a failed document means discarding them.
+    The database's write lock is only taken once the document is complete,
+    rather than while it's processed, and other writers wait up to timeout
+    seconds for it.  A document's values aren't visible, even to the
+    document itself, until it's committed.
+
+    Values are split into rows of chunk_size bytes, which read streams fetch
+    as they're needed.  Each value's id is indexed, so ids are listed without
+    visiting every value
+    """
+
+    process_safe = True
+
+    transactional = True
+
+    def __init__(
+            self,
+            path,
+            key_builder=None,
+            chunk_size=DEFAULT_CHUNK_SIZE,
+            timeout=60,
+            synchronous='NORMAL'):
+
+        super(SqliteDatabase, self).__init__(key_builder=key_builder)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self._inherited_locals = []
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def reopen(self):
+        # A connection must never be used, or even closed, in a process
+        # forked from the one that opened it, so hold a reference to the old
+        # ones, to keep them from being garbage collected, and open new ones
+        self._inherited_locals.append(self._local)
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        The current thread's connection.  Transactions are begun and
+        committed explicitly, rather than by the sqlite3 module
+        """
+        try:
+            return self._local.connection
+        except AttributeError:
+            pass
+        connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute(
+                'PRAGMA synchronous = {0}'.format(self.synchronous))
+        self._local.connection = connection
+        return connection
+
+    def _pending(self):
+        return getattr(self._local, 'pending', None)
+
+    @contextmanager
+    def transaction(self):
+        if self._pending() is not None:
+            yield
+            return
+
+        pending = self._local.pending = OrderedDict()
+        try:
+            yield
+        finally:
+            self._local.pending = None
+        if pending:
+            self._write(pending.items())
+
+    def _write(self, values):
+        """
+        Store each (key, value) pair, or delete key, if value is None, in a
+        single transaction
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key, value in values:
+                self._delete(connection, key)
+                if value is not None:
+                    self._insert(connection, key, value)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _delete(self, connection, key):
+        row = connection.execute(
+                'SELECT token FROM keys WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False
+        token, = row
+        connection.execute('DELETE FROM chunks WHERE token = ?', (token,))
+        connection.execute('DELETE FROM keys WHERE token = ?', (token,))
+        return True
+
+    def _insert(self, connection, key, value):
+        _id, _, _ = self.key_builder.decompose(key)
+        size = self.chunk_size
+        token = connection.execute(
+                'INSERT INTO keys (key, _id, size, chunk_size) '
+                'VALUES (?, ?, ?, ?)',
+                (key, _id, len(value), size)).lastrowid
+        connection.executemany(
+                'INSERT INTO chunks (token, n, data) VALUES (?, ?, ?)',
+                ((token, n, buffer(value, i, size))
+                 for n, i in enumerate(xrange(0, len(value), size))))
+
+    def _store(self, key, value):
+        """
+        Store value under key, or delete key, if value is None, once the
+        current document is complete, or right away, outside of one
+        """
+        pending = self._pending()
+        if pending is None:
+            self._write([(key, value)])
+        else:
+            pending[key] = value
+
+    def write_stream(self, key, content_type):
+        return _MemoryWriteStream(lambda value: self._store(key, value))
+
+    def _fetch(self, token, index):
+        row = self._connection().execute(
+                'SELECT data FROM chunks WHERE token = ? AND n = ?',
+                (token, index)).fetchone()
+        return None if row is None else row[0]
+
+    def read_stream(self, key):
+        row = self._connection().execute(_READ, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        token, size, chunk_size, first = row
+        return ReadStream(
+                self._fetch, token, size, chunk_size, first or buffer(''))
+
+    def size(self, key):
+        row = self._connection().execute(
+                'SELECT size FROM keys WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def iter_ids(self):
+        cursor = self._connection().execute(
+                'SELECT DISTINCT _id FROM keys ORDER BY _id')
+        for _id, in cursor:
+            yield _id
+
+    def count(self):
+        return self._connection().execute(
+                'SELECT COUNT(DISTINCT _id) FROM keys').fetchone()[0]
+
+    def __contains__(self, key):
+        return self._connection().execute(
+                'SELECT 1 FROM keys WHERE key = ?', (key,)).fetchone() \
+            is not None
+
+    def __delitem__(self, key):
+        pending = self._pending()
+        if pending is not None and key in pending:
+            exists = pending[key] is not None
+        else:
+            exists = key in self
+        if not exists:
+            raise KeyError(key)
+        self._store(key, None)
@@ -0,0 +1,69 @@
+import unittest2
+import compression
+from decoder import CompressionDecoder
+from io import BytesIO
+import bz2
+import os
+
+
+class CompressionTests(unittest2.TestCase):
+    def setUp(self):
+        self.value = os.urandom(100) * 100
+
+    def compress(self, name, level=None):
+        codec = compression.codec(name)
+        compressor = codec.compressor(level)
+        return codec.header + compressor.compress(self.value) \
+            + compressor.flush()
+
+    def decompress(self, compressed):
+        return ''.join(CompressionDecoder()(BytesIO(compressed)))
+
+    def test_unknown_codec_raises(self):
+        self.assertRaises(ValueError, lambda: compression.codec('unknown'))
+
+    def test_codecs_have_distinct_tags(self):
+        tags = [c.tag for c in compression.CODECS.itervalues()]
+        self.assertEqual(len(tags), len(set(tags)))
+
+    def test_zlib_round_trip(self):
+        compressed = self.compress('zlib')
+        self.assertLess(len(compressed), len(self.value))
+        self.assertEqual(self.value, self.decompress(compressed))
+
+    def test_bz2_round_trip(self):
+        self.assertEqual(self.value, self.decompress(self.compress('bz2')))
+
+    @unittest2.skipIf(compression.lzma is None, 'lzma is not installed')
+    def test_lzma_round_trip(self):
+        self.assertEqual(self.value, self.decompress(self.compress('lzma')))
+
+    def test_zlib_level_is_used(self):
+        self.assertNotEqual(
+                self.compress('zlib', level=0), self.compress('zlib', level=9))
+
+    def test_detects_codec_from_header(self):
+        codec, is_header = compression.detect(self.compress('zlib'))
+        self.assertEqual('zlib', codec.name)
+        self.assertTrue(is_header)
+
+    def test_detects_bz2_without_header(self):
+        codec, is_header = compression.detect(bz2.compress(self.value))
+        self.assertEqual('bz2', codec.name)
+        self.assertFalse(is_header)
+
+    def test_decodes_bz2_without_header(self):
+        self.assertEqual(
+                self.value, self.decompress(bz2.compress(self.value)))
+
+    def test_unknown_tag_raises(self):
+        self.assertRaises(
+                ValueError,
+                lambda: compression.detect(compression.HEADER_PREFIX + '?'))
+
+    def test_uncompressed_value_raises(self):
+        self.assertRaises(
+                ValueError, lambda: self.decompress('not compressed'))
+
+    def test_empty_value_decodes_to_nothing(self):
+        self.assertEqual('', self.decompress(''))
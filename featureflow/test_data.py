@@ -2,8 +2,9 @@ import unittest2
 from uuid import uuid4
 from data import \
     InMemoryDatabase, UserSpecifiedIdProvider, FileSystemDatabase, \
-    StringDelimitedKeyBuilder
+    StringDelimitedKeyBuilder, MappedReadStream, LruDatabase, CachedDatabase
 import shutil
+import os
 
 
 class InMemoryDatabaseTest(unittest2.TestCase):
@@ -26,6 +27,15 @@ class InMemoryDatabaseTest(unittest2.TestCase):
         rs = self.get('key')
         self.assertEqual('test data', rs.read())
 
+    def test_can_read_many(self):
+        self.set('a', 'data a')
+        self.set('b', 'data b')
+        results = list(self.db.read_many(['b', 'missing', 'a']))
+        self.assertEqual(['b', 'missing', 'a'], [k for k, _ in results])
+        self.assertEqual('data b', results[0][1].read())
+        self.assertIsNone(results[1][1])
+        self.assertEqual('data a', results[2][1].read())
+
     def test_can_overwrite_key(self):
         self.set('key', 'test data')
         rs = self.get('key')
@@ -35,6 +45,274 @@ class InMemoryDatabaseTest(unittest2.TestCase):
         self.assertEqual('test data2', rs.read())
 
 
+class LruDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.spill = InMemoryDatabase(key_builder=self.key_builder)
+
+    def _make_db(self, max_bytes=10, spill=False):
+        return LruDatabase(
+                max_bytes,
+                spill=self.spill if spill else None,
+                key_builder=self.key_builder)
+
+    def set(self, db, k, v):
+        with db.write_stream(k, 'text/plain') as s:
+            s.write(v)
+
+    def get(self, db, k):
+        return db.read_stream(k).read()
+
+    def test_can_read_data(self):
+        db = self._make_db()
+        self.set(db, 'key', 'data')
+        self.assertEqual('data', self.get(db, 'key'))
+        self.assertEqual(4, db.size('key'))
+
+    def test_value_is_not_visible_until_stream_is_closed(self):
+        db = self._make_db()
+        s = db.write_stream('key', 'text/plain')
+        s.write('data')
+        self.assertNotIn('key', db)
+        s.close()
+        self.assertIn('key', db)
+
+    def test_tracks_bytes_held(self):
+        db = self._make_db()
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbb')
+        self.set(db, 'a', 'a')
+        self.assertEqual(4, db.nbytes)
+        del db['b']
+        self.assertEqual(1, db.nbytes)
+
+    def test_evicts_least_recently_used_value(self):
+        db = self._make_db()
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbb')
+        self.get(db, 'a')
+        self.set(db, 'c', 'cccc')
+        self.assertIn('a', db)
+        self.assertNotIn('b', db)
+        self.assertIn('c', db)
+        self.assertEqual(1, db.evictions)
+        self.assertEqual(8, db.nbytes)
+
+    def test_evicted_value_raises_key_error_without_spill(self):
+        db = self._make_db()
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbbbbbb')
+        self.assertRaises(KeyError, lambda: db.read_stream('a'))
+        self.assertRaises(KeyError, lambda: db.size('a'))
+
+    def test_value_larger_than_budget_is_dropped_without_spill(self):
+        db = self._make_db()
+        self.set(db, 'a', 'a' * 11)
+        self.assertNotIn('a', db)
+        self.assertEqual(0, db.nbytes)
+
+    def test_counts_hits_and_misses(self):
+        db = self._make_db()
+        self.set(db, 'a', 'aaaa')
+        self.get(db, 'a')
+        self.get(db, 'a')
+        self.assertRaises(KeyError, lambda: db.read_stream('b'))
+        self.assertEqual(2, db.hits)
+        self.assertEqual(1, db.misses)
+
+    def test_evicted_value_is_spilled(self):
+        db = self._make_db(spill=True)
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbbbbbb')
+        self.assertEqual('aaaa', self.spill.read_stream('a').read())
+        self.assertIn('a', db)
+        self.assertEqual(4, db.size('a'))
+
+    def test_spilled_value_is_read_back_into_memory(self):
+        db = self._make_db(spill=True)
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbbbbbb')
+        self.assertEqual('aaaa', self.get(db, 'a'))
+        self.assertEqual(1, db.misses)
+        self.assertEqual('aaaa', self.get(db, 'a'))
+        self.assertEqual(1, db.hits)
+        self.assertEqual('bbbbbbbb', self.get(db, 'b'))
+
+    def test_unchanged_value_is_not_spilled_again(self):
+        db = self._make_db(spill=True)
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbbbbbb')
+        self.get(db, 'a')
+        del self.spill['a']
+        self.set(db, 'c', 'cccccccc')
+        self.assertNotIn('a', self.spill)
+
+    def test_overwritten_value_is_spilled_again(self):
+        db = self._make_db(spill=True)
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbbbbbb')
+        self.get(db, 'a')
+        self.set(db, 'a', 'AAAA')
+        self.set(db, 'c', 'cccccccc')
+        self.assertEqual('AAAA', self.get(db, 'a'))
+
+    def test_value_larger_than_budget_is_written_to_spill(self):
+        db = self._make_db(spill=True)
+        self.set(db, 'a', 'a' * 11)
+        self.assertEqual(0, db.nbytes)
+        self.assertEqual('a' * 11, self.get(db, 'a'))
+        self.assertEqual(0, db.nbytes)
+
+    def test_iter_ids_includes_spilled_values(self):
+        db = self._make_db(max_bytes=20, spill=True)
+        for _id in ('a', 'b', 'c'):
+            for feature in ('x', 'y'):
+                self.set(db, self.key_builder.build(_id, feature, 'v'), 'data')
+        self.assertEqual(['a', 'b', 'c'], sorted(db.iter_ids()))
+
+    def test_delete_removes_spilled_value(self):
+        db = self._make_db(spill=True)
+        self.set(db, 'a', 'aaaa')
+        self.set(db, 'b', 'bbbbbbbb')
+        self.get(db, 'a')
+        del db['a']
+        self.assertNotIn('a', db)
+        self.assertNotIn('a', self.spill)
+
+    def test_delete_missing_key_raises_key_error(self):
+        db = self._make_db(spill=True)
+
+        def delete():
+            del db['a']
+
+        self.assertRaises(KeyError, delete)
+
+
+class CachedDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.front = LruDatabase(100, key_builder=self.key_builder)
+        self.back = InMemoryDatabase(key_builder=self.key_builder)
+
+    def _make_db(self, write_back=False):
+        return CachedDatabase(self.front, self.back, write_back=write_back)
+
+    def set(self, db, k, v):
+        with db.transaction():
+            with db.write_stream(k, 'text/plain') as s:
+                s.write(v)
+
+    def get(self, db, k):
+        return db.read_stream(k).read()
+
+    def test_writes_through_to_both_databases(self):
+        db = self._make_db()
+        self.set(db, 'key', 'data')
+        self.assertEqual('data', self.get(self.front, 'key'))
+        self.assertEqual('data', self.get(self.back, 'key'))
+
+    def test_reads_from_front(self):
+        db = self._make_db()
+        self.set(db, 'key', 'data')
+        del self.back['key']
+        self.assertEqual('data', self.get(db, 'key'))
+        self.assertEqual(1, db.hits)
+        self.assertEqual(4, db.bytes_saved)
+
+    def test_populates_front_on_miss(self):
+        db = self._make_db()
+        self.set(self.back, 'key', 'data')
+        self.assertEqual('data', self.get(db, 'key'))
+        self.assertEqual(1, db.misses)
+        self.assertEqual('data', self.get(self.front, 'key'))
+        self.assertEqual('data', self.get(db, 'key'))
+        self.assertEqual(1, db.hits)
+        self.assertEqual(0.5, db.hit_ratio)
+
+    def test_missing_key_raises_key_error(self):
+        db = self._make_db()
+        self.assertRaises(KeyError, lambda: db.read_stream('key'))
+        self.assertRaises(KeyError, lambda: db.size('key'))
+        self.assertNotIn('key', db)
+
+    def test_reads_values_evicted_from_front(self):
+        db = self._make_db()
+        self.set(db, 'a', 'a' * 60)
+        self.set(db, 'b', 'b' * 60)
+        self.assertNotIn('a', self.front)
+        self.assertIn('a', db)
+        self.assertEqual(60, db.size('a'))
+        self.assertEqual('a' * 60, self.get(db, 'a'))
+
+    def test_delete_invalidates_front(self):
+        db = self._make_db()
+        self.set(db, 'key', 'data')
+        del db['key']
+        self.assertNotIn('key', self.front)
+        self.assertNotIn('key', self.back)
+        self.assertRaises(KeyError, lambda: db.read_stream('key'))
+
+    def test_aborted_transaction_invalidates_front(self):
+        db = self._make_db()
+
+        def write():
+            with db.transaction():
+                with db.write_stream('key', 'text/plain') as s:
+                    s.write('data')
+                raise ValueError()
+
+        self.assertRaises(ValueError, write)
+        self.assertNotIn('key', self.front)
+
+    def test_write_back_defers_writes_until_commit(self):
+        db = self._make_db(write_back=True)
+        self.set(db, 'key', 'data')
+        self.assertNotIn('key', self.back)
+        self.assertEqual('data', self.get(db, 'key'))
+        db.commit()
+        self.assertEqual('data', self.get(self.back, 'key'))
+
+    def test_write_back_iter_ids_includes_uncommitted_values(self):
+        db = self._make_db(write_back=True)
+        self.set(db, self.key_builder.build('a', 'f', 'v'), 'data')
+        self.set(self.back, self.key_builder.build('b', 'f', 'v'), 'data')
+        self.assertEqual(['a', 'b'], sorted(db.iter_ids()))
+        db.commit()
+        self.assertEqual(['a', 'b'], sorted(db.iter_ids()))
+
+    def test_write_back_can_delete_uncommitted_value(self):
+        db = self._make_db(write_back=True)
+        self.set(db, 'key', 'data')
+        del db['key']
+        db.commit()
+        self.assertNotIn('key', db)
+
+
+class CachedFileSystemDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{path}'.format(path=uuid4().hex)
+        key_builder = StringDelimitedKeyBuilder()
+        self.front = FileSystemDatabase(
+                os.path.join(self.path, 'front'),
+                key_builder=key_builder,
+                createdirs=True)
+        self.back = FileSystemDatabase(
+                os.path.join(self.path, 'back'),
+                key_builder=key_builder,
+                createdirs=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_is_process_safe_when_both_databases_are(self):
+        db = CachedDatabase(self.front, self.back)
+        self.assertTrue(db.process_safe)
+
+    def test_is_not_process_safe_with_write_back(self):
+        db = CachedDatabase(self.front, self.back, write_back=True)
+        self.assertFalse(db.process_safe)
+
+
 class UserSpecifiedIdProviderTest(unittest2.TestCase):
     def test_raises_when_no_key_is_provided(self):
         self.assertRaises(ValueError, lambda: UserSpecifiedIdProvider())
@@ -68,3 +346,236 @@ class FileSystemDatabaseTests(unittest2.TestCase):
     def test_does_not_create_path_when_not_asked(self):
         db = self._make_db(createdirs=False)
         self.assertRaises(IOError, lambda: db.write_stream('key', 'text/plain'))
+
+    def test_can_read_many(self):
+        db = self._make_db(createdirs=True)
+        keys = [str(i) for i in xrange(50)]
+        for key in keys:
+            with db.write_stream(key, 'text/plain') as s:
+                s.write('text' + key)
+
+        results = list(db.read_many(keys[:20] + ['missing'] + keys[20:]))
+        self.assertEqual(51, len(results))
+        self.assertEqual(('missing', None), results[20])
+        for key, stream in results[:20] + results[21:]:
+            self.assertEqual('text' + key, stream.read())
+
+    def test_can_read_many_on_worker_threads(self):
+        db = self._make_db(createdirs=True)
+        keys = [str(i) for i in xrange(50)]
+        for key in keys:
+            with db.write_stream(key, 'text/plain') as s:
+                s.write('text' + key)
+
+        results = list(db.read_many(
+                keys[:20] + ['missing'] + keys[20:], workers=2, batch_size=8))
+        self.assertEqual(51, len(results))
+        self.assertEqual(('missing', None), results[20])
+        for key, stream in results[:20] + results[21:]:
+            self.assertEqual('text' + key, stream.read())
+            stream.close()
+
+
+class MappedFileSystemDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self._path = '/tmp/{path}'.format(path=uuid4().hex)
+        self.db = FileSystemDatabase(
+                path=self._path,
+                key_builder=StringDelimitedKeyBuilder(),
+                createdirs=True,
+                mmap=True)
+
+    def tearDown(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _write(self, key, value):
+        with self.db.write_stream(key, 'text/plain') as s:
+            s.write(value)
+
+    def test_can_read_value(self):
+        self._write('key', 'text')
+        with self.db.read_stream('key') as s:
+            self.assertIsInstance(s, MappedReadStream)
+            self.assertEqual('text', s.read())
+
+    def test_can_read_empty_value(self):
+        self._write('key', '')
+        with self.db.read_stream('key') as s:
+            self.assertEqual('', s.read())
+
+    def test_can_read_in_chunks(self):
+        self._write('key', 'abcdefg')
+        with self.db.read_stream('key') as s:
+            self.assertEqual('abc', s.read(3))
+            self.assertEqual('defg', s.read(10))
+            self.assertEqual('', s.read(3))
+
+    def test_can_seek(self):
+        self._write('key', 'abcdefg')
+        with self.db.read_stream('key') as s:
+            s.seek(-2, os.SEEK_END)
+            self.assertEqual('fg', s.read())
+            s.seek(1)
+            s.seek(1, os.SEEK_CUR)
+            self.assertEqual(2, s.tell())
+            self.assertEqual('cd', s.read(2))
+
+    def test_missing_value_raises_key_error(self):
+        self.assertRaises(KeyError, lambda: self.db.read_stream('key'))
+
+    def test_cannot_read_closed_stream(self):
+        self._write('key', 'text')
+        s = self.db.read_stream('key')
+        s.close()
+        self.assertRaises(ValueError, lambda: s.read())
+
+    def test_buffer_outlives_stream(self):
+        self._write('key', 'text')
+        with self.db.read_stream('key') as s:
+            b = s.read_buffer()
+        self.assertEqual('text', b[:])
+
+    def test_buffer_is_unchanged_when_value_is_rewritten(self):
+        self._write('key', 'text')
+        with self.db.read_stream('key') as s:
+            b = s.read_buffer()
+        self._write('key', '')
+        self.assertEqual('text', b[:])
+        with self.db.read_stream('key') as s:
+            self.assertEqual('', s.read())
+
+    def test_partially_written_values_are_not_listed(self):
+        s = self.db.write_stream('id:feature:version', 'text/plain')
+        s.write('text')
+        self.assertEqual([], list(self.db.iter_ids()))
+        s.close()
+        self.assertEqual(['id'], list(self.db.iter_ids()))
+
+
+class FanOutFileSystemDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self._key_builder = StringDelimitedKeyBuilder()
+        self._path = '/tmp/{path}'.format(path=uuid4().hex)
+
+    def tearDown(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def _make_db(self, levels=2):
+        return FileSystemDatabase(
+                path=self._path,
+                key_builder=self._key_builder,
+                createdirs=True,
+                levels=levels)
+
+    def _key(self, _id, feature='feature'):
+        return self._key_builder.build(_id, feature, 'version')
+
+    def _write(self, db, key):
+        with db.write_stream(key, 'text/plain') as s:
+            s.write('text' + key)
+
+    def _write_documents(self, db, n=20, features=('a', 'b')):
+        for i in xrange(n):
+            for feature in features:
+                self._write(db, self._key(str(i), feature))
+
+    def test_values_are_stored_beneath_hashed_directories(self):
+        db = self._make_db()
+        key = self._key('id')
+        self._write(db, key)
+        self.assertFalse(os.path.exists(os.path.join(self._path, key)))
+        directory, = [d for d, _, files in os.walk(self._path) if files]
+        parts = os.path.relpath(directory, self._path).split(os.sep)
+        self.assertEqual(2, len(parts))
+        self.assertTrue(all(len(p) == 2 for p in parts))
+
+    def test_document_features_share_a_directory(self):
+        db = self._make_db()
+        self._write_documents(db, n=1, features=('a', 'b', 'c'))
+        directories = [d for d, _, files in os.walk(self._path) if files]
+        self.assertEqual(1, len(directories))
+
+    def test_can_read_value(self):
+        db = self._make_db()
+        key = self._key('id')
+        self._write(db, key)
+        with db.read_stream(key) as s:
+            self.assertEqual('text' + key, s.read())
+        self.assertEqual(len('text' + key), db.size(key))
+        self.assertIn(key, db)
+
+    def test_missing_value_raises_key_error(self):
+        db = self._make_db()
+        self.assertRaises(KeyError, lambda: db.read_stream(self._key('id')))
+        self.assertNotIn(self._key('id'), db)
+
+    def test_can_delete_value(self):
+        db = self._make_db()
+        key = self._key('id')
+        self._write(db, key)
+        del db[key]
+        self.assertNotIn(key, db)
+
+    def test_iter_ids(self):
+        db = self._make_db()
+        self._write_documents(db)
+        self.assertEqual(
+                sorted(str(i) for i in xrange(20)), sorted(db.iter_ids()))
+
+    def test_does_not_create_path_when_not_asked(self):
+        db = FileSystemDatabase(
+                path=self._path, key_builder=self._key_builder, levels=2)
+        self.assertRaises(
+                IOError, lambda: db.write_stream(self._key('id'), 'text/plain'))
+
+    def test_can_migrate_flat_database(self):
+        db = self._make_db(levels=0)
+        self._write_documents(db)
+        db.migrate(2)
+        self.assertEqual(2, db.levels)
+        self.assertEqual([], [
+            f for f in os.listdir(self._path)
+            if not os.path.isdir(os.path.join(self._path, f))])
+        db = self._make_db(levels=2)
+        self.assertEqual(
+                sorted(str(i) for i in xrange(20)), sorted(db.iter_ids()))
+        key = self._key('7', 'b')
+        with db.read_stream(key) as s:
+            self.assertEqual('text' + key, s.read())
+
+    def test_can_migrate_back_to_flat_database(self):
+        db = self._make_db(levels=2)
+        self._write_documents(db)
+        db.migrate(0)
+        self.assertEqual(40, len(os.listdir(self._path)))
+        self.assertEqual(
+                sorted(str(i) for i in xrange(20)), sorted(db.iter_ids()))
+
+    def test_can_migrate_between_depths(self):
+        db = self._make_db(levels=2)
+        self._write_documents(db)
+        db.migrate(1)
+        self.assertEqual(
+                sorted(str(i) for i in xrange(20)), sorted(db.iter_ids()))
+        for directory in os.listdir(self._path):
+            path = os.path.join(self._path, directory)
+            self.assertTrue(all(
+                not os.path.isdir(os.path.join(path, f))
+                for f in os.listdir(path)))
+
+    def test_can_finish_interrupted_migration(self):
+        db = self._make_db(levels=0)
+        self._write_documents(db)
+        moved = self._make_db(levels=2)
+        for i in xrange(5):
+            key = self._key(str(i), 'a')
+            directory = moved._directory(key)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            os.rename(
+                    os.path.join(self._path, key),
+                    os.path.join(directory, key))
+        db.migrate(2)
+        self.assertEqual(
+                sorted(str(i) for i in xrange(20)),
+                sorted(self._make_db(levels=2).iter_ids()))
@@ -0,0 +1,377 @@
+import unittest2
+import time
+from extractor import \
+    Node, Aggregator, Graph, NotEnoughData, SerialExecutor, QueueExecutor, \
+    ThreadPoolExecutor, _Edge
+
+
+class Chars(Node):
+    def __init__(self, chunksize=3, needs=None):
+        super(Chars, self).__init__(needs=needs)
+        self._chunksize = chunksize
+
+    def _process(self, data):
+        for i in xrange(0, len(data), self._chunksize):
+            yield data[i: i + self._chunksize]
+
+
+class Upper(Node):
+    def __init__(self, needs=None):
+        super(Upper, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data.upper()
+
+
+class Words(Node):
+    def __init__(self, needs=None):
+        super(Words, self).__init__(needs=needs)
+        self._cache = ''
+
+    def _enqueue(self, data, pusher):
+        self._cache += data
+
+    def _finalize(self, pusher):
+        self._cache += ' '
+
+    def _dequeue(self):
+        index = self._cache.rfind(' ')
+        if index == -1:
+            raise NotEnoughData()
+        current = self._cache[:index + 1]
+        self._cache = self._cache[index + 1:]
+        return current
+
+    def _process(self, data):
+        for word in data.split():
+            yield word
+
+
+class Join(Aggregator, Node):
+    def __init__(self, needs=None):
+        super(Join, self).__init__(needs=needs)
+        self._cache = []
+
+    def _enqueue(self, data, pusher):
+        self._cache.append(data)
+
+    def _process(self, data):
+        yield '|'.join(data)
+
+
+class Zip(Node):
+    def __init__(self, needs=None):
+        super(Zip, self).__init__(needs=needs)
+        self._cache = dict()
+
+    def _enqueue(self, data, pusher):
+        self._cache[id(pusher)] = data
+
+    def _dequeue(self):
+        if len(self._cache) < len(self._needs):
+            raise NotEnoughData()
+        v, self._cache = self._cache, dict()
+        return v
+
+    def _process(self, data):
+        yield ''.join(data[id(n)] for n in self._needs)
+
+
+class Collect(Node):
+    def __init__(self, needs=None):
+        super(Collect, self).__init__(needs=needs)
+        self.chunks = []
+
+    def _process(self, data):
+        self.chunks.append(data)
+        yield data
+
+    def _last_chunk(self):
+        self.chunks.append('<done>')
+        return iter(())
+
+
+class Broken(Node):
+    def __init__(self, needs=None):
+        super(Broken, self).__init__(needs=needs)
+
+    def _process(self, data):
+        raise ValueError(data)
+        yield data
+
+
+class Strict(Aggregator, Node):
+    """
+    An aggregator that fails loudly if it is asked for data before it's ready
+    """
+
+    def __init__(self, needs=None):
+        super(Strict, self).__init__(needs=needs)
+        self._cache = []
+
+    def _enqueue(self, data, pusher):
+        self._cache.append(data)
+
+    def _ready(self):
+        return super(Strict, self)._ready()
+
+    def _dequeue(self):
+        if not self._finalized:
+            raise AssertionError('_dequeue() called before _ready()')
+        return super(Strict, self)._dequeue()
+
+    def _process(self, data):
+        yield ''.join(data)
+
+
+class Slow(Node):
+    def __init__(self, needs=None):
+        super(Slow, self).__init__(needs=needs)
+
+    def _process(self, data):
+        time.sleep(0.001)
+        yield data
+
+
+def build_graph():
+    g = Graph()
+    g['left'] = Chars()
+    g['right'] = Chars(chunksize=3)
+    g['upper'] = Upper(needs=g['left'])
+    g['words'] = Words(needs=g['upper'])
+    g['joined'] = Join(needs=g['words'])
+    g['zipped'] = Zip(needs=[g['upper'], g['right']])
+    g['joined_sink'] = Collect(needs=g['joined'])
+    g['zipped_sink'] = Collect(needs=g['zipped'])
+    return g
+
+
+class GraphTests(unittest2.TestCase):
+    def test_topological_sort_places_dependencies_first(self):
+        g = build_graph()
+        order = g.topological_sort()
+        self.assertEqual(len(g), len(order))
+        for i, key in enumerate(order):
+            for n in g[key].needs:
+                dependency = [k for k, v in g.iteritems() if v is n][0]
+                self.assertLess(order.index(dependency), i)
+
+    def test_compile_returns_cached_plan(self):
+        g = build_graph()
+        self.assertIs(g.compile(), g.compile())
+
+    def test_modifying_graph_invalidates_compiled_plan(self):
+        g = build_graph()
+        plan = g.compile()
+        g['another'] = Upper(needs=g['joined'])
+        self.assertIsNot(plan, g.compile())
+        self.assertEqual(len(g), len(g.compile()))
+
+    def test_compile_raises_when_dependency_is_not_in_graph(self):
+        g = Graph()
+        g['upper'] = Upper(needs=Chars())
+        self.assertRaises(ValueError, lambda: g.compile())
+
+
+class ReadinessTests(unittest2.TestCase):
+    def test_default_readiness_is_reliable(self):
+        self.assertTrue(Upper._ready_is_reliable())
+
+    def test_aggregator_readiness_is_reliable(self):
+        self.assertTrue(Join._ready_is_reliable())
+
+    def test_readiness_is_unreliable_when_only_dequeue_is_overridden(self):
+        self.assertFalse(Words._ready_is_reliable())
+        self.assertFalse(Zip._ready_is_reliable())
+
+    def test_aggregator_is_not_ready_until_dependencies_are_finalized(self):
+        node = Join(needs=Chars())
+        node._enqueue('abc', None)
+        self.assertFalse(node._ready())
+
+    def test_compiled_plan_checks_readiness_before_dequeueing(self):
+        g = Graph()
+        g['chars'] = Chars(chunksize=1)
+        g['strict'] = Strict(needs=g['chars'])
+        g['sink'] = Collect(needs=g['strict'])
+        g.process(chars='abcdef')
+        self.assertEqual(['abcdef', '<done>'], g['sink'].chunks)
+
+
+class Tail(Node):
+    def __init__(self, needs=None):
+        super(Tail, self).__init__(needs=needs)
+        self.finalized = False
+
+    def _process(self, data):
+        yield data
+
+    def _finalize(self, pusher):
+        self.finalized = True
+
+    def _last_chunk(self):
+        yield '!'
+
+
+class FusionTests(unittest2.TestCase):
+    def _chain(self):
+        g = Graph()
+        g['chars'] = Chars()
+        g['upper'] = Upper(needs=g['chars'])
+        g['tail'] = Tail(needs=g['upper'])
+        g['sink'] = Collect(needs=g['tail'])
+        return g
+
+    def test_fuses_linear_chain_of_stateless_nodes(self):
+        g = self._chain()
+        self.assertEqual(['upper', 'tail', 'sink'], g.compile().fused)
+
+    def test_does_not_fuse_buffering_nodes(self):
+        g = build_graph()
+        fused = g.compile().fused
+        self.assertNotIn('words', fused)
+        self.assertNotIn('joined', fused)
+        self.assertNotIn('zipped', fused)
+        self.assertIn('upper', fused)
+
+    def test_fused_chain_preserves_last_chunk_and_finalize(self):
+        g = self._chain()
+        g.process(chars='abcdef')
+        self.assertEqual(['ABC', 'DEF', '!', '<done>'], g['sink'].chunks)
+        self.assertTrue(g['tail'].finalized)
+
+    def test_fused_node_keeps_its_other_listeners(self):
+        g = self._chain()
+        g['other'] = Collect(needs=g['upper'])
+        g.process(chars='abcdef')
+        self.assertIn('tail', g.compile().fused)
+        self.assertEqual(['ABC', 'DEF', '<done>'], g['other'].chunks)
+        self.assertEqual(['ABC', 'DEF', '!', '<done>'], g['sink'].chunks)
+
+    def test_can_disable_fusion_for_a_single_node(self):
+        g = self._chain()
+        g['tail'].fusable = False
+        self.assertEqual(['upper', 'sink'], g.compile().fused)
+        g.process(chars='abcdef')
+        self.assertEqual(['ABC', 'DEF', '!', '<done>'], g['sink'].chunks)
+
+    def test_profiled_plan_is_not_fused(self):
+        g = self._chain()
+        self.assertEqual([], g.compile(profile=True).fused)
+
+
+class BaseExecutorTest(object):
+    def _process(self, **kwargs):
+        g = build_graph()
+        g.executor = self.executor
+        g.process(**kwargs)
+        return g
+
+    def test_aggregates_all_input(self):
+        g = self._process(left='mary had a lamb', right='xxxxxxxxxxxxxxx')
+        self.assertEqual(
+                ['MARY|HAD|A|LAMB', '<done>'], g['joined_sink'].chunks)
+
+    def test_combines_chunks_from_multiple_roots(self):
+        g = self._process(left='abcdef', right='123456')
+        self.assertEqual(['ABC123', 'DEF456', '<done>'], g['zipped_sink'].chunks)
+
+    def test_raises_when_root_argument_is_missing(self):
+        self.assertRaises(KeyError, lambda: self._process(left='abcdef'))
+
+
+class SerialExecutorTests(BaseExecutorTest, unittest2.TestCase):
+    executor = SerialExecutor()
+
+
+class QueueExecutorTests(BaseExecutorTest, unittest2.TestCase):
+    executor = QueueExecutor()
+
+
+class ThreadPoolExecutorTests(BaseExecutorTest, unittest2.TestCase):
+    executor = ThreadPoolExecutor(workers=2)
+
+    def test_single_worker_processes_all_branches(self):
+        g = build_graph()
+        g.executor = ThreadPoolExecutor(workers=1)
+        g.process(left='abcdef', right='123456')
+        self.assertEqual(['ABC123', 'DEF456', '<done>'], g['zipped_sink'].chunks)
+        self.assertEqual(['ABCDEF', '<done>'], g['joined_sink'].chunks)
+
+    def test_preserves_chunk_order_within_each_branch(self):
+        g = Graph()
+        g['source'] = Chars(chunksize=1)
+        for i in xrange(4):
+            g['sink{i}'.format(i=i)] = Collect(needs=g['source'])
+        g.executor = self.executor
+        text = 'the quick brown fox jumped over the lazy dog'
+        g.process(source=text)
+        for i in xrange(4):
+            chunks = g['sink{i}'.format(i=i)].chunks
+            self.assertEqual(list(text) + ['<done>'], chunks)
+
+    def test_raises_exception_from_worker_thread(self):
+        g = build_graph()
+        g['broken'] = Broken(needs=g['upper'])
+        g.executor = self.executor
+        self.assertRaises(
+                ValueError, lambda: g.process(left='abcdef', right='123456'))
+
+    def test_raises_when_workers_is_less_than_one(self):
+        self.assertRaises(ValueError, lambda: ThreadPoolExecutor(workers=0))
+
+    def test_branches_share_no_nodes(self):
+        g = build_graph()
+        branches = g.compile().branches()
+        keys = [k for b in branches for k in b]
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(len(g) - 2, len(keys))
+
+
+class BackpressureTests(unittest2.TestCase):
+    def _process(self, executor, text='x' * 100):
+        g = Graph()
+        g['source'] = Chars(chunksize=4)
+        g['slow'] = Slow(needs=g['source'])
+        g['sink'] = Collect(needs=g['slow'])
+        g['other'] = Collect(needs=g['source'])
+        g.executor = executor
+        g.process(source=text)
+        return g
+
+    def test_chunk_budget_is_never_exceeded(self):
+        g = self._process(ThreadPoolExecutor(workers=2, max_chunks=2))
+        chunks, _ = g.high_water_marks[('source', 'slow')]
+        self.assertLessEqual(chunks, 2)
+        self.assertEqual(['xxxx'] * 25 + ['<done>'], g['sink'].chunks)
+
+    def test_byte_budget_is_never_exceeded(self):
+        g = self._process(ThreadPoolExecutor(workers=2, max_bytes=10))
+        _, nbytes = g.high_water_marks[('source', 'slow')]
+        self.assertLessEqual(nbytes, 10)
+        self.assertEqual(['xxxx'] * 25 + ['<done>'], g['sink'].chunks)
+
+    def test_can_set_budget_for_single_edge(self):
+        executor = ThreadPoolExecutor(
+                workers=2, budgets={('source', 'slow'): (1, None)})
+        g = self._process(executor)
+        chunks, _ = g.high_water_marks[('source', 'slow')]
+        self.assertEqual(1, chunks)
+
+    def test_executor_records_high_water_marks_across_graphs(self):
+        executor = ThreadPoolExecutor(workers=2, max_chunks=3)
+        self._process(executor)
+        self._process(executor)
+        self.assertEqual(
+                set([('source', 'slow'), ('source', 'other')]),
+                set(executor.high_water_marks))
+        for chunks, nbytes in executor.high_water_marks.itervalues():
+            self.assertLessEqual(chunks, 3)
+            self.assertLessEqual(nbytes, 12)
+
+    def test_chunk_larger_than_byte_budget_is_admitted_to_empty_edge(self):
+        edge = _Edge('a', 'b', max_bytes=10)
+        edge.acquire(100)
+        self.assertEqual((1, 100), (edge.peak_chunks, edge.peak_bytes))
+        edge.release(100)
+        self.assertEqual(0, edge.bytes)
@@ -4,9 +4,11 @@ import random
 from requests.exceptions import HTTPError
 import subprocess
 import sys
+import os
 import time
 
-from extractor import NotEnoughData, Aggregator, Node, InvalidProcessMethod
+from extractor import NotEnoughData, Aggregator, Node, InvalidProcessMethod, \
+    ThreadPoolExecutor
 from iteratornode import IteratorNode
 from model import BaseModel, NoPersistenceSettingsError
 from feature import Feature, JSONFeature, CompressedFeature
@@ -14,9 +16,14 @@ from data import *
 from bytestream import ByteStream, ByteStreamFeature
 from io import BytesIO
 from util import chunked
-from lmdbstore import LmdbDatabase
+from lmdbstore import LmdbDatabase, ShardedLmdbDatabase
+from sqlitestore import SqliteDatabase
+from segmentstore import SegmentDatabase
 from decoder import Decoder
+from encoder import BZ2Encoder
+import compression
 from persistence import PersistenceSettings
+from profiler import Profiler
 from tempfile import mkdtemp
 from shutil import rmtree
 import traceback
@@ -1194,6 +1201,361 @@ class BaseTest(object):
         self.assertTrue(_id in _ids1)
         self.assertTrue(_id in _ids2)
 
+    def test_can_process_branches_with_thread_pool_executor(self):
+        class D(BaseModel, self.Settings):
+            executor = ThreadPoolExecutor(workers=3)
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+            lowercase = Feature(ToLower, needs=stream, store=True)
+            words = Feature(Tokenizer, needs=stream, store=False)
+            count = JSONFeature(WordCount, needs=words, store=True)
+
+        _id = D.process(stream='humpty')
+        doc = D(_id)
+        self.assertEqual(data_source['humpty'].upper(), doc.uppercase.read())
+        self.assertEqual(data_source['humpty'].lower(), doc.lowercase.read())
+        self.assertEqual(2, doc.count['humpty'])
+
+    def test_keys_are_removed_when_thread_pool_executor_raises(self):
+        class D(BaseModel, self.Settings):
+            executor = ThreadPoolExecutor(workers=2)
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+            broken = Feature(Broken, needs=stream, store=True)
+
+        self.assertRaises(Exception, lambda: D.process(stream='humpty'))
+        self.assertEqual(0, len(list(self.Settings.database.iter_ids())))
+
+    def test_can_process_many_documents(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        names = ['mary', 'humpty', 'cased', 'lorem']
+        results = list(D.process_many(
+                [dict(stream=name) for name in names], workers=2))
+        self.assertEqual(range(len(names)), [r.index for r in results])
+        for name, result in zip(names, results):
+            self.assertIsNone(result.error)
+            self.assertEqual(dict(stream=name), result.kwargs)
+            doc = D(result._id)
+            self.assertEqual(data_source[name].upper(), doc.uppercase.read())
+        self.assertEqual(len(names), len(list(self.Settings.database)))
+
+    def test_process_many_reports_failures_without_aborting_batch(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        kwargs = [dict(stream='mary'), dict(stream=10), dict(stream='humpty')]
+        results = list(D.process_many(kwargs, workers=2))
+        self.assertIsNone(results[0].error)
+        self.assertIn('KeyError', results[1].error)
+        self.assertIsNone(results[2].error)
+        _ids = set(self.Settings.database.iter_ids())
+        self.assertEqual(set([results[0]._id, results[2]._id]), _ids)
+
+    def test_process_many_can_yield_documents_as_completed(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        names = ['mary', 'humpty', 'cased', 'lorem']
+        results = list(D.process_many(
+                [dict(stream=name) for name in names],
+                workers=3,
+                ordered=False))
+        self.assertEqual(set(range(len(names))), set(r.index for r in results))
+        for result in results:
+            self.assertEqual(
+                    data_source[names[result.index]],
+                    D(result._id).stream.read())
+
+    def test_can_process_many_documents_in_a_single_process(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        results = list(D.process_many(
+                [dict(stream='mary'), dict(stream='cased')], workers=1))
+        self.assertEqual(
+                data_source['cased'], D(results[1]._id).stream.read())
+
+    def test_can_profile_document_processing(self):
+        reports = []
+
+        class D(BaseModel, self.Settings):
+            profiler = Profiler(callback=reports.append)
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        D.process(stream='mary')
+        self.assertEqual(1, len(reports))
+        report = reports[0]
+        self.assertEqual(
+                len(data_source['mary']), report['uppercase_writer'].bytes_in)
+        self.assertEqual(
+                report['stream'].chunks_out, report['uppercase'].chunks_in)
+
+    def test_can_profile_lazy_computation_of_unstored_feature(self):
+        reports = []
+
+        class D(BaseModel, self.Settings):
+            profiler = Profiler(callback=reports.append)
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=False)
+
+        _id = D.process(stream='mary')
+        del reports[:]
+        doc = D(_id)
+        self.assertEqual(data_source['mary'].upper(), doc.uppercase.read())
+        self.assertEqual(1, len(reports))
+        self.assertIn('uppercase', reports[0].nodes)
+
+    def test_update_computes_only_missing_features(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        class B(A):
+            lowercase = Feature(ToLower, needs=A.stream, store=True)
+
+        _id = A.process(stream='mary')
+        # no raw input is needed, since the stream is read back from storage
+        self.assertEqual(['lowercase'], B.update(_id))
+        self.assertEqual(data_source['mary'].lower(), B(_id).lowercase.read())
+        self.assertEqual(data_source['mary'].upper(), B(_id).uppercase.read())
+
+    def test_update_computes_features_whose_version_has_changed(self):
+        class D1(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            timestamp = JSONFeature(
+                    TimestampEmitter, version='1', needs=stream, store=True)
+
+        class D2(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            timestamp = JSONFeature(
+                    TimestampEmitter, version='2', needs=stream, store=True)
+
+        _id = D1.process(stream='mary')
+        self.assertEqual(['timestamp'], D2.update(_id))
+        self.assertEqual('2', D2(_id).timestamp)
+
+    def test_update_does_nothing_when_document_is_up_to_date(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        _id = D.process(stream='mary')
+        self.assertEqual([], D.update(_id))
+
+    def test_update_computes_unstored_intermediate_features(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        class B(A):
+            lowercase = Feature(ToLower, needs=A.stream, store=False)
+            uppercase = Feature(ToUpper, needs=lowercase, store=True)
+
+        _id = A.process(stream='mary')
+        self.assertEqual(['uppercase'], B.update(_id))
+        self.assertEqual(data_source['mary'].upper(), B(_id).uppercase.read())
+
+    def test_update_requires_raw_input_when_root_feature_is_missing(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=False)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        class B(A):
+            lowercase = Feature(ToLower, needs=A.stream, store=True)
+
+        _id = A.process(stream='mary')
+        self.assertRaises(KeyError, lambda: B.update(_id))
+        self.assertEqual(['lowercase'], B.update(_id, stream='mary'))
+        self.assertEqual(data_source['mary'].lower(), B(_id).lowercase.read())
+
+    def test_failed_update_only_rolls_back_missing_features(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        class B(A):
+            lowercase = Feature(ToLower, needs=A.stream, store=True)
+            broken = Feature(Broken, needs=A.stream, store=True)
+
+        _id = A.process(stream='mary')
+        self.assertRaises(Exception, lambda: B.update(_id))
+        self.assertEqual(data_source['mary'], A(_id).stream.read())
+        key = B.key_builder.build(_id, 'lowercase', B.lowercase.version)
+        self.assertNotIn(key, B.database)
+
+    def test_can_update_many_documents(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        class B(A):
+            uppercase = Feature(ToUpper, needs=A.stream, store=True)
+
+        ids = [A.process(stream=k) for k in ('mary', 'humpty', 'cased')]
+        results = list(B.update_many(ids, workers=2))
+        self.assertEqual(ids, [r._id for r in results])
+        self.assertTrue(all(r.error is None for r in results))
+        for _id, k in zip(ids, ('mary', 'humpty', 'cased')):
+            self.assertEqual(data_source[k].upper(), B(_id).uppercase.read())
+
+    def test_update_many_updates_every_document_by_default(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        class B(A):
+            uppercase = Feature(ToUpper, needs=A.stream, store=True)
+
+        ids = [A.process(stream=k) for k in ('mary', 'humpty')]
+        results = list(B.update_many(workers=1))
+        self.assertEqual(set(ids), set(r._id for r in results))
+        for _id, k in zip(ids, ('mary', 'humpty')):
+            self.assertEqual(data_source[k].upper(), B(_id).uppercase.read())
+
+    def test_features_for_computes_shared_dependencies_once(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            counted = Feature(Counter, needs=stream, store=False)
+            uppercase = Feature(ToUpper, needs=counted, store=False)
+            lowercase = Feature(ToLower, needs=counted, store=False)
+
+        _id = D.process(stream='mary')
+        Counter.Count = 0
+        D(_id).uppercase.read()
+        single = Counter.Count
+
+        Counter.Count = 0
+        results = D.features_for(_id, ['uppercase', 'lowercase'])
+        self.assertEqual(single, Counter.Count)
+        self.assertEqual(data_source['mary'].upper(), results['uppercase'].read())
+        self.assertEqual(data_source['mary'].lower(), results['lowercase'].read())
+
+    def test_features_for_can_mix_stored_and_unstored_features(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=False)
+            words = Feature(Tokenizer, needs=stream, store=False)
+            count = JSONFeature(WordCount, needs=words, store=True)
+
+        _id = D.process(stream='mary')
+        results = D.features_for(_id, ['stream', 'uppercase', 'count'])
+        self.assertEqual(data_source['mary'], results['stream'].read())
+        self.assertEqual(data_source['mary'].upper(), results['uppercase'].read())
+        self.assertEqual(3, results['count']['lamb'])
+
+    def test_features_for_can_compute_feature_and_its_dependency(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = Feature(ToLower, needs=stream, store=False)
+            uppercase = Feature(ToUpper, needs=lowercase, store=False)
+
+        _id = D.process(stream='mary')
+        results = D.features_for(_id, ['uppercase', 'lowercase'])
+        self.assertEqual(data_source['mary'].upper(), results['uppercase'].read())
+        self.assertEqual(data_source['mary'].lower(), results['lowercase'].read())
+
+    def test_features_for_raises_when_feature_cannot_be_computed(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=False)
+            uppercase = Feature(ToUpper, needs=stream, store=False)
+            lowercase = Feature(ToLower, needs=stream, store=True)
+
+        _id = D.process(stream='mary')
+        self.assertRaises(
+                AttributeError,
+                lambda: D.features_for(_id, ['lowercase', 'uppercase']))
+
+    def test_fetch_many_reads_stored_feature(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            words = Feature(Tokenizer, needs=stream, store=False)
+            count = JSONFeature(WordCount, needs=words, store=True)
+
+        keys = ['mary', 'humpty', 'cased']
+        ids = [D.process(stream=k) for k in keys]
+        results = list(D.fetch_many(ids, 'count'))
+        self.assertEqual(ids, [_id for _id, _ in results])
+        for k, (_id, count) in zip(keys, results):
+            self.assertEqual(D(_id).count, count)
+
+    def test_fetch_many_computes_unstored_feature(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=False)
+
+        keys = ['mary', 'humpty']
+        ids = [D.process(stream=k) for k in keys]
+        results = list(D.fetch_many(ids, 'uppercase'))
+        for k, (_id, uppercase) in zip(keys, results):
+            self.assertEqual(data_source[k].upper(), uppercase.read())
+
+    def test_fetch_many_computes_missing_stored_feature(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        class B(A):
+            uppercase = Feature(ToUpper, needs=A.stream, store=True)
+
+        first = A.process(stream='mary')
+        second = B.process(stream='humpty')
+        results = dict(B.fetch_many([first, second], 'uppercase'))
+        self.assertEqual(
+                data_source['mary'].upper(), results[first].read())
+        self.assertEqual(
+                data_source['humpty'].upper(), results[second].read())
+
+    def test_materialize_caches_features_on_document(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            counted = Feature(Counter, needs=stream, store=False)
+            uppercase = Feature(ToUpper, needs=counted, store=False)
+            lowercase = Feature(ToLower, needs=counted, store=False)
+
+        _id = D.process(stream='mary')
+        doc = D(_id)
+        results = doc.materialize(['uppercase', 'lowercase'])
+        Counter.Count = 0
+        self.assertIs(results['uppercase'], doc.uppercase)
+        self.assertIs(results['lowercase'], doc.lowercase)
+        self.assertEqual(0, Counter.Count)
+        self.assertEqual(data_source['mary'].lower(), doc.lowercase.read())
+
+    def test_graph_template_is_built_once_per_model(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        D.process(stream='mary')
+        template = D._graph_template()
+        D.process(stream='humpty')
+        self.assertIs(template, D._graph_template())
+
+    def test_graph_template_omits_dead_features(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = Feature(ToLower, needs=stream, store=False)
+            uppercase = Feature(ToUpper, needs=lowercase, store=True)
+            unused = Feature(ToLower, needs=uppercase, store=False)
+
+        graph = D._build_extractor('id')
+        self.assertIn('lowercase', graph)
+        self.assertNotIn('unused', graph)
+        self.assertNotIn('lowercase_writer', graph)
+        self.assertEqual(len(D._graph_template()), len(graph))
+
+    def test_derived_model_has_its_own_graph_template(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+
+        class B(A):
+            uppercase = Feature(ToUpper, needs=A.stream, store=True)
+
+        A.process(stream='mary')
+        _id = B.process(stream='mary')
+        self.assertIsNot(A._graph_template(), B._graph_template())
+        self.assertEqual(data_source['mary'].upper(), B(_id).uppercase.read())
+
     def test_can_use_bz2_compression_encoder_and_decoder(self):
         class A(BaseModel, self.Settings):
             stream = Feature(TextStream, store=True)
@@ -1209,6 +1571,68 @@ class BaseTest(object):
         doc = A(_id)
         self.assertEqual(data_source['lorem'].lower(), ''.join(doc.lowercase))
 
+    def test_can_use_zlib_compression_codec(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = CompressedFeature(
+                    ToLower, needs=stream, store=True, codec='zlib', level=1)
+
+        _id = A.process(stream='lorem')
+        db = self.Settings.database
+        key_builder = self.Settings.key_builder
+        stream = db.read_stream(
+                key_builder.build(_id, 'lowercase', A.lowercase.version))
+        compressed = stream.read()
+        self.assertTrue(compressed.startswith(compression.HEADER_PREFIX))
+        self.assertTrue(len(compressed) < len(data_source['lorem']))
+        doc = A(_id)
+        self.assertEqual(data_source['lorem'].lower(), ''.join(doc.lowercase))
+
+    @unittest2.skipIf(compression.lzma is None, 'lzma is not installed')
+    def test_can_use_lzma_compression_codec(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = CompressedFeature(
+                    ToLower, needs=stream, store=True, codec='lzma')
+
+        _id = A.process(stream='lorem')
+        doc = A(_id)
+        self.assertEqual(data_source['lorem'].lower(), ''.join(doc.lowercase))
+
+    def test_unknown_compression_codec_raises(self):
+        self.assertRaises(
+                ValueError,
+                lambda: CompressedFeature(ToLower, codec='unknown'))
+
+    def test_can_read_values_compressed_with_another_codec(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = CompressedFeature(
+                    ToLower, needs=stream, store=True, codec='zlib')
+
+        class B(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = CompressedFeature(
+                    ToLower, needs=stream, store=True, codec='bz2')
+
+        _id = A.process(stream='lorem')
+        doc = B(_id)
+        self.assertEqual(data_source['lorem'].lower(), ''.join(doc.lowercase))
+
+    def test_can_read_bz2_values_written_without_codec_header(self):
+        class A(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = Feature(
+                    ToLower, needs=stream, store=True, encoder=BZ2Encoder)
+
+        class B(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            lowercase = CompressedFeature(ToLower, needs=stream, store=True)
+
+        _id = A.process(stream='lorem')
+        doc = B(_id)
+        self.assertEqual(data_source['lorem'].lower(), ''.join(doc.lowercase))
+
 
 class InMemoryTest(BaseTest, unittest2.TestCase):
     def setUp(self):
@@ -1220,6 +1644,136 @@ class InMemoryTest(BaseTest, unittest2.TestCase):
         self.Settings = Settings
 
 
+class LruTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = LruDatabase(
+                    100,
+                    spill=FileSystemDatabase(
+                            path=self._dir, key_builder=key_builder),
+                    key_builder=key_builder)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
+class CachedTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = CachedDatabase(
+                    LruDatabase(100, key_builder=key_builder),
+                    FileSystemDatabase(path=self._dir, key_builder=key_builder))
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
+class CachedWriteBackTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = CachedDatabase(
+                    FileSystemDatabase(
+                            path=os.path.join(self._dir, 'front'),
+                            key_builder=key_builder,
+                            createdirs=True),
+                    FileSystemDatabase(
+                            path=os.path.join(self._dir, 'back'),
+                            key_builder=key_builder,
+                            createdirs=True),
+                    write_back=True)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+    def test_process_many_writes_every_value_to_back(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, store=True)
+            uppercase = Feature(ToUpper, needs=stream, store=True)
+
+        names = ['mary', 'humpty']
+        results = list(D.process_many(
+                [dict(stream=name) for name in names], workers=2))
+        self.assertTrue(all(r.error is None for r in results))
+        back = self.Settings.database.back
+        self.assertEqual(
+                sorted(r._id for r in results), sorted(back.iter_ids()))
+
+
+class CachedLmdbTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = CachedDatabase(
+                    LmdbDatabase(
+                            path=os.path.join(self._dir, 'front'),
+                            map_size=10000000,
+                            key_builder=key_builder),
+                    LmdbDatabase(
+                            path=os.path.join(self._dir, 'back'),
+                            map_size=10000000,
+                            key_builder=key_builder))
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
+class SqliteTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = SqliteDatabase(
+                    os.path.join(self._dir, 'features.db'),
+                    chunk_size=100,
+                    key_builder=key_builder)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
+class SegmentTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = SegmentDatabase(
+                    self._dir, segment_size=1000, key_builder=key_builder)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
 class FileSystemTest(BaseTest, unittest2.TestCase):
     def setUp(self):
         self._dir = mkdtemp()
@@ -1236,6 +1790,22 @@ class FileSystemTest(BaseTest, unittest2.TestCase):
         rmtree(self._dir)
 
 
+class MappedFileSystemTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = FileSystemDatabase(
+                    path=self._dir, key_builder=key_builder, mmap=True)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
 class LmdbTest(BaseTest, unittest2.TestCase):
     def setUp(self):
         self._dir = mkdtemp()
@@ -1252,3 +1822,73 @@ class LmdbTest(BaseTest, unittest2.TestCase):
 
     def tearDown(self):
         rmtree(self._dir)
+
+
+class LmdbGroupCommitTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = LmdbDatabase(
+                    path=self._dir,
+                    map_size=10000000,
+                    key_builder=key_builder,
+                    group_commit=1)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+
+class LmdbGroupCommitMapGrowthTest(unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = LmdbDatabase(
+                    path=self._dir,
+                    map_size=100000,
+                    key_builder=key_builder,
+                    group_commit=4)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
+
+    def test_process_many_stores_every_document_reported_successful(self):
+        class D(BaseModel, self.Settings):
+            stream = Feature(TextStream, chunksize=1000, store=True)
+
+        values = [os.urandom(3000) for _ in xrange(18)]
+        results = list(D.process_many(
+                [dict(stream=value) for value in values], workers=1))
+        self.assertTrue(all(r.error is None for r in results))
+        for value, result in zip(values, results):
+            self.assertEqual(value, D(result._id).stream.read())
+        self.assertGreater(
+                self.Settings.database.env.info()['map_size'], 100000)
+
+
+class ShardedLmdbTest(BaseTest, unittest2.TestCase):
+    def setUp(self):
+        self._dir = mkdtemp()
+
+        class Settings(PersistenceSettings):
+            id_provider = UuidProvider()
+            key_builder = StringDelimitedKeyBuilder()
+            database = ShardedLmdbDatabase(
+                    path=self._dir,
+                    shards=3,
+                    map_size=10000000,
+                    key_builder=key_builder)
+
+        self.Settings = Settings
+
+    def tearDown(self):
+        rmtree(self._dir)
@@ -1,9 +1,14 @@
 import unittest2
-from lmdbstore import LmdbDatabase
+from lmdbstore import \
+    LmdbDatabase, ShardedLmdbDatabase, ChunkedReadStream
 from uuid import uuid4
 from data import StringDelimitedKeyBuilder
 import shutil
+import threading
+import subprocess
+import sys
 import os
+import lmdb
 
 
 class LmdbDatabaseTests(unittest2.TestCase):
@@ -71,4 +76,805 @@ class LmdbDatabaseTests(unittest2.TestCase):
         _ids = list(self.db.iter_ids())
         self.assertEqual(0, len(_ids))
 
+    def test_can_read_buffer_without_copying(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.seek(100)
+            buf = rs.read_buffer(100)
+            self.assertIsInstance(buf, buffer)
+            self.assertEqual(self.value[100:200], buf[:])
+            self.assertEqual(200, rs.tell())
+
+    def test_cannot_read_from_closed_stream(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            pass
+        self.assertTrue(rs.closed)
+        self.assertRaises(ValueError, lambda: rs.read())
+
+    def test_open_stream_is_unaffected_by_subsequent_writes(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            del self.db[self.key]
+            for i in xrange(10):
+                key = self.key_builder.build(str(i), 'feature', 'version')
+                with self.db.write_stream(key, 'application/octet-stream') as ws:
+                    ws.write(os.urandom(1000))
+            self.assertEqual(self.value, rs.read())
+        self.assertNotIn(self.key, self.db)
+
+    def write_ids(self, *ids, **kwargs):
+        feature = kwargs.get('feature', 'feature')
+        for _id in ids:
+            key = self.key_builder.build(_id, feature, 'version')
+            with self.db.write_stream(key, 'application/octet-stream') as ws:
+                ws.write(self.value)
+
+    def test_iter_ids_includes_documents_missing_some_features(self):
+        self.write_ids('a', 'b', feature='first')
+        self.write_ids('c', feature='second')
+        self.assertEqual(['a', 'b', 'c'], list(self.db.iter_ids()))
+
+    def test_iter_ids_yields_ids_in_sorted_order(self):
+        self.write_ids('c', 'a', 'd', 'b')
+        self.assertEqual(['a', 'b', 'c', 'd'], list(self.db.iter_ids()))
+
+    def test_iter_ids_can_resume_from_id(self):
+        self.write_ids('a', 'b', 'c', 'd')
+        self.assertEqual(['c', 'd'], list(self.db.iter_ids(start='c')))
+
+    def test_iter_ids_can_resume_from_missing_id(self):
+        self.write_ids('a', 'b', 'd')
+        self.assertEqual(['d'], list(self.db.iter_ids(start='c')))
+        self.assertEqual([], list(self.db.iter_ids(start='e')))
+
+    def test_count(self):
+        self.write_ids('a', 'b', feature='first')
+        self.write_ids('b', 'c', feature='second')
+        self.assertEqual(3, self.db.count())
+
+    def test_count_of_empty_database(self):
+        self.assertEqual(0, self.db.count())
+
+    def test_overwriting_value_does_not_add_id_twice(self):
+        self.write_ids('a')
+        self.write_ids('a')
+        del self.db[self.key_builder.build('a', 'feature', 'version')]
+        self.assertEqual(0, self.db.count())
+        self.assertEqual([], list(self.db.iter_ids()))
+
+    def test_id_remains_until_all_its_values_are_deleted(self):
+        self.write_ids('a', feature='first')
+        self.write_ids('a', feature='second')
+        del self.db[self.key_builder.build('a', 'first', 'version')]
+        self.assertEqual(['a'], list(self.db.iter_ids()))
+        del self.db[self.key_builder.build('a', 'second', 'version')]
+        self.assertEqual([], list(self.db.iter_ids()))
+
+    def test_id_index_is_built_for_existing_database(self):
+        self.write_ids('a', 'b', feature='first')
+        self.write_ids('b', 'c', feature='second')
+        with self.db.env.begin(write=True) as txn:
+            txn.drop(self.db.ids_db, delete=False)
+        self.db.env.close()
+        self.init_database()
+        self.assertEqual(['a', 'b', 'c'], list(self.db.iter_ids()))
+        del self.db[self.key_builder.build('b', 'first', 'version')]
+        self.assertEqual(3, self.db.count())
+
+
+class ChunkedLmdbDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{dir}'.format(dir=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.db = LmdbDatabase(
+                self.path, key_builder=self.key_builder, chunk_size=64)
+        self.value = os.urandom(1000)
+        self.key = self.key_builder.build('id', 'feature', 'version')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write_key(self, value=None, key=None):
+        value = self.value if value is None else value
+        with self.db.write_stream(
+                key or self.key, 'application/octet-stream') as ws:
+            for i in xrange(0, len(value), 100):
+                ws.write(value[i: i + 100])
+
+    def stored_chunks(self):
+        with self.db.env.begin() as txn:
+            return txn.stat(self.db.chunks_db)['entries']
+
+    def test_large_value_is_stored_in_chunks(self):
+        self.write_key()
+        self.assertEqual(16, self.stored_chunks())
+        with self.db.read_stream(self.key) as rs:
+            self.assertIsInstance(rs, ChunkedReadStream)
+            self.assertEqual(self.value, rs.read())
+
+    def test_can_read_many_chunked_values(self):
+        other = self.key_builder.build('id2', 'feature', 'version')
+        self.write_key()
+        self.write_key(self.value[:10], key=other)
+        streams = [s for _, s in self.db.read_many([self.key, other])]
+        self.assertIsInstance(streams[0], ChunkedReadStream)
+        self.assertEqual(self.value, streams[0].read())
+        self.assertEqual(self.value[:10], streams[1].read())
+
+    def test_small_value_is_stored_in_a_single_record(self):
+        self.write_key(self.value[:64])
+        self.assertEqual(0, self.stored_chunks())
+        with self.db.read_stream(self.key) as rs:
+            self.assertNotIsInstance(rs, ChunkedReadStream)
+            self.assertEqual(self.value[:64], rs.read())
+
+    def test_chunks_are_written_before_stream_is_closed(self):
+        ws = self.db.write_stream(self.key, 'application/octet-stream')
+        ws.write(self.value[:500])
+        self.assertEqual(7, self.stored_chunks())
+        self.assertNotIn(self.key, self.db)
+        ws.write(self.value[500:])
+        ws.close()
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_can_seek_and_read_across_chunk_boundaries(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.seek(50)
+            self.assertEqual(self.value[50:250], rs.read(200))
+            rs.seek(-10, os.SEEK_END)
+            self.assertEqual(self.value[-10:], rs.read(100))
+            self.assertEqual('', rs.read(100))
+
+    def test_read_within_a_chunk_is_not_copied(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.seek(64)
+            buf = rs.read_buffer(64)
+            self.assertIsInstance(buf, buffer)
+            self.assertEqual(self.value[64:128], buf[:])
+
+    def test_size_of_chunked_value(self):
+        self.write_key()
+        self.assertEqual(1000, self.db.size(self.key))
+
+    def test_overwriting_chunked_value_removes_old_chunks(self):
+        self.write_key()
+        self.write_key(self.value[:10])
+        self.assertEqual(0, self.stored_chunks())
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual(self.value[:10], rs.read())
+
+    def test_open_stream_is_unaffected_by_overwriting_chunked_value(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            self.write_key(os.urandom(1000))
+            self.assertEqual(self.value, rs.read())
+
+    def test_detached_stream_reads_remaining_chunks(self):
+        self.write_key()
+        other = self.key_builder.build('id2', 'feature', 'version')
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual(self.value[:100], rs.read(100))
+            self.write_key(key=other)
+            self.assertIn(other, self.db)
+            self.assertIsNone(rs.txn)
+            self.assertEqual(self.value[100:], rs.read())
+
+    def test_detached_stream_of_overwritten_value_raises(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.read(10)
+            self.write_key(os.urandom(1000))
+            self.assertIn(self.key, self.db)
+            self.assertRaises(IOError, rs.read)
+
+    def test_deleting_chunked_value_removes_chunks(self):
+        self.write_key()
+        del self.db[self.key]
+        self.assertNotIn(self.key, self.db)
+        self.assertEqual(0, self.stored_chunks())
+
+    def test_chunks_are_not_listed_as_ids(self):
+        self.write_key()
+        self.write_key(key=self.key_builder.build('id2', 'feature', 'version'))
+        self.db.env.close()
+        self.db = LmdbDatabase(
+                self.path, key_builder=self.key_builder, chunk_size=64)
+        self.assertEqual(['id', 'id2'], sorted(self.db.iter_ids()))
+
+
+class LmdbTransactionTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{dir}'.format(dir=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.init_database()
+        self.value = os.urandom(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def init_database(self, group_commit=None):
+        try:
+            self.db.env.close()
+        except AttributeError:
+            pass
+        self.db = LmdbDatabase(
+                self.path,
+                key_builder=self.key_builder,
+                chunk_size=64,
+                group_commit=group_commit)
+
+    def key(self, _id, feature='feature'):
+        return self.key_builder.build(_id, feature, 'version')
+
+    def write_key(self, key):
+        with self.db.write_stream(key, 'application/octet-stream') as ws:
+            for i in xrange(0, len(self.value), 100):
+                ws.write(self.value[i: i + 100])
+
+    def write_document(self, _id, features=('a', 'b')):
+        with self.db.transaction():
+            for feature in features:
+                self.write_key(self.key(_id, feature))
+
+    def stored_chunks(self):
+        with self.db.env.begin() as txn:
+            return txn.stat(self.db.chunks_db)['entries']
+
+    def test_writes_are_not_visible_until_transaction_ends(self):
+        with self.db.transaction():
+            self.write_key(self.key('id', 'a'))
+            self.write_key(self.key('id', 'b'))
+            self.assertNotIn(self.key('id', 'a'), self.db)
+        self.assertIn(self.key('id', 'a'), self.db)
+        with self.db.read_stream(self.key('id', 'b')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_failed_transaction_writes_nothing(self):
+        def fail():
+            with self.db.transaction():
+                self.write_key(self.key('id', 'a'))
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertNotIn(self.key('id', 'a'), self.db)
+        self.assertEqual(0, self.stored_chunks())
+        self.assertEqual(0, len(list(self.db.iter_ids())))
+
+    def test_chunks_are_written_before_transaction_ends(self):
+        with self.db.transaction():
+            self.write_key(self.key('id', 'a'))
+            self.assertEqual(16, self.stored_chunks())
+            self.assertNotIn(self.key('id', 'a'), self.db)
+        with self.db.read_stream(self.key('id', 'a')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_failed_transaction_deletes_only_its_own_chunks(self):
+        self.write_document('id1')
+
+        def fail():
+            with self.db.transaction():
+                self.write_key(self.key('id2', 'a'))
+                self.write_key(self.key('id2', 'b'))
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(32, self.stored_chunks())
+        with self.db.read_stream(self.key('id1', 'b')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_failed_transaction_leaves_existing_values_intact(self):
+        self.write_document('id')
+
+        def fail():
+            with self.db.transaction():
+                del self.db[self.key('id', 'a')]
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        with self.db.read_stream(self.key('id', 'a')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_streams_written_from_other_threads_join_transaction(self):
+        with self.db.transaction():
+            streams = [
+                self.db.write_stream(
+                        self.key('id', feature), 'application/octet-stream')
+                for feature in ('a', 'b', 'c')]
+
+            def write(ws):
+                ws.write(self.value)
+                ws.close()
+
+            threads = [
+                threading.Thread(target=write, args=(ws,)) for ws in streams]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertNotIn(self.key('id', 'a'), self.db)
+        for feature in ('a', 'b', 'c'):
+            with self.db.read_stream(self.key('id', feature)) as rs:
+                self.assertEqual(self.value, rs.read())
+
+    def test_document_does_not_hold_write_lock_while_in_progress(self):
+        written = threading.Event()
 
+        def write_other_document():
+            self.write_document('other')
+            written.set()
+
+        with self.db.transaction():
+            self.write_key(self.key('id', 'a'))
+            thread = threading.Thread(target=write_other_document)
+            thread.start()
+            self.assertTrue(written.wait(5))
+        thread.join()
+        self.assertEqual(['id', 'other'], list(self.db.iter_ids()))
+
+    def test_group_commit_batches_documents(self):
+        self.init_database(group_commit=3)
+        self.write_document('id1')
+        self.write_document('id2')
+        self.assertEqual(0, len(list(self.db.iter_ids())))
+        self.write_document('id3')
+        self.assertEqual(
+                ['id1', 'id2', 'id3'], sorted(self.db.iter_ids()))
+
+    def test_commit_writes_partial_group(self):
+        self.init_database(group_commit=3)
+        self.write_document('id1')
+        self.db.commit()
+        with self.db.read_stream(self.key('id1', 'a')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_failed_document_in_group_is_discarded_alone(self):
+        self.init_database(group_commit=3)
+        self.write_document('id1')
+
+        def fail():
+            with self.db.transaction():
+                self.write_key(self.key('id2', 'a'))
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.write_document('id3')
+        self.db.commit()
+        self.assertEqual(['id1', 'id3'], sorted(self.db.iter_ids()))
+        self.assertEqual(64, self.stored_chunks())
+
+    def test_group_commit_database_is_not_process_safe(self):
+        self.init_database(group_commit=3)
+        self.assertFalse(self.db.process_safe)
+
+
+class LmdbEnvironmentTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{dir}'.format(dir=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.db = None
+        self.value = os.urandom(10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def init_database(self, **kwargs):
+        if self.db is not None:
+            self.db.env.close()
+        self.db = LmdbDatabase(
+                self.path, key_builder=self.key_builder, **kwargs)
+        return self.db
+
+    def key(self, _id, feature='feature'):
+        return self.key_builder.build(_id, feature, 'version')
+
+    def write_key(self, key):
+        with self.db.write_stream(key, 'application/octet-stream') as ws:
+            ws.write(self.value)
+
+    def write_keys(self, n):
+        for i in xrange(n):
+            self.write_key(self.key(str(i)))
+
+    def test_map_grows_when_full(self):
+        self.init_database(map_size=2 ** 16)
+        self.write_keys(50)
+        self.assertEqual(50, self.db.count())
+        self.assertGreater(self.db.env.info()['map_size'], 2 ** 16)
+        with self.db.read_stream(self.key('49')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_map_does_not_grow_beyond_max_map_size(self):
+        self.init_database(map_size=2 ** 16, max_map_size=2 ** 18)
+        self.assertRaises(lmdb.MapFullError, lambda: self.write_keys(50))
+        self.assertEqual(2 ** 18, self.db.env.info()['map_size'])
+
+    def test_map_does_not_grow_when_growth_is_disabled(self):
+        self.init_database(map_size=2 ** 16, map_growth=None)
+        self.assertRaises(lmdb.MapFullError, lambda: self.write_keys(50))
+        self.assertEqual(2 ** 16, self.db.env.info()['map_size'])
+
+    def test_map_does_not_grow_while_buffers_are_handed_out(self):
+        self.init_database(map_size=2 ** 16)
+        self.write_keys(1)
+        with self.db.read_stream(self.key('0')) as rs:
+            buf = rs.read_buffer()
+            self.assertRaises(lmdb.MapFullError, lambda: self.write_keys(50))
+            self.assertEqual(self.value, buf[:])
+        self.write_keys(50)
+        self.assertEqual(50, self.db.count())
+
+    def test_map_grows_while_stream_is_open(self):
+        self.init_database(map_size=2 ** 16)
+        self.write_keys(1)
+        with self.db.read_stream(self.key('0')) as rs:
+            self.write_keys(50)
+            self.assertEqual(self.value, rs.read())
+        self.assertEqual(50, self.db.count())
+
+    def test_document_that_fills_map_is_retried_once_map_grows(self):
+        self.init_database(map_size=2 ** 16)
+        with self.db.transaction():
+            self.write_keys(50)
+        self.assertEqual(50, self.db.count())
+        self.assertGreater(self.db.env.info()['map_size'], 2 ** 16)
+
+    def test_document_that_fills_batch_is_retried_once_map_grows(self):
+        self.init_database(map_size=2 ** 16, group_commit=10)
+        for i in xrange(4):
+            with self.db.transaction():
+                for j in xrange(5):
+                    self.write_key(self.key('{i}-{j}'.format(**locals())))
+        self.db.commit()
+        self.assertEqual(20, self.db.count())
+        self.assertGreater(self.db.env.info()['map_size'], 2 ** 16)
+
+    def test_batch_that_fills_map_when_committed_is_written_once_map_grows(
+            self):
+        self.init_database(map_size=100000, group_commit=4)
+        self.value = os.urandom(3000)
+        for i in xrange(16):
+            with self.db.transaction():
+                self.write_key(self.key(str(i)))
+        self.db.commit()
+        self.assertEqual(16, self.db.count())
+        self.assertGreater(self.db.env.info()['map_size'], 100000)
+        for i in xrange(16):
+            with self.db.read_stream(self.key(str(i))) as rs:
+                self.assertEqual(self.value, rs.read())
+
+    def test_document_that_cannot_fit_in_map_fails(self):
+        self.init_database(map_size=2 ** 16, max_map_size=2 ** 18)
+
+        def write_document():
+            with self.db.transaction():
+                self.write_keys(50)
+
+        self.assertRaises(lmdb.MapFullError, write_document)
+        self.assertEqual(0, self.db.count())
+        self.assertEqual(2 ** 18, self.db.env.info()['map_size'])
+
+    def test_adopts_map_grown_by_another_process(self):
+        self.init_database(map_size=2 ** 20)
+        self.write_keys(1)
+        script = '\n'.join([
+            'import lmdb, os',
+            'env = lmdb.open({path!r}, map_size=2 ** 24, max_dbs=128)',
+            'db = env.open_db("other")',
+            'with env.begin(write=True) as txn:',
+            '    for i in xrange(200):',
+            '        txn.put(str(i), os.urandom(10000), db=db)'
+        ]).format(path=self.path)
+        subprocess.check_call([sys.executable, '-c', script])
+        with self.db.read_stream(self.key('0')) as rs:
+            self.assertEqual(self.value, rs.read())
+        self.write_key(self.key('1'))
+        self.assertEqual(2, self.db.count())
+
+    def test_can_store_many_features(self):
+        self.init_database()
+        for i in xrange(50):
+            self.write_key(self.key('id', 'feature{i}'.format(**locals())))
+        self.assertEqual(['id'], list(self.db.iter_ids()))
+
+    def test_can_read_from_readonly_database(self):
+        self.init_database()
+        self.write_keys(3)
+        self.init_database(readonly=True)
+        self.assertEqual(['0', '1', '2'], list(self.db.iter_ids()))
+        with self.db.read_stream(self.key('1')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_can_list_ids_of_readonly_database_without_id_index(self):
+        self.init_database()
+        for _id in ('b', 'a', 'c'):
+            self.write_key(self.key(_id, feature='first'))
+        self.write_key(self.key('b', feature='second'))
+        with self.db.env.begin(write=True) as txn:
+            txn.drop(self.db.ids_db, delete=True)
+        self.init_database(readonly=True)
+        self.assertIsNone(self.db.ids_db)
+        self.assertEqual(['a', 'b', 'c'], list(self.db.iter_ids()))
+        self.assertEqual(['b', 'c'], list(self.db.iter_ids(start='ab')))
+        self.assertEqual(3, self.db.count())
+        self.assertIn(self.key('a', feature='first'), self.db)
+
+    def test_cannot_write_to_readonly_database(self):
+        self.init_database()
+        self.write_keys(1)
+        self.init_database(readonly=True)
+        self.assertRaises(
+                lmdb.ReadonlyError, lambda: self.write_key(self.key('1')))
+
+    def test_readonly_database_without_locking(self):
+        self.init_database()
+        self.write_keys(3)
+        self.init_database(readonly=True, lock=False)
+        self.assertEqual(3, self.db.count())
+        with self.db.read_stream(self.key('2')) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_max_readers(self):
+        self.init_database(max_readers=4)
+        self.assertEqual(4, self.db.env.max_readers())
+
+
+class ShardedLmdbDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{dir}'.format(dir=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.db = ShardedLmdbDatabase(
+                self.path, shards=4, key_builder=self.key_builder)
+        self.value = os.urandom(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def key(self, _id, feature='feature'):
+        return self.key_builder.build(_id, feature, 'version')
+
+    def write_key(self, key):
+        with self.db.write_stream(key, 'application/octet-stream') as ws:
+            ws.write(self.value)
+
+    def write_keys(self, n):
+        for i in xrange(n):
+            self.write_key(self.key(str(i)))
+
+    def test_documents_are_spread_across_shards(self):
+        self.write_keys(100)
+        counts = [shard.count() for shard in self.db.shards]
+        self.assertEqual(100, sum(counts))
+        self.assertTrue(all(counts))
+
+    def test_document_features_are_stored_in_the_same_shard(self):
+        self.write_key(self.key('id', 'a'))
+        self.write_key(self.key('id', 'b'))
+        counts = sorted(shard.count() for shard in self.db.shards)
+        self.assertEqual([0, 0, 0, 1], counts)
+
+    def test_can_read_value(self):
+        self.write_keys(10)
+        with self.db.read_stream(self.key('7')) as rs:
+            self.assertEqual(self.value, rs.read())
+        self.assertEqual(1000, self.db.size(self.key('7')))
+
+    def test_contains_and_delete(self):
+        self.write_keys(10)
+        self.assertIn(self.key('3'), self.db)
+        del self.db[self.key('3')]
+        self.assertNotIn(self.key('3'), self.db)
+        self.assertEqual(9, self.db.count())
+
+    def test_read_many_across_shards(self):
+        self.write_keys(20)
+        keys = [self.key(str(i)) for i in (19, 3, 7, 3)] + [self.key('x')]
+        results = list(self.db.read_many(keys))
+        self.assertEqual(keys, [k for k, _ in results])
+        for _, stream in results[:-1]:
+            self.assertEqual(self.value, stream.read())
+        self.assertIsNone(results[-1][1])
+
+    def test_iter_ids_merges_shards_in_sorted_order(self):
+        self.write_keys(100)
+        expected = sorted(str(i) for i in xrange(100))
+        self.assertEqual(expected, list(self.db.iter_ids()))
+        self.assertEqual(
+                [_id for _id in expected if _id >= '50'],
+                list(self.db.iter_ids(start='50')))
+
+    def test_failed_transaction_writes_nothing(self):
+        def fail():
+            with self.db.transaction():
+                self.write_key(self.key('a'))
+                self.write_key(self.key('b'))
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(0, self.db.count())
+
+    def test_transaction_commits_to_each_shard_touched(self):
+        with self.db.transaction():
+            self.write_keys(20)
+        self.assertEqual(20, self.db.count())
+
+    def test_can_reopen_with_same_number_of_shards(self):
+        self.write_keys(10)
+        for shard in self.db.shards:
+            shard.env.close()
+        self.db = ShardedLmdbDatabase(
+                self.path, shards=4, key_builder=self.key_builder)
+        self.assertEqual(10, self.db.count())
+
+    def test_cannot_reopen_with_different_number_of_shards(self):
+        self.write_keys(10)
+        self.assertRaises(ValueError, lambda: ShardedLmdbDatabase(
+                self.path, shards=3, key_builder=self.key_builder))
+
+
+class LmdbReadTransactionTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{dir}'.format(dir=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.db = LmdbDatabase(self.path, key_builder=self.key_builder)
+        self.value = os.urandom(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def key(self, _id, feature='feature'):
+        return self.key_builder.build(_id, feature, 'version')
+
+    def write_key(self, key):
+        with self.db.write_stream(key, 'application/octet-stream') as ws:
+            ws.write(self.value)
+
+    def test_lookups_share_a_transaction(self):
+        self.write_key(self.key('a'))
+        self.write_key(self.key('b'))
+        self.assertIn(self.key('a'), self.db)
+        self.assertEqual(1000, self.db.size(self.key('b')))
+        with self.db.read_stream(self.key('a')) as rs1:
+            with self.db.read_stream(self.key('b')) as rs2:
+                self.assertIs(rs1.txn, rs2.txn)
+                self.assertEqual(1, len(self.db._readers))
+
+    def test_threads_have_their_own_transactions(self):
+        self.write_key(self.key('a'))
+        streams = []
+
+        def read():
+            streams.append(self.db.read_stream(self.key('a')))
+
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+        with self.db.read_stream(self.key('a')) as rs:
+            self.assertIsNot(rs.txn, streams[0].txn)
+        streams[0].close()
+
+    def test_writes_are_visible_to_subsequent_lookups(self):
+        self.write_key(self.key('a'))
+        self.assertNotIn(self.key('b'), self.db)
+        self.write_key(self.key('b'))
+        self.assertIn(self.key('b'), self.db)
+        del self.db[self.key('a')]
+        self.assertNotIn(self.key('a'), self.db)
+
+    def test_writes_by_another_process_are_visible(self):
+        self.write_key(self.key('a'))
+        self.assertNotIn(self.key('b'), self.db)
+        script = '\n'.join([
+            'import lmdb',
+            'env = lmdb.open({path!r}, max_dbs=128)',
+            'db = env.open_db("feature")',
+            'with env.begin(write=True) as txn:',
+            '    txn.put("b:version", "value", db=db)'
+        ]).format(path=self.path)
+        subprocess.check_call([sys.executable, '-c', script])
+        self.assertIn(self.key('b'), self.db)
+
+    def test_transaction_is_released_once_replaced_and_unused(self):
+        self.write_key(self.key('a'))
+        rs = self.db.read_stream(self.key('a'))
+        buf = rs.read_buffer()
+        self.write_key(self.key('b'))
+        self.assertIn(self.key('b'), self.db)
+        self.assertEqual(2, len(self.db._readers))
+        self.assertEqual(self.value, buf[:])
+        rs.close()
+        self.assertEqual(1, len(self.db._readers))
+
+    def test_stream_is_detached_once_its_transaction_is_replaced(self):
+        self.write_key(self.key('a'))
+        rs = self.db.read_stream(self.key('a'))
+        rs.read(10)
+        self.write_key(self.key('b'))
+        self.assertIn(self.key('b'), self.db)
+        self.assertEqual(1, len(self.db._readers))
+        self.assertIsNone(rs.txn)
+        self.assertEqual(self.value[10:], rs.read())
+
+    def test_kept_streams_do_not_use_up_readers(self):
+        # max_readers is fixed when the environment is created
+        self.db.env.close()
+        shutil.rmtree(self.path)
+        self.db = LmdbDatabase(
+                self.path, key_builder=self.key_builder, max_readers=16)
+        streams = []
+        for i in xrange(50):
+            self.write_key(self.key(str(i)))
+            streams.append(self.db.read_stream(self.key(str(i))))
+        for stream in streams:
+            self.assertEqual(self.value, stream.read())
+
+    def test_transaction_is_released_once_unclosed_stream_is_collected(self):
+        self.write_key(self.key('a'))
+        rs = self.db.read_stream(self.key('a'))
+        rs.read_buffer()
+        self.write_key(self.key('b'))
+        self.assertIn(self.key('b'), self.db)
+        del rs
+        self.assertEqual(1, len(self.db._readers))
+
+    def test_read_many_returns_streams_in_order(self):
+        for _id in ('c', 'a', 'b'):
+            self.write_key(self.key(_id))
+        keys = [self.key(_id) for _id in ('b', 'missing', 'c', 'a')]
+        results = list(self.db.read_many(keys))
+        self.assertEqual(keys, [k for k, _ in results])
+        self.assertIsNone(results[1][1])
+        for _, stream in results[:1] + results[2:]:
+            self.assertEqual(self.value, stream.read())
+
+    def test_read_many_across_features(self):
+        self.write_key(self.key('a', 'x'))
+        self.write_key(self.key('a', 'y'))
+        keys = [self.key('a', 'y'), self.key('a', 'z'), self.key('a', 'x')]
+        streams = [s for _, s in self.db.read_many(keys)]
+        self.assertEqual(self.value, streams[0].read())
+        self.assertIsNone(streams[1])
+        self.assertEqual(self.value, streams[2].read())
+
+    def test_read_many_shares_a_transaction(self):
+        self.write_key(self.key('a'))
+        self.write_key(self.key('b'))
+        streams = [s for _, s in self.db.read_many(
+                [self.key('a'), self.key('b')])]
+        self.assertIs(streams[0].txn, streams[1].txn)
+        self.assertEqual(1, len(self.db._readers))
+
+    def test_read_many_streams_release_transaction(self):
+        self.write_key(self.key('a'))
+        self.write_key(self.key('b'))
+        _, streams = zip(*self.db.read_many([self.key('a'), self.key('b')]))
+        for stream in streams:
+            stream.read_buffer()
+        self.write_key(self.key('c'))
+        self.assertIn(self.key('c'), self.db)
+        self.assertEqual(2, len(self.db._readers))
+        streams[0].close()
+        self.assertEqual(2, len(self.db._readers))
+        del streams, stream
+        self.assertEqual(1, len(self.db._readers))
+
+    def test_read_many_with_duplicate_keys(self):
+        self.write_key(self.key('a'))
+        streams = [s for _, s in self.db.read_many(
+                [self.key('a'), self.key('a')])]
+        self.assertIsNot(streams[0], streams[1])
+        self.assertEqual(self.value, streams[0].read())
+        self.assertEqual(self.value, streams[1].read())
+
+    def test_map_grows_after_lookups(self):
+        self.db.env.close()
+        self.db = LmdbDatabase(
+                self.path, key_builder=self.key_builder, map_size=2 ** 16)
+        for i in xrange(100):
+            key = self.key(str(i))
+            self.write_key(key)
+            self.assertIn(key, self.db)
+        self.assertEqual(100, self.db.count())
@@ -2,7 +2,8 @@ import unittest2
 
 try:
     import numpy as np
-    from nmpy import NumpyFeature, StreamingNumpyDecoder, PackedNumpyEncoder
+    from nmpy import NumpyFeature, StreamingNumpyDecoder, PackedNumpyEncoder, \
+        GreedyNumpyDecoder, _PinnedArray
 except ImportError:
     np = None
 
@@ -41,9 +42,9 @@ class BaseNumpyTest(object):
         self.assertEqual(shape, arr.shape)
         self.assertEqual(dtype, arr.dtype)
 
-    def _build_doc(self):
+    def _build_doc(self, **kwargs):
         class Doc(BaseModel, self.Settings):
-            feat = NumpyFeature(PassThrough, store=True)
+            feat = NumpyFeature(PassThrough, store=True, **kwargs)
             packed = NumpyFeature(
                     PassThrough,
                     needs=feat,
@@ -111,6 +112,38 @@ class GreedyNumpyOnDiskTest(BaseNumpyTest, unittest2.TestCase):
         rmtree(self._dir)
 
 
+class GreedyNumpyMappedTest(GreedyNumpyOnDiskTest):
+    def _register_database(self, settings_class):
+        self._dir = mkdtemp()
+        return settings_class.clone(database=FileSystemDatabase(
+            path=self._dir,
+            key_builder=settings_class.key_builder,
+            mmap=True))
+
+    def test_decoded_array_is_copied_by_default(self):
+        cls = self._build_doc()
+        _id = cls.process(feat=np.zeros((10, 3)))
+        recovered = cls(_id).feat
+        self.assertNotIsInstance(recovered.base, _PinnedArray)
+
+    def test_zero_copy_decoded_array_is_not_copied(self):
+        cls = self._build_doc(decoder=GreedyNumpyDecoder(zero_copy=True))
+        _id = cls.process(feat=np.zeros((10, 3)))
+        recovered = cls(_id).feat
+        self.assertIsInstance(recovered.base, _PinnedArray)
+
+    def test_decoded_array_survives_subsequent_writes(self):
+        cls = self._build_doc(decoder=GreedyNumpyDecoder(zero_copy=True))
+        arr = np.arange(300, dtype=np.float32).reshape((100, 3))
+        _id = cls.process(feat=arr)
+        recovered = cls(_id).feat
+        key = self.Settings.key_builder.build(_id, 'feat', cls.feat.version)
+        with self.Settings.database.write_stream(key, 'text/plain') as s:
+            s.write('')
+        del self.Settings.database[key]
+        self.assertTrue(np.all(arr == recovered))
+
+
 class GreedyNumpyLmdbTest(BaseNumpyTest, unittest2.TestCase):
     def _register_database(self, settings_class):
         self._dir = mkdtemp()
@@ -122,6 +155,46 @@ class GreedyNumpyLmdbTest(BaseNumpyTest, unittest2.TestCase):
     def tearDown(self):
         rmtree(self._dir)
 
+    def test_decoded_array_is_copied_by_default(self):
+        cls = self._build_doc()
+        _id = cls.process(feat=np.zeros((10, 3)))
+        recovered = cls(_id).feat
+        self.assertNotIsInstance(recovered.base, _PinnedArray)
+
+    def test_zero_copy_decoded_array_is_not_copied(self):
+        cls = self._build_doc(decoder=GreedyNumpyDecoder(zero_copy=True))
+        _id = cls.process(feat=np.zeros((10, 3)))
+        recovered = cls(_id).feat
+        self.assertIsInstance(recovered.base, _PinnedArray)
+
+    def test_decoded_array_survives_subsequent_writes(self):
+        cls = self._build_doc(decoder=GreedyNumpyDecoder(zero_copy=True))
+        arr = np.arange(300, dtype=np.float32).reshape((100, 3))
+        _id = cls.process(feat=arr)
+        recovered = cls(_id).feat
+        key = self.Settings.key_builder.build(_id, 'feat', cls.feat.version)
+        del self.Settings.database[key]
+        for _ in xrange(10):
+            cls.process(feat=np.random.random_sample((100, 3)))
+        self.assertTrue(np.all(arr == recovered))
+
+    def test_kept_arrays_do_not_use_up_readers(self):
+        # max_readers is fixed when the environment is created
+        self.Settings.database.env.close()
+        rmtree(self._dir)
+        self.Settings.database = LmdbDatabase(
+            path=self._dir,
+            map_size=10000000,
+            max_readers=16,
+            key_builder=self.Settings.key_builder)
+        cls = self._build_doc()
+        kept = []
+        for i in xrange(30):
+            _id = cls.process(feat=np.zeros((10, 3)) + i)
+            kept.append(cls(_id).feat)
+        for i, arr in enumerate(kept):
+            self.assertTrue(np.all(arr == i))
+
 
 class StreamingNumpyTest(BaseNumpyTest, unittest2.TestCase):
     def _register_database(self, settings_class):
@@ -176,6 +249,15 @@ class StreamingNumpyOnDiskTest(BaseNumpyTest, unittest2.TestCase):
         return np.concatenate(list(data))
 
 
+class StreamingNumpyMappedTest(StreamingNumpyOnDiskTest):
+    def _register_database(self, settings_class):
+        self._dir = mkdtemp()
+        return settings_class.clone(database=FileSystemDatabase(
+            path=self._dir,
+            key_builder=settings_class.key_builder,
+            mmap=True))
+
+
 class StreamingNumpyLmdbTest(BaseNumpyTest, unittest2.TestCase):
     def _register_database(self, settings_class):
         self._dir = mkdtemp()
@@ -204,3 +286,23 @@ class StreamingNumpyLmdbTest(BaseNumpyTest, unittest2.TestCase):
 
     def _restore(self, data):
         return np.concatenate(list(data))
+
+
+class GreedyNumpyChunkedLmdbTest(GreedyNumpyLmdbTest):
+    def _register_database(self, settings_class):
+        self._dir = mkdtemp()
+        return settings_class.clone(database=LmdbDatabase(
+            path=self._dir,
+            map_size=10000000,
+            chunk_size=100,
+            key_builder=settings_class.key_builder))
+
+
+class StreamingNumpyChunkedLmdbTest(StreamingNumpyLmdbTest):
+    def _register_database(self, settings_class):
+        self._dir = mkdtemp()
+        return settings_class.clone(database=LmdbDatabase(
+            path=self._dir,
+            map_size=10000000,
+            chunk_size=100,
+            key_builder=settings_class.key_builder))
@@ -0,0 +1,131 @@
+import unittest2
+from extractor import \
+    Node, Aggregator, Graph, ThreadPoolExecutor, QueueExecutor
+from profiler import Profiler, GraphReport, NodeStats
+
+
+class Chars(Node):
+    def __init__(self, needs=None):
+        super(Chars, self).__init__(needs=needs)
+
+    def _process(self, data):
+        for c in data:
+            yield c
+
+
+class Upper(Node):
+    def __init__(self, needs=None):
+        super(Upper, self).__init__(needs=needs)
+
+    def _process(self, data):
+        yield data.upper()
+
+
+class Join(Aggregator, Node):
+    def __init__(self, needs=None):
+        super(Join, self).__init__(needs=needs)
+        self._cache = []
+
+    def _enqueue(self, data, pusher):
+        self._cache.append(data)
+
+    def _process(self, data):
+        yield ''.join(data)
+
+    def _last_chunk(self):
+        yield '!'
+
+
+def build_graph(profiler, executor=None):
+    g = Graph()
+    g['chars'] = Chars()
+    g['upper'] = Upper(needs=g['chars'])
+    g['joined'] = Join(needs=g['upper'])
+    g.profiler = profiler
+    if executor is not None:
+        g.executor = executor
+    return g
+
+
+class ProfilerTests(unittest2.TestCase):
+    def test_always_samples_by_default(self):
+        self.assertTrue(all(Profiler().sample() for _ in xrange(100)))
+
+    def test_never_samples_with_sample_rate_of_zero(self):
+        profiler = Profiler(sample_rate=0)
+        self.assertFalse(any(profiler.sample() for _ in xrange(100)))
+
+    def test_unsampled_run_returns_no_report(self):
+        reports = []
+        g = build_graph(Profiler(sample_rate=0, callback=reports.append))
+        self.assertIsNone(g.process(chars='abc'))
+        self.assertEqual([], reports)
+
+    def test_graph_without_profiler_returns_no_report(self):
+        g = build_graph(None)
+        self.assertIsNone(g.process(chars='abc'))
+
+    def test_report_is_passed_to_callback(self):
+        reports = []
+        g = build_graph(Profiler(callback=reports.append))
+        report = g.process(chars='abc')
+        self.assertEqual([report], reports)
+
+    def test_report_includes_every_node(self):
+        g = build_graph(Profiler())
+        report = g.process(chars='abc')
+        self.assertEqual(3, len(report))
+        self.assertEqual(set(g.keys()), set(report.nodes.keys()))
+
+    def test_counts_chunks_and_bytes(self):
+        report = build_graph(Profiler()).process(chars='abcd')
+        self.assertEqual(4, report['chars'].chunks_out)
+        self.assertEqual(4, report['upper'].chunks_in)
+        self.assertEqual(4, report['upper'].bytes_out)
+        self.assertEqual(4, report['joined'].chunks_in)
+        self.assertEqual(2, report['joined'].chunks_out)
+        self.assertEqual(5, report['joined'].bytes_out)
+
+    def test_counts_stalls(self):
+        report = build_graph(Profiler()).process(chars='abcd')
+        self.assertEqual(4, report['joined'].stalls)
+        self.assertEqual(0, report['upper'].stalls)
+
+    def test_records_process_time(self):
+        report = build_graph(Profiler()).process(chars='abcd')
+        self.assertTrue(all(s.process_time >= 0 for s in report))
+        self.assertLessEqual(report.process_time, report.wall_time)
+
+    def test_profiles_graph_run_by_thread_pool_executor(self):
+        g = build_graph(Profiler(), ThreadPoolExecutor(workers=2))
+        report = g.process(chars='abcd')
+        self.assertEqual(4, report['chars'].chunks_out)
+        self.assertEqual(4, report['upper'].chunks_in)
+        self.assertEqual(2, report['joined'].chunks_out)
+
+    def test_graph_run_by_queue_executor_cannot_be_profiled(self):
+        g = build_graph(Profiler(), QueueExecutor())
+        self.assertRaises(ValueError, lambda: g.process(chars='abcd'))
+
+    def test_unsampled_graph_run_by_queue_executor_cannot_be_profiled(self):
+        g = build_graph(Profiler(sample_rate=0), QueueExecutor())
+        self.assertRaises(ValueError, lambda: g.process(chars='abcd'))
+
+
+class GraphReportTests(unittest2.TestCase):
+    def _stats(self, key, process_time):
+        stats = NodeStats(key, Upper())
+        stats.process_time = process_time
+        return stats
+
+    def test_iterates_in_descending_order_of_process_time(self):
+        report = GraphReport(
+                [self._stats('a', 1), self._stats('b', 3), self._stats('c', 2)],
+                10)
+        self.assertEqual(['b', 'c', 'a'], [s.key for s in report])
+
+    def test_can_format_report_as_table(self):
+        report = GraphReport([self._stats('a', 1)], 10)
+        text = str(report)
+        self.assertIn('Upper', text)
+        self.assertIn('wall time', text)
@@ -0,0 +1,199 @@
+import unittest2
+from segmentstore import \
+    SegmentDatabase, CorruptSegmentError, INDEX_FILE, _segment_name
+from uuid import uuid4
+from data import StringDelimitedKeyBuilder
+import shutil
+import os
+
+
+class SegmentDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{dir}'.format(dir=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.init_database()
+        self.value = os.urandom(1000)
+        self.key = self.key_builder.build('id', 'feature', 'version')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def init_database(self, **kwargs):
+        self.db = SegmentDatabase(
+                self.path, key_builder=self.key_builder, **kwargs)
+
+    def write_key(self, key=None, value=None):
+        with self.db.write_stream(
+                key or self.key, 'application/octet-stream') as ws:
+            ws.write(self.value if value is None else value)
+
+    def write_ids(self, *ids, **kwargs):
+        feature = kwargs.get('feature', 'feature')
+        for _id in ids:
+            self.write_key(self.key_builder.build(_id, feature, 'version'))
+
+    def read_key(self, key=None):
+        with self.db.read_stream(key or self.key) as rs:
+            return rs.read()
+
+    def segments(self):
+        return sorted(
+                f for f in os.listdir(self.path) if f.startswith('segment'))
+
+    def test_can_read_value(self):
+        self.write_key()
+        self.assertEqual(self.value, self.read_key())
+        self.assertEqual(1000, self.db.size(self.key))
+        self.assertIn(self.key, self.db)
+
+    def test_can_read_empty_value(self):
+        self.write_key(value='')
+        self.assertEqual('', self.read_key())
+        self.assertEqual(0, self.db.size(self.key))
+
+    def test_can_read_buffer_without_copying(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.seek(100)
+            buf = rs.read_buffer(100)
+            self.assertIsInstance(buf, buffer)
+            self.assertEqual(self.value[100:200], buf[:])
+
+    def test_missing_value_raises_key_error(self):
+        self.assertRaises(KeyError, lambda: self.db.read_stream(self.key))
+        self.assertRaises(KeyError, lambda: self.db.size(self.key))
+        self.assertNotIn(self.key, self.db)
+
+    def test_can_overwrite_value(self):
+        self.write_key()
+        self.write_key(value='value')
+        self.assertEqual('value', self.read_key())
+
+    def test_values_share_a_segment(self):
+        self.write_ids(*[str(i) for i in xrange(100)])
+        self.assertEqual([_segment_name(0)], self.segments())
+
+    def test_begins_new_segment_when_current_one_is_full(self):
+        self.init_database(segment_size=2500)
+        self.write_ids(*[str(i) for i in xrange(10)])
+        self.assertEqual(4, len(self.segments()))
+        for i in xrange(10):
+            key = self.key_builder.build(str(i), 'feature', 'version')
+            self.assertEqual(self.value, self.read_key(key))
+
+    def test_can_delete_value(self):
+        self.write_key()
+        del self.db[self.key]
+        self.assertNotIn(self.key, self.db)
+        self.assertEqual([], list(self.db.iter_ids()))
+
+    def test_deleting_missing_value_raises_key_error(self):
+        def delete():
+            del self.db[self.key]
+
+        self.assertRaises(KeyError, delete)
+
+    def test_iter_ids_yields_each_id_once_in_sorted_order(self):
+        self.write_ids('c', 'a', 'b', feature='first')
+        self.write_ids('b', 'd', feature='second')
+        self.assertEqual(['a', 'b', 'c', 'd'], list(self.db.iter_ids()))
+        self.assertEqual(4, self.db.count())
+
+    def test_index_is_rebuilt_from_segments(self):
+        self.write_ids('a', 'b', 'c')
+        self.write_key(value='value')
+        del self.db[self.key_builder.build('b', 'feature', 'version')]
+        self.init_database()
+        self.assertEqual(['a', 'c', 'id'], list(self.db.iter_ids()))
+        self.assertEqual('value', self.read_key())
+
+    def test_saved_index_is_used_with_later_records(self):
+        self.write_ids('a', 'b')
+        self.db.commit()
+        self.assertTrue(os.path.exists(os.path.join(self.path, INDEX_FILE)))
+        self.write_ids('c')
+        del self.db[self.key_builder.build('a', 'feature', 'version')]
+        self.init_database()
+        self.assertEqual(['b', 'c'], list(self.db.iter_ids()))
+
+    def test_transaction_is_written_at_once(self):
+        with self.db.transaction():
+            self.write_ids('a', 'b')
+            self.write_key(value='value')
+            self.assertEqual('value', self.read_key())
+            self.assertEqual(0, os.path.getsize(
+                    os.path.join(self.path, _segment_name(0))))
+        self.assertEqual(['a', 'b', 'id'], list(self.db.iter_ids()))
+
+    def test_failed_transaction_writes_nothing(self):
+        def write():
+            with self.db.transaction():
+                self.write_ids('a', 'b')
+                raise ValueError()
+
+        self.assertRaises(ValueError, write)
+        self.assertEqual([], list(self.db.iter_ids()))
+        self.init_database()
+        self.assertEqual([], list(self.db.iter_ids()))
+
+    def test_delete_within_transaction(self):
+        self.write_key()
+        with self.db.transaction():
+            del self.db[self.key]
+            self.assertNotIn(self.key, self.db)
+            self.assertIn(self.key, self.db._index)
+        self.assertNotIn(self.key, self.db)
+
+    def test_partially_written_batch_is_discarded(self):
+        self.write_ids('a')
+        with self.db.transaction():
+            self.write_ids('b', 'c')
+        path = os.path.join(self.path, _segment_name(0))
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 10)
+        self.init_database()
+        self.assertEqual(['a'], list(self.db.iter_ids()))
+        self.write_ids('d')
+        self.init_database()
+        self.assertEqual(['a', 'd'], list(self.db.iter_ids()))
+
+    def test_corrupt_earlier_segment_raises(self):
+        self.init_database(segment_size=2500)
+        self.write_ids(*[str(i) for i in xrange(10)])
+        path = os.path.join(self.path, _segment_name(0))
+        with open(path, 'r+b') as f:
+            f.seek(100)
+            f.write('garbage')
+        self.assertRaises(CorruptSegmentError, self.init_database)
+
+    def test_compaction_reclaims_space(self):
+        self.init_database(segment_size=2500)
+        self.write_ids(*[str(i) for i in xrange(10)])
+        for i in xrange(5):
+            del self.db[self.key_builder.build(str(i), 'feature', 'version')]
+        self.write_ids('9')
+        before = self.segments()
+        self.db.compact()
+        after = self.segments()
+        self.assertFalse(set(before) & set(after))
+        self.assertEqual(2, len(after))
+        self.assertEqual(
+                ['5', '6', '7', '8', '9'], list(self.db.iter_ids()))
+        for i in xrange(5, 10):
+            key = self.key_builder.build(str(i), 'feature', 'version')
+            self.assertEqual(self.value, self.read_key(key))
+
+    def test_compacted_database_can_be_reopened(self):
+        self.write_ids('a', 'b')
+        del self.db[self.key_builder.build('a', 'feature', 'version')]
+        self.db.compact()
+        self.write_ids('c')
+        self.init_database()
+        self.assertEqual(['b', 'c'], list(self.db.iter_ids()))
+
+    def test_buffer_outlives_compaction(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            buf = rs.read_buffer()
+        self.db.compact()
+        self.assertEqual(self.value, buf[:])
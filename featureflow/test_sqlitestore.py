@@ -0,0 +1,229 @@
+import unittest2
+from sqlitestore import SqliteDatabase, ReadStream
+from uuid import uuid4
+from data import StringDelimitedKeyBuilder
+import threading
+import subprocess
+import sys
+import os
+
+
+class SqliteDatabaseTests(unittest2.TestCase):
+    def setUp(self):
+        self.path = '/tmp/{name}.db'.format(name=uuid4().hex)
+        self.key_builder = StringDelimitedKeyBuilder()
+        self.init_database()
+        self.value = os.urandom(1000)
+        self.key = self.key_builder.build('id', 'feature', 'version')
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path + suffix)
+            except OSError:
+                pass
+
+    def init_database(self, **kwargs):
+        self.db = SqliteDatabase(
+                self.path, key_builder=self.key_builder, **kwargs)
+
+    def write_key(self, key=None, value=None):
+        with self.db.write_stream(
+                key or self.key, 'application/octet-stream') as ws:
+            ws.write(self.value if value is None else value)
+
+    def write_ids(self, *ids, **kwargs):
+        feature = kwargs.get('feature', 'feature')
+        for _id in ids:
+            self.write_key(self.key_builder.build(_id, feature, 'version'))
+
+    def test_uses_write_ahead_log(self):
+        mode, = self.db._connection().execute(
+                'PRAGMA journal_mode').fetchone()
+        self.assertEqual('wal', mode)
+
+    def test_can_read_value(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            self.assertIsInstance(rs, ReadStream)
+            self.assertEqual(self.value, rs.read())
+
+    def test_can_read_value_after_reopening(self):
+        self.write_key()
+        self.init_database()
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_can_read_empty_value(self):
+        self.write_key(value='')
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual('', rs.read())
+        self.assertEqual(0, self.db.size(self.key))
+
+    def test_can_overwrite_value(self):
+        self.write_key()
+        self.write_key(value='value')
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual('value', rs.read())
+        self.assertEqual(5, self.db.size(self.key))
+
+    def test_missing_value_raises_key_error(self):
+        self.assertRaises(KeyError, lambda: self.db.read_stream(self.key))
+        self.assertRaises(KeyError, lambda: self.db.size(self.key))
+        self.assertNotIn(self.key, self.db)
+
+    def test_size(self):
+        self.write_key()
+        self.assertEqual(1000, self.db.size(self.key))
+
+    def test_can_seek(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.read(100)
+            rs.seek(100, os.SEEK_CUR)
+            self.assertEqual(200, rs.tell())
+            self.assertEqual(self.value[200:300], rs.read(100))
+            rs.seek(-100, os.SEEK_END)
+            self.assertEqual(self.value[-100:], rs.read())
+            rs.seek(0)
+            self.assertEqual(self.value[:100], rs.read(100))
+
+    def test_invalid_seek_argument_raises(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            self.assertRaises(IOError, lambda: rs.seek(0, 999))
+
+    def test_cannot_read_from_closed_stream(self):
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            pass
+        self.assertRaises(ValueError, lambda: rs.read())
+
+    def test_can_read_value_spanning_many_chunks(self):
+        self.init_database(chunk_size=64)
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual(self.value[:10], rs.read(10))
+            self.assertEqual(self.value[10:500], rs.read(490))
+            self.assertEqual(self.value[500:], rs.read())
+            rs.seek(63)
+            self.assertEqual(self.value[63:65], rs.read(2))
+
+    def test_stored_chunks(self):
+        self.init_database(chunk_size=64)
+        self.write_key()
+        n, = self.db._connection().execute(
+                'SELECT COUNT(*) FROM chunks').fetchone()
+        self.assertEqual(16, n)
+
+    def test_value_keeps_chunk_size_it_was_written_with(self):
+        self.init_database(chunk_size=64)
+        self.write_key()
+        self.init_database(chunk_size=100)
+        with self.db.read_stream(self.key) as rs:
+            self.assertEqual(self.value, rs.read())
+
+    def test_overwritten_chunks_are_not_mixed(self):
+        self.init_database(chunk_size=64)
+        self.write_key()
+        with self.db.read_stream(self.key) as rs:
+            rs.read(10)
+            self.write_key(value=os.urandom(1000))
+            self.assertRaises(IOError, lambda: rs.read())
+
+    def test_can_delete_value(self):
+        self.init_database(chunk_size=64)
+        self.write_key()
+        del self.db[self.key]
+        self.assertNotIn(self.key, self.db)
+        n, = self.db._connection().execute(
+                'SELECT COUNT(*) FROM chunks').fetchone()
+        self.assertEqual(0, n)
+
+    def test_deleting_missing_value_raises_key_error(self):
+        def delete():
+            del self.db[self.key]
+
+        self.assertRaises(KeyError, delete)
+
+    def test_can_iterate_over_empty_database(self):
+        self.assertEqual([], list(self.db.iter_ids()))
+        self.assertEqual(0, self.db.count())
+
+    def test_iter_ids_yields_each_id_once_in_sorted_order(self):
+        self.write_ids('c', 'a', 'b', feature='first')
+        self.write_ids('b', 'd', feature='second')
+        self.assertEqual(['a', 'b', 'c', 'd'], list(self.db.iter_ids()))
+        self.assertEqual(4, self.db.count())
+
+    def test_transaction_commits_all_values_at_once(self):
+        with self.db.transaction():
+            self.write_ids('a', 'b')
+            other = []
+            thread = threading.Thread(
+                    target=lambda: other.extend(self.db.iter_ids()))
+            thread.start()
+            thread.join()
+            self.assertEqual([], other)
+            self.assertEqual([], list(self.db.iter_ids()))
+        self.assertEqual(['a', 'b'], list(self.db.iter_ids()))
+
+    def test_transaction_does_not_hold_write_lock_until_it_ends(self):
+        self.init_database(timeout=0)
+        errors = []
+
+        def write_other():
+            try:
+                self.write_ids('b')
+            except Exception as e:
+                errors.append(e)
+
+        with self.db.transaction():
+            self.write_ids('a')
+            thread = threading.Thread(target=write_other)
+            thread.start()
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(['a', 'b'], list(self.db.iter_ids()))
+
+    def test_can_delete_value_within_transaction(self):
+        self.write_key()
+        with self.db.transaction():
+            del self.db[self.key]
+            self.assertRaises(KeyError, lambda: self.db.__delitem__(self.key))
+        self.assertNotIn(self.key, self.db)
+
+    def test_failed_transaction_discards_all_values(self):
+        def write():
+            with self.db.transaction():
+                self.write_ids('a', 'b')
+                raise ValueError()
+
+        self.assertRaises(ValueError, write)
+        self.assertEqual([], list(self.db.iter_ids()))
+
+    def test_nested_transactions_are_part_of_the_outer_one(self):
+        def write():
+            with self.db.transaction():
+                with self.db.transaction():
+                    self.write_ids('a')
+                raise ValueError()
+
+        self.assertRaises(ValueError, write)
+        self.assertEqual([], list(self.db.iter_ids()))
+
+    def test_readers_are_not_blocked_by_writer(self):
+        self.write_ids('a')
+        script = '\n'.join([
+            'from sqlitestore import SqliteDatabase',
+            'from data import StringDelimitedKeyBuilder',
+            'db = SqliteDatabase({path!r}, '
+            'key_builder=StringDelimitedKeyBuilder(), timeout=0)',
+            'print list(db.iter_ids())'
+        ]).format(path=self.path)
+        with self.db.transaction():
+            self.write_ids('b')
+            output = subprocess.check_output(
+                    [sys.executable, '-c', script],
+                    cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual("['a']", output.strip())
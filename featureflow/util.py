@@ -6,3 +6,17 @@ def chunked(f, chunksize=4096):
         data = f.read(chunksize)
 
 
+def nbytes(data):
+    """
+    Best-effort size, in bytes, of a chunk of data passed between nodes.
+    Chunks that aren't arrays or strings are counted as zero bytes
+    """
+    try:
+        return data.nbytes
+    except AttributeError:
+        pass
+
+    if isinstance(data, (basestring, bytearray, buffer, memoryview)):
+        return len(data)
+
+    return 0